@@ -2,6 +2,7 @@
 from .add_book import router as add_book_router
 from .get_all_books import router as get_all_books_router
 from .get_recommendation import router as get_recommendation_router
+from .get_recommendation_batch import router as get_recommendation_batch_router
 from .mark_read import router as mark_read_router
 from .remove_book import router as remove_book_router
 from .clear_database import router as clear_database_router
@@ -1,33 +1,53 @@
-from fastapi import APIRouter, Request
+import asyncio
+from fastapi import APIRouter, Request, Depends
+from fastapi.responses import JSONResponse
 from datetime import datetime, timezone
-from google.cloud import bigquery
-import json
+import pyarrow as pa
 
 from app.models import AddBookRequest
 from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
+from app.books.helpers import embedding_codec
+from app.books.helpers.columnar_writer import ColumnarWriter
 from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+from app.books.helpers.embeddings_worker_pool import EmbeddingsWorkerPool
+from app.books.helpers.existing_ids import ExistingIds
+from app.books.helpers.library_cache import LibraryCache
+from app.books.helpers.query_runner import WritePendingError
+from app.books.helpers.recommendation_cache import RecommendationCache
+from app.books.helpers.vector_index import VectorIndex
 from app.books.helpers.book_metadata.openlibrary import OpenLibraryProvider
 from app.books.helpers.book_metadata.provider_factory import get_providers
 
 router = APIRouter()
 
+SOURCE_TABLE_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("owner", pa.string()),
+    ("isbn", pa.string()),
+    ("title", pa.string()),
+    ("authors", pa.list_(pa.string())),
+    ("last_read", pa.timestamp("us", tz="UTC")),
+    ("created_at", pa.timestamp("us", tz="UTC"))
+])
+
 def create_source_table_id(owner: str, isbn: str) -> str:
     return f"{owner}:{isbn}"
 
-@router.post("/books", response_model=None, status_code=201, operation_id="AddBook")
+@router.post("/books", response_model=None, status_code=201, responses={202: {"description": "The write is still running in BigQuery and may yet commit"}}, operation_id="AddBook")
 async def add_book(
     request: Request,
-    add_book_request: AddBookRequest
+    add_book_request: AddBookRequest,
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
     ):
     """
-    Inserts data into both tables atomically within a single BigQuery transaction.
+    Inserts data into both tables atomically: the rows are loaded into staging tables as Parquet, then copied into
+    both tables within a single BigQuery transaction.
     """
-    bigquery_client_helper = get_bigquery_client()
-
     log_payload = {
         "add_book_request" : add_book_request.dict(),
         "bigquery_client_helper": bigquery_client_helper.to_dict(),
-        "embeddings_generator": EmbeddingsGenerator.to_dict()
+        "embeddings_generator": EmbeddingsGenerator.to_dict(),
+        "embeddings_worker_pool": EmbeddingsWorkerPool.to_dict()
     }
     cloud_logger = request.app.state.cloud_logging_client.logger("app-log")
     cloud_logger.log_struct(log_payload, severity="INFO")
@@ -35,12 +55,22 @@ async def add_book(
     # Uniquify the list of incoming ISBNs and only process the ones that have not been processed before
     # TODO:  This does not factor in any user-provided relevant text/tags and does not account for new providers needed to process
     isbns_to_process: list[str] = [cleaned_isbn.isbn for cleaned_isbn in add_book_request.isbns]
-    unique_isbns = [isbn for isbn in list(set(isbns_to_process)) if not id_exists(
-        bigquery_client_helper=bigquery_client_helper,
-        table_id=bigquery_client_helper.source_table_id,
-        id_column="id",
-        id=f"{add_book_request.owner}:{isbn}"
-    )]
+    # One query per table for all of the ISBNs, both tables at once
+    existing_source_ids, existing_embedding_isbns = await asyncio.gather(
+        ExistingIds.find(
+            bigquery_client_helper,
+            table_id=bigquery_client_helper.source_table_id,
+            id_column="id",
+            ids=[create_source_table_id(add_book_request.owner, isbn) for isbn in isbns_to_process]
+        ),
+        ExistingIds.find(
+            bigquery_client_helper,
+            table_id=bigquery_client_helper.embeddings_table_id,
+            id_column="isbn",
+            ids=isbns_to_process
+        )
+    )
+    unique_isbns = [isbn for isbn in list(set(isbns_to_process)) if create_source_table_id(add_book_request.owner, isbn) not in existing_source_ids]
     # Get all the metadata for each of the given ISBNs
     providers = get_providers()
     final_metadatas: dict[str, list] = { isbn: [] for isbn in unique_isbns }
@@ -49,10 +79,6 @@ async def add_book(
         for isbn, metadata in metadatas.items():
             final_metadatas[isbn].extend(metadata)
 
-    utc_now = datetime.now(timezone.utc)
-    source_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.source_table_id}"
-    embeddings_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.embeddings_table_id}"
-
     # Construct the objects needed to add to the source table
     source_table_data = []
     for isbn, metadata in final_metadatas.items():
@@ -64,144 +90,77 @@ async def add_book(
         metadata = list(set(metadata))
 
         source_table_data.append({
-            "id": f"{add_book_request.owner}:{isbn}",
+            "id": create_source_table_id(add_book_request.owner, isbn),
             "owner": add_book_request.owner,
             "isbn": isbn,
             "title": title,
             "authors": authors,
-            "last_read": None,
-            "created_at": utc_now.isoformat()
+            "last_read": None
         })
     
     # Construct the objects needed to add to the embeddings table, if needed
-    embeddings_table_data = []
-    for isbn, metadata in final_metadatas.items():
-        need_embeddings = not id_exists(
-            bigquery_client_helper=bigquery_client_helper,
-            table_id=bigquery_client_helper.embeddings_table_id,
-            id_column="isbn",
-            id=isbn,
-        )
-        if not need_embeddings:
-            continue
-        
-        # TODO:  Bring back user-provided tags
-        # TODO:  Should we put the title of the book as well?
-        embeddings_info: list[EmbeddingsGenerator.EmbeddingsInfo] = EmbeddingsGenerator.generate_embeddings(tags="", relevant_text=metadata)
-        for info in embeddings_info:
-            emb_raw_list = info.embedding_raw
-            emb_norm_list = info.embedding_normalized
-            if hasattr(emb_raw_list, "tolist"):
-                emb_raw_list = emb_raw_list.tolist()
-            if hasattr(emb_norm_list, "tolist"):
-                emb_norm_list = emb_norm_list.tolist()
-            # if it's a numpy scalar or other, coerce to list
-            emb_raw_list = list(map(float, emb_raw_list))
-            emb_norm_list = list(map(float, emb_norm_list))
-            embeddings_table_data.append({
-                "isbn": isbn,
-                "content": info.text,
-                "embedding_raw": emb_raw_list,
-                "embedding_normalized": emb_norm_list,
-                "model_name": EmbeddingsGenerator.MODEL_FILE,
-                "created_at": utc_now.isoformat(),   # ISO string
-                # TODO:  Fill in owner if it is a user-provided text
-                "owner": None
-            })
-
-    transaction_script = f"""
-    BEGIN TRANSACTION;
-
-    -- Insert multiple source rows
-    INSERT INTO `{source_table_id}` (
-        id, owner, isbn, title, authors, last_read, created_at
-    )
-    SELECT
-        JSON_VALUE(elem, '$.id') AS id,
-        JSON_VALUE(elem, '$.owner') AS owner,
-        JSON_VALUE(elem, '$.isbn') AS isbn,
-        JSON_VALUE(elem, '$.title') AS title,
-
-        (
-        SELECT ARRAY_AGG(JSON_VALUE(a, '$'))
-        FROM UNNEST(JSON_EXTRACT_ARRAY(elem, '$.authors')) AS a
-        ) AS authors,
-
-        CAST(JSON_VALUE(elem, '$.last_read') AS TIMESTAMP) AS last_read,
-        CAST(JSON_VALUE(elem, '$.created_at') AS TIMESTAMP) AS created_at
-    FROM UNNEST(JSON_EXTRACT_ARRAY(@source_rows_json)) AS elem;
-
-    -- Insert multiple embedding rows (each may have different ISBNs)
-    INSERT INTO `{embeddings_table_id}` (
-        isbn, content, embedding_raw, embedding_normalized, model_name, created_at, owner
-    )
-    SELECT
-        JSON_VALUE(elem, '$.isbn') AS isbn,
-        JSON_VALUE(elem, '$.content') AS content,
-
-        (
-        SELECT ARRAY_AGG(CAST(JSON_VALUE(e, '$') AS FLOAT64))
-        FROM UNNEST(JSON_EXTRACT_ARRAY(elem, '$.embedding_raw')) AS e
-        ) AS embedding_raw,
-
-        (
-        SELECT ARRAY_AGG(CAST(JSON_VALUE(e, '$') AS FLOAT64))
-        FROM UNNEST(JSON_EXTRACT_ARRAY(elem, '$.embedding_normalized')) AS e
-        ) AS embedding_normalized,
-
-        JSON_VALUE(elem, '$.model_name') AS model_name,
-        CAST(JSON_VALUE(elem, '$.created_at') AS TIMESTAMP) AS created_at,
-        JSON_VALUE(elem, '$.owner') AS owner
-    FROM UNNEST(JSON_EXTRACT_ARRAY(@embeddings_json)) AS elem;
-
-    COMMIT TRANSACTION;
-    """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter(
-                "source_rows_json", "STRING", json.dumps(source_table_data)
-            ),
-            bigquery.ScalarQueryParameter(
-                "embeddings_json", "STRING", json.dumps(embeddings_table_data)
-            ),
-        ]
+    isbns_needing_embeddings = [isbn for isbn in final_metadatas if isbn not in existing_embedding_isbns]
+
+    # TODO:  Bring back user-provided tags
+    # TODO:  Should we put the title of the book as well?
+    # About one job per worker process, each embedding the texts of a run of ISBNs together, so the event loop stays free
+    all_embeddings_info: list[list[EmbeddingsGenerator.EmbeddingsInfo]] = await EmbeddingsWorkerPool.generate_embeddings_grouped(
+        [final_metadatas[isbn] for isbn in isbns_needing_embeddings]
     )
+    embedding_rows = [
+        (isbn, info)
+        for isbn, embeddings_info in zip(isbns_needing_embeddings, all_embeddings_info)
+        for info in embeddings_info
+    ]
+
+    # Taken once the slow part is done, so created_at trails the commit by as little as possible (GET /books?since=
+    # relies on it)
+    utc_now = datetime.now(timezone.utc)
+    for row in source_table_data:
+        row["created_at"] = utc_now
+
+    # Columnar from here on: the rows go to BigQuery as Parquet, the vectors as float32 lists
+    source_table = pa.Table.from_pylist(source_table_data, schema=SOURCE_TABLE_SCHEMA)
+    embeddings_table = pa.table({
+        "isbn": pa.array([isbn for isbn, _ in embedding_rows], type=pa.string()),
+        "content": pa.array([info.text for _, info in embedding_rows], type=pa.string()),
+        "embedding_raw": embedding_codec.to_arrow_list([info.embedding_raw for _, info in embedding_rows]),
+        "embedding_normalized": embedding_codec.to_arrow_list([info.embedding_normalized for _, info in embedding_rows]),
+        "model_name": pa.array([EmbeddingsGenerator.MODEL_FILE] * len(embedding_rows), type=pa.string()),
+        "created_at": pa.array([utc_now] * len(embedding_rows), type=pa.timestamp("us", tz="UTC")),
+        # TODO:  Fill in owner if it is a user-provided text
+        "owner": pa.nulls(len(embedding_rows), type=pa.string())
+    })
 
     try:
-        query_job = bigquery_client_helper.client.query(transaction_script, job_config=job_config)
-        # Waiting on the result means we wait for the COMMIT to finish
-        query_job.result()
+        # Both tables or neither: staged with load jobs, then copied over in one transaction
+        await ColumnarWriter.insert(bigquery_client_helper, {
+            bigquery_client_helper.source_table_id: source_table,
+            bigquery_client_helper.embeddings_table_id: embeddings_table
+        })
         print(f"Full non-streaming transaction committed successfully for ISBN: {add_book_request.isbns}.")
-        print(f"Inserted {len(source_table_data)} source table rows")
-        print(f"Inserted {len(embeddings_table_data)} embedding rows.")
+        print(f"Inserted {source_table.num_rows} source table rows")
+        print(f"Inserted {embeddings_table.num_rows} embedding rows.")
+
+        VectorIndex.add_books(
+            owner=add_book_request.owner,
+            isbns=[row["isbn"] for row in source_table_data],
+            rows=[(isbn, info.text, info.embedding_normalized) for isbn, info in embedding_rows]
+        )
+        RecommendationCache.invalidate(add_book_request.owner)
+        LibraryCache.invalidate(add_book_request.owner)
+        ExistingIds.remember(bigquery_client_helper.source_table_id, [row["id"] for row in source_table_data])
+        ExistingIds.remember(bigquery_client_helper.embeddings_table_id, {isbn for isbn, _ in embedding_rows})
+
+    except WritePendingError as e:
+        # It may still commit or roll back: read this owner's books from BigQuery again rather than guess
+        print(f"Transaction still running for ISBN: {add_book_request.isbns}: {e}")
+        VectorIndex.invalidate(add_book_request.owner)
+        RecommendationCache.invalidate(add_book_request.owner)
+        LibraryCache.invalidate(add_book_request.owner)
+        return JSONResponse(status_code=202, content=e.to_dict())
 
     except Exception as e:
         print(f"Transaction failed and was rolled back: {e}")
         # BigQuery automatically rolls back the entire transaction if an error occurs within the script
         raise
-
-def id_exists(bigquery_client_helper: BigQueryClientHelper, table_id:str, id_column:str, id: str) -> bool:
-    table_ref = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{table_id}"
-    query = f"""
-        SELECT
-            COUNT(*) as row_count
-        FROM
-            `{table_ref}`
-        WHERE
-            {id_column} = @id_param
-    """
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("id_param", "STRING", id)
-        ]
-    )
-
-    query_job = bigquery_client_helper.client.query(query, job_config=job_config)
-
-    # We should only get a single row with one column
-    row = next(query_job.result())
-    row_count = row["row_count"]
-
-    return row_count > 0
-
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, Request, Query
+from fastapi import APIRouter, Request, Query, Depends
 
 from app.books.add_book import add_book
 from app.books.clear_database import clear_database
+from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
 from app.models import AddBookRequest, CleanedISBN
 
 router = APIRouter()
@@ -9,9 +10,10 @@ router = APIRouter()
 @router.post("/reset", response_model=None, operation_id="ClearAndSeedDbForTesting")
 async def clear_and_seed_db(
     request: Request,
-    owner: str = Query(..., example="user@gmail.com")
+    owner: str = Query(..., example="user@gmail.com"),
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
     ):
-    await clear_database()
+    await clear_database(bigquery_client_helper=bigquery_client_helper)
     
     add_book_request = AddBookRequest(
         owner=owner,
@@ -33,5 +35,6 @@ async def clear_and_seed_db(
     )
     await add_book(
         request=request,
-        add_book_request=add_book_request
+        add_book_request=add_book_request,
+        bigquery_client_helper=bigquery_client_helper
     )
@@ -1,15 +1,21 @@
-from fastapi import APIRouter
-from app.books.helpers.bigquery_client_helper import get_bigquery_client
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
+from app.books.helpers.existing_ids import ExistingIds
+from app.books.helpers.library_cache import LibraryCache
+from app.books.helpers.query_runner import QueryRunner, WritePendingError
+from app.books.helpers.recommendation_cache import RecommendationCache
+from app.books.helpers.vector_index import VectorIndex
 
 router = APIRouter()
 
-@router.delete("/books", response_model=None, operation_id="ClearDatabase")
-async def clear_database():
+@router.delete("/books", response_model=None, responses={202: {"description": "The write is still running in BigQuery and may yet commit"}}, operation_id="ClearDatabase")
+async def clear_database(
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
+    ):
     """
     Clears all tables
     """
-    bigquery_client_helper = get_bigquery_client()
-
     transaction_script = f"""
     BEGIN TRANSACTION;
 
@@ -20,11 +26,25 @@ async def clear_database():
     """
 
     try:
-        query_job = bigquery_client_helper.client.query(transaction_script, job_config=None)
         # Waiting on the result means we wait for the COMMIT to finish
-        rows = query_job.result()
+        rows = await QueryRunner.run_write(bigquery_client_helper, transaction_script)
         for row in rows:
             print(row)
+        VectorIndex.invalidate()
+        RecommendationCache.invalidate()
+        LibraryCache.invalidate()
+        LibraryCache.record_unlisted_removals()
+        ExistingIds.forget()
+
+    except WritePendingError as e:
+        # It may still commit or roll back: read everything from BigQuery again rather than guess
+        print(f"Transaction still running: {e}")
+        VectorIndex.invalidate()
+        RecommendationCache.invalidate()
+        LibraryCache.invalidate()
+        LibraryCache.record_unlisted_removals()
+        ExistingIds.forget()
+        return JSONResponse(status_code=202, content=e.to_dict())
 
     except Exception as e:
         print(f"Transaction failed and was rolled back: {e}")
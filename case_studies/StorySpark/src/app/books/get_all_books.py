@@ -1,53 +1,189 @@
-from fastapi import APIRouter, Query
+import os
+import json
+import base64
+import binascii
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Final, Optional
+import pyarrow as pa
+import pyarrow.compute as pc
+from fastapi import APIRouter, HTTPException, Query, Depends, Request, Response
+from fastapi.responses import StreamingResponse
 from app.models import Book
 from google.cloud import bigquery
-from app.books.helpers.bigquery_client_helper import get_bigquery_client
-from app.models import CleanedISBN
+from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
+from app.books.helpers.library_cache import LibraryCache
+from app.books.helpers.query_runner import QueryRunner
+from app.books.helpers.read_marks_buffer import ReadMarksBuffer
 
 router = APIRouter()
 
-@router.get("/books", response_model=list[Book], operation_id="GetAllBooks")
+NEXT_PAGE_TOKEN_HEADER = "X-Next-Page-Token"
+WATERMARK_HEADER = "X-Library-Watermark"
+REMOVED_HEADER = "X-Library-Removed"
+# How far the returned watermark trails the read, so books whose write was still committing are sent again next time
+SINCE_OVERLAP_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_LIBRARY_SINCE_OVERLAP_SECONDS", "60"))
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+@router.get("/books", response_model=list[Book], responses={410: {"description": "since is too old for the removals after it to be listed"}}, operation_id="GetAllBooks")
 async def get_all_books(
-    owner: str = Query(..., example="user@gmail.com")
-    ) -> list[Book]:
+    request: Request,
+    owner: str = Query(..., example="user@gmail.com"),
+    page_size: Optional[int] = Query(None, gt=0, le=1000, description="Books per page, oldest first.  The token for the next page is returned in the X-Next-Page-Token header (absent on the last page).  Default: all books in one response"),
+    page_token: Optional[str] = Query(None, description="X-Next-Page-Token of the previous page"),
+    stream: bool = Query(False, description="Stream the books as NDJSON (one Book per line) as they arrive from BigQuery.  Cannot be combined with page_size"),
+    since: Optional[datetime] = Query(None, description="Only books added or marked read after this time.  Pass the X-Library-Watermark header of the previous response.  ISBNs removed after it are listed, comma separated, in the X-Library-Removed header; drop those before applying the returned books.  410 means removals cannot be listed: start over with since=1970-01-01T00:00:00Z", example="2025-01-02T03:04:05Z"),
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
+    ) -> Response:
     """
-    Retrieves all the books owned by this user
+    Retrieves the books owned by this user, ordered by created_at then id.  The rows stay in Arrow columns from
+    BigQuery until they are written out as JSON, with no Book model built per row; the JSON has the shape of
+    list[Book].
+
+    Pages are keyset pages: a page token holds the (created_at, id) of the last book of its page, and the next page
+    starts after it, so books added or removed meanwhile do not shift later pages.
+
+    The full listing (no page_size, page_token, stream or since) is served from the owner's LibraryCache snapshot
+    with a strong ETag, and If-None-Match is answered with 304.
+
+    With since, books removed after it are reported from LibraryCache's removal log, or with 410 Gone when this
+    instance cannot list them all.  since at or before 1970-01-01 asks for everything, so it never gets a 410.
     """
-    bigquery_client_helper = get_bigquery_client()
+    if stream and page_size is not None:
+        raise HTTPException(status_code=422, detail="stream cannot be combined with page_size")
+    after = _decode_page_token(page_token, owner) if page_token is not None else None
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+
     table_id = f"{bigquery_client_helper.source_table_id}"
     table_ref = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{table_id}"
 
+    # Read marks not yet written to BigQuery
+    read_marks = ReadMarksBuffer.overlay(owner)
+    headers = {}
+    if since is not None:
+        # Taken before the read: anything committed after it is in the next response.  So are the removals: one
+        # logged after this is reported next time, and the read below cannot return a book removed before it.
+        headers[WATERMARK_HEADER] = (datetime.now(timezone.utc) - timedelta(seconds=SINCE_OVERLAP_SECONDS)).isoformat()
+        removed = LibraryCache.removals_since(owner, since) if since > _EPOCH else []
+        if removed is None:
+            raise HTTPException(status_code=410, detail="Books may have been removed since then that cannot be listed; start over with since=1970-01-01T00:00:00Z")
+        headers[REMOVED_HEADER] = ",".join(removed)
+
     query = f"""
         SELECT
-            *
+            id, owner, isbn, title, authors, last_read, created_at
         FROM
             `{table_ref}`
         WHERE
             owner = @owner
+            {"AND (created_at > @after_created_at OR (created_at = @after_created_at AND id > @after_id))" if after is not None else ""}
+            {"AND (created_at > @since OR last_read > @since OR isbn IN UNNEST(@marked_isbns))" if since is not None else ""}
+        ORDER BY
+            created_at, id
+        {"LIMIT @limit" if page_size is not None else ""}
     """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("owner", "STRING", owner)
-        ]
-    )
+    query_parameters = [
+        bigquery.ScalarQueryParameter("owner", "STRING", owner)
+    ]
+    if after is not None:
+        query_parameters.append(bigquery.ScalarQueryParameter("after_created_at", "TIMESTAMP", after[0]))
+        query_parameters.append(bigquery.ScalarQueryParameter("after_id", "STRING", after[1]))
+    if since is not None:
+        query_parameters.append(bigquery.ScalarQueryParameter("since", "TIMESTAMP", since))
+        # Marked read after since, but maybe not yet in BigQuery
+        query_parameters.append(bigquery.ArrayQueryParameter("marked_isbns", "STRING", [isbn for isbn, last_read in read_marks.items() if last_read > since]))
+    if page_size is not None:
+        # One extra row tells whether there is a next page
+        query_parameters.append(bigquery.ScalarQueryParameter("limit", "INT64", page_size + 1))
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
 
-    query_job = bigquery_client_helper.client.query(query, job_config=job_config)
-    rows = query_job.result()
-    all_books = []
-    for row in rows:
-        book = Book(
-            id=row['id'],
-            owner=row['owner'],
-            isbn=CleanedISBN(isbn=row['isbn']),
-            title=row['title'],
-            authors=row['authors'],
-            last_read=row['last_read'],
-            created_at=row['created_at']
-        )
-        all_books.append(book)
+    if page_size is None and page_token is None and not stream and since is None:
+        # Shared by concurrent polls, so not tied to this request
+        async def load() -> bytes:
+            table = await QueryRunner.run_arrow(bigquery_client_helper, query, job_config=job_config)
+            return books_to_json(ReadMarksBuffer.apply_overlay(table, read_marks))
+        snapshot = await LibraryCache.get_or_load(owner, load)
+        # Clients may keep the body, but must check back before using it
+        headers = {"ETag": snapshot.etag, "Cache-Control": "private, no-cache"}
+        if LibraryCache.not_modified(snapshot, request.headers.get("If-None-Match")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=snapshot.body, media_type="application/json", headers=headers)
 
-    return all_books
+    if stream:
+        batches = QueryRunner.stream_arrow(bigquery_client_helper, query, job_config=job_config, request=request)
+        # Start the query now, so a failing or timed out one is still an error status rather than a cut-off stream
+        first = await anext(batches, None)
+        return StreamingResponse(_ndjson_lines(first, batches, read_marks), media_type="application/x-ndjson", headers=headers)
 
+    # Cancelled in BigQuery too if the client disconnects first
+    table = await QueryRunner.run_arrow(bigquery_client_helper, query, job_config=job_config, request=request)
+    table = ReadMarksBuffer.apply_overlay(table, read_marks)
+    if page_size is not None and table.num_rows > page_size:
+        table = table.slice(0, page_size)
+        headers[NEXT_PAGE_TOKEN_HEADER] = _encode_page_token(owner, table)
+    return Response(content=books_to_json(table), media_type="application/json", headers=headers)
 
+def books_to_json(table: pa.Table) -> bytes:
+    """
+    Serializes book rows column by column: timestamps are formatted by Arrow in one pass per column, and the
+    Python values are only assembled into rows for the final json.dumps.
+    """
+    return json.dumps(_book_dicts(table), separators=(",", ":")).encode("utf-8")
 
+async def _ndjson_lines(first: Optional[pa.RecordBatch], batches: AsyncIterator[pa.RecordBatch], read_marks: dict) -> AsyncIterator[bytes]:
+    batch = first
+    while batch is not None:
+        if batch.num_rows:
+            batch = ReadMarksBuffer.apply_overlay(batch, read_marks)
+            yield "".join(json.dumps(book, separators=(",", ":")) + "\n" for book in _book_dicts(batch)).encode("utf-8")
+        batch = await anext(batches, None)
+
+def _book_dicts(table) -> list[dict]:
+    """
+    Book-shaped dicts of a Table or RecordBatch of book rows.
+    """
+    columns = [
+        table.column("id").to_pylist(),
+        table.column("owner").to_pylist(),
+        table.column("isbn").to_pylist(),
+        table.column("title").to_pylist(),
+        table.column("authors").to_pylist(),
+        _iso_timestamps(table.column("last_read")),
+        _iso_timestamps(table.column("created_at"))
+    ]
+    return [
+        {
+            "id": id,
+            "owner": owner,
+            "isbn": {"isbn": isbn},
+            "title": title,
+            "authors": authors or [],
+            "last_read": last_read,
+            "created_at": created_at
+        }
+        for id, owner, isbn, title, authors, last_read, created_at in zip(*columns)
+    ]
+
+def _iso_timestamps(column) -> list:
+    # UTC with microseconds, e.g. 2025-01-02T03:04:05.678901Z; nulls stay None
+    return pc.strftime(column.cast(pa.timestamp("us", tz="UTC")), format="%Y-%m-%dT%H:%M:%SZ").to_pylist()
+
+def _encode_page_token(owner: str, page: pa.Table) -> str:
+    """
+    Opaque to clients: base64 of the owner and the (created_at in microseconds, id) of the page's last book.
+    """
+    last_created_at = page.column("created_at").cast(pa.timestamp("us", tz="UTC"))[-1].value
+    last_id = page.column("id")[-1].as_py()
+    payload = json.dumps({"o": owner, "c": last_created_at, "i": last_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
 
+def _decode_page_token(page_token: str, owner: str) -> tuple[datetime, str]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(page_token + "=" * (-len(page_token) % 4)))
+        token_owner, created_at, id = payload["o"], int(payload["c"]), str(payload["i"])
+    except (binascii.Error, ValueError, TypeError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid page_token: {e}")
+    if token_owner != owner:
+        raise HTTPException(status_code=400, detail="page_token belongs to a different owner")
+    # Exact to the microsecond, unlike going through a float of seconds
+    return _EPOCH + timedelta(microseconds=created_at), id
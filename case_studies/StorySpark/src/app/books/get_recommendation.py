@@ -1,7 +1,14 @@
-from fastapi import APIRouter, Query
+import asyncio
+from typing import Literal, Optional
+import numpy as np
+from fastapi import APIRouter, Query, Depends, Request
 from app.models import RecommendedBook, CleanedISBN
-from app.books.helpers.bigquery_client_helper import get_bigquery_client
-from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
+from app.books.helpers.embeddings_batcher import EmbeddingsBatcher
+from app.books.helpers.query_runner import QueryRunner
+from app.books.helpers.read_marks_buffer import ReadMarksBuffer
+from app.books.helpers.recommendation_cache import RecommendationCache
+from app.books.helpers.vector_index import VectorIndex, VectorMatch
 from google.cloud import bigquery
 
 router = APIRouter()
@@ -11,82 +18,58 @@ async def get_recommendation(
     owner: str = Query(..., example="user@gmail.com"),
     text: str = Query(..., example="canoe"),
     limit: int = Query(10, gt=0, description="Maximum number of results; must be > 0", example=10),
-
+    search_mode: Optional[Literal["exact", "approximate", "two_stage", "hybrid"]] = Query(None, description="exact scores every embedding; approximate uses the HNSW index; two_stage prefilters books by their centroid embedding; hybrid fuses keyword (BM25) and embedding ranking.  Defaults to STORYSPARK_RECOMMENDATION_SEARCH_MODE"),
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
     ) -> list[RecommendedBook]:
-    embedding_info = EmbeddingsGenerator.generate_embeddings(tags=None, relevant_text=[text])[0]
+    # Repeated queries are answered from the result cache; concurrent identical ones share one computation
+    return await RecommendationCache.get_or_compute(
+        owner, text, limit, search_mode,
+        lambda: recommend(bigquery_client_helper, owner=owner, text=text, limit=limit, search_mode=search_mode)
+    )
 
-    bigquery_client_helper = get_bigquery_client()
-    source_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.source_table_id}"
-    embeddings_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.embeddings_table_id}"
+async def recommend(bigquery_client_helper: BigQueryClientHelper, owner: str, text: str, limit: int, search_mode: Optional[str]) -> list[RecommendedBook]:
+    if (search_mode or VectorIndex.SEARCH_MODE) == "hybrid":
+        # Keyword queries are answered without embedding the text at all
+        matches = (await VectorIndex.search_hybrid(bigquery_client_helper, owner, [text], limit, embed=embed_texts))[0]
+        return (await fetch_recommended_books(bigquery_client_helper, owner, [matches]))[0]
 
-    # TODO:  Figure out the owner stuff
-    query = f"""
-    DECLARE owner_param STRING DEFAULT @owner;
-    DECLARE query_embedding ARRAY<FLOAT64> DEFAULT @query_embedding;
+    embedding_info = await EmbeddingsBatcher.embed(text)
 
-    -- Filter to only books owned by this person
-    WITH owner_books AS (
-        SELECT *
-        FROM `{source_table_id}`
-        WHERE owner = owner_param
-    ),
-    owner_isbns AS (
-      SELECT DISTINCT isbn AS isbn
-      FROM owner_books
-    ),
-    -- Calculate similarity scores
-    scored AS (
-        SELECT
-            isbn,
-            content,
-            (
-                SELECT SUM(a * b)
-                FROM UNNEST(s.embedding_normalized) AS a WITH OFFSET row_pos
-                JOIN UNNEST(query_embedding) AS b WITH OFFSET query_pos
-                ON row_pos = query_pos
-            ) AS cosine_similarity
-        FROM `{embeddings_table_id}` as s
-        WHERE s.isbn IN (SELECT isbn FROM owner_isbns)
-    ),
-    -- Pick the closest similarity score per ISBN
-    ranked AS (
-        SELECT
-            isbn,
-            content,
-            cosine_similarity,
-            ROW_NUMBER() OVER
-            (
-                PARTITION by isbn
-                ORDER BY cosine_similarity DESC
-            ) AS row_num
-        FROM scored
-    ),
-    -- Pick the best one
-    best_per_isbn AS (
-        SELECT
-            isbn,
-            content,
-            cosine_similarity AS best_cosine_similarity
-        FROM ranked
-        WHERE row_num = 1
-    )
-    -- Join back with the original table to get more information
+    # Rank in process: best-matching text per ISBN, top `limit` ISBNs
+    matches = await VectorIndex.search(bigquery_client_helper, owner, embedding_info.embedding_normalized, limit, mode=search_mode)
+    return (await fetch_recommended_books(bigquery_client_helper, owner, [matches]))[0]
+
+async def embed_texts(texts: list[str]) -> np.ndarray:
+    """
+    (Q, D) normalized embeddings of a few query texts, through the micro-batcher.  Submitted together, so they
+    share one batch.
+    """
+    infos = await asyncio.gather(*(EmbeddingsBatcher.embed(text) for text in texts))
+    return np.stack([info.embedding_normalized for info in infos])
+
+async def fetch_recommended_books(bigquery_client_helper: BigQueryClientHelper, owner: str, match_lists: list[list[VectorMatch]], request: Optional[Request] = None) -> list[list[RecommendedBook]]:
+    """
+    Turns ranked matches (one list per query) into RecommendedBooks, reading the matched books in one query.
+    Read fresh rather than cached so last_read etc. are current.  With a request, the query is cancelled if the
+    client disconnects (leave it out when the result is shared through the result cache).
+    """
+    isbns = sorted({match.isbn for matches in match_lists for match in matches})
+    if not isbns:
+        return [[] for _ in match_lists]
+
+    source_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.source_table_id}"
+    query = f"""
     SELECT
-        ANY_VALUE(ob.id) AS id,
-        ANY_VALUE(ob.owner) AS owner,
-        best.isbn,
-        ANY_VALUE(ob.title) AS title,
-        ANY_VALUE(ob.authors) AS authors,
-        best.content AS relevant_text,
-        ANY_VALUE(ob.last_read) AS last_read,
-        ANY_VALUE(ob.created_at) AS created_at,
-        best.best_cosine_similarity
-    FROM best_per_isbn AS best
-    LEFT JOIN owner_books AS ob
-        ON ob.isbn = best.isbn
-    GROUP BY best.isbn, best.content, best.best_cosine_similarity
-    ORDER BY best_cosine_similarity DESC
-    LIMIT @limit
+        ANY_VALUE(id) AS id,
+        ANY_VALUE(owner) AS owner,
+        isbn,
+        ANY_VALUE(title) AS title,
+        ANY_VALUE(authors) AS authors,
+        ANY_VALUE(last_read) AS last_read,
+        ANY_VALUE(created_at) AS created_at
+    FROM `{source_table_id}`
+    WHERE owner = @owner AND isbn IN UNNEST(@isbns)
+    GROUP BY isbn
     """
 
     job_config = bigquery.QueryJobConfig(
@@ -95,32 +78,39 @@ async def get_recommendation(
                 "owner", "STRING", owner
             ),
             bigquery.ArrayQueryParameter(
-                "query_embedding", "FLOAT64", embedding_info.embedding_normalized
-            ),
-            bigquery.ScalarQueryParameter("limit", "INT64", limit)
+                "isbns", "STRING", isbns
+            )
         ]
     )
 
+    # Read marks not yet written to BigQuery
+    read_marks = ReadMarksBuffer.overlay(owner)
     try:
-        query_job = bigquery_client_helper.client.query(query=query, job_config=job_config)
-        rows = query_job.result()
-        all_books = []
-        for row in rows:
+        table = await QueryRunner.run_arrow(bigquery_client_helper, query, job_config=job_config, request=request)
+        books_by_isbn = {row['isbn']: row for row in ReadMarksBuffer.apply_overlay(table, read_marks).to_pylist()}
+    except Exception as e:
+        print(f"Query failed:  {e}")
+        raise
+
+    all_books = []
+    for matches in match_lists:
+        books = []
+        for match in matches:
+            row = books_by_isbn.get(match.isbn)
+            if row is None:
+                # Removed through another instance since the index was loaded
+                continue
             book = RecommendedBook(
                 id=row['id'],
                 owner=row['owner'],
                 isbn=CleanedISBN(isbn=row['isbn']),
                 title=row['title'],
                 authors=row['authors'],
-                relevant_text=row['relevant_text'],
+                relevant_text=match.content,
                 last_read=row['last_read'],
                 created_at=row['created_at'],
-                cosine_simularity=row['best_cosine_similarity']
+                cosine_simularity=match.cosine_similarity
             )
-            all_books.append(book)
-            
-        return all_books
-    except Exception as e:
-        print(f"Query failed:  {e}")
-        raise
-
+            books.append(book)
+        all_books.append(books)
+    return all_books
@@ -0,0 +1,43 @@
+import asyncio
+import numpy as np
+from fastapi import APIRouter, Depends, Request
+from app.models import RecommendationBatchRequest, RecommendationBatchResult
+from app.books.get_recommendation import fetch_recommended_books
+from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
+from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+from app.books.helpers.vector_index import VectorIndex
+
+router = APIRouter()
+
+@router.post("/books/recommendation:batch", response_model=list[RecommendationBatchResult], operation_id="GetBookRecommendationBatch")
+async def get_recommendation_batch(
+    request: Request,
+    recommendation_batch_request: RecommendationBatchRequest,
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
+    ) -> list[RecommendationBatchResult]:
+    """
+    Recommendations for several query texts of one owner at once (e.g. a row of themed shelves).
+    The texts are embedded together in padded ONNX batches, scored against the owner's embeddings in a single
+    matrix-matrix product, and the matched books are read in one query.  Results are in the order of the texts.
+    """
+    texts = recommendation_batch_request.texts
+    owner = recommendation_batch_request.owner
+    limit = recommendation_batch_request.limit
+    search_mode = recommendation_batch_request.search_mode
+
+    if (search_mode or VectorIndex.SEARCH_MODE) == "hybrid":
+        # Only the texts that are not keyword queries get embedded
+        match_lists = await VectorIndex.search_hybrid(bigquery_client_helper, owner, texts, limit, embed=embed_batch)
+    else:
+        queries = await embed_batch(texts)
+        match_lists = await VectorIndex.search_many(bigquery_client_helper, owner, queries, limit, mode=search_mode)
+    books_per_text = await fetch_recommended_books(bigquery_client_helper, owner, match_lists, request=request)
+
+    return [RecommendationBatchResult(text=text, books=books) for text, books in zip(texts, books_per_text)]
+
+async def embed_batch(texts: list[str]) -> np.ndarray:
+    """
+    (Q, D) normalized embeddings.  Runs on a thread so the event loop stays free; duplicate texts are only embedded once.
+    """
+    embeddings_info = await asyncio.to_thread(EmbeddingsGenerator.generate_embeddings, tags=None, relevant_text=texts)
+    return np.stack([info.embedding_normalized for info in embeddings_info])
@@ -1,14 +1,27 @@
 from urllib.request import Request
 from google.cloud import bigquery
 import os
+import time
+import threading
+from typing import Final, Optional
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    # Optional: without it every read goes through the REST API
+    bigquery_storage = None
 
 class BigQueryClientHelper:
-    def __init__(self, project_id, dataset_id, source_table_id, embeddings_table_id, client):
+    def __init__(self, project_id, dataset_id, source_table_id, embeddings_table_id, client, read_client=None):
         self.project_id = project_id
         self.dataset_id = dataset_id
         self.source_table_id = source_table_id
         self.embeddings_table_id = embeddings_table_id
         self.client = client
+        # BigQuery Storage Read API client for large results; None when google-cloud-bigquery-storage is not installed
+        self.read_client = read_client
     
     def to_dict(self):
         return {
@@ -19,13 +32,95 @@ class BigQueryClientHelper:
             # intentionally omit client or include only safe metadata "client_info": {"project": getattr(self.client, "project", None)}
         }
 
+class BigQueryClients:
+    """
+    The process-wide BigQuery client.
+
+    Created once (in the app lifespan, or on first use outside the app) so credential discovery, token refresh and
+    TLS handshakes are paid once per process instead of once per request.  Its HTTP session keeps up to
+    HTTP_POOL_SIZE keep-alive connections per host, enough for every request a worker has in flight (the default
+    of 10 would make the rest open and drop connections of their own).
+    """
+    HTTP_POOL_SIZE: Final[int] = int(os.environ.get("STORYSPARK_BIGQUERY_HTTP_POOL_SIZE", "32"))
+    HTTP_MAX_RETRIES: Final[int] = int(os.environ.get("STORYSPARK_BIGQUERY_HTTP_MAX_RETRIES", "3"))
+
+    _helper: Optional[BigQueryClientHelper] = None
+    _lock = threading.Lock()
+
+    # metrics
+    _created: int = 0
+    _create_seconds: float = 0.0
+
+    # ---------- public API ----------
+    @staticmethod
+    def start():
+        """
+        Creates the client up front.  A failure (e.g. no credentials on a dev box) is only logged; get() tries again.
+        """
+        try:
+            BigQueryClients.get()
+        except Exception as e:
+            print(f"Failed to create the BigQuery client; it will be created on first use: {e}")
+
+    @staticmethod
+    def get() -> BigQueryClientHelper:
+        helper = BigQueryClients._helper
+        if helper is None:
+            with BigQueryClients._lock:
+                # Only one caller creates it; the others wait for that one
+                if BigQueryClients._helper is None:
+                    BigQueryClients._helper = BigQueryClients._create()
+                helper = BigQueryClients._helper
+        return helper
+
+    @staticmethod
+    def stop():
+        """
+        Closes the client's HTTP connections (and the Storage Read API channel).
+        """
+        with BigQueryClients._lock:
+            helper = BigQueryClients._helper
+            BigQueryClients._helper = None
+        if helper is not None:
+            helper.client.close()
+            if helper.read_client is not None:
+                helper.read_client.transport.close()
+
+    @staticmethod
+    def to_dict():
+        return {
+            "HTTP_POOL_SIZE": BigQueryClients.HTTP_POOL_SIZE,
+            "HTTP_MAX_RETRIES": BigQueryClients.HTTP_MAX_RETRIES,
+            "started": BigQueryClients._helper is not None,
+            "storage_read_api": bigquery_storage is not None,
+            "created": BigQueryClients._created,
+            "create_seconds": BigQueryClients._create_seconds,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _create() -> BigQueryClientHelper:
+        started_at = time.perf_counter()
+        project_id = os.environ.get("STORYSPARK_GCP_BQ_PROJECT_ID")
+        credentials, _ = google.auth.default(scopes=bigquery.Client.SCOPE)
+
+        session = AuthorizedSession(credentials)
+        # Retries only cover failing to connect; the BigQuery client retries API errors itself
+        adapter = HTTPAdapter(pool_connections=BigQueryClients.HTTP_POOL_SIZE, pool_maxsize=BigQueryClients.HTTP_POOL_SIZE, max_retries=BigQueryClients.HTTP_MAX_RETRIES)
+        session.mount("https://", adapter)
+
+        helper = BigQueryClientHelper(project_id=project_id,
+                                      dataset_id=os.environ.get("STORYSPARK_GCP_BQ_DATASET_ID"),
+                                      source_table_id=os.environ.get("STORYSPARK_GCP_BQ_SOURCE_TABLE_ID"),
+                                      embeddings_table_id=os.environ.get("STORYSPARK_GCP_BQ_EMBEDDINGS_TABLE_ID"),
+                                      client=bigquery.Client(project=project_id, credentials=credentials, _http=session),
+                                      # gRPC; its channel is opened on the first large read
+                                      read_client=bigquery_storage.BigQueryReadClient(credentials=credentials) if bigquery_storage is not None else None)
+        BigQueryClients._created += 1
+        BigQueryClients._create_seconds += time.perf_counter() - started_at
+        return helper
+
 def get_bigquery_client() -> BigQueryClientHelper:
-    """Creates and returns a BigQuery client using default credentials from the Environment Variables"""
+    """Returns the process-wide BigQuery client, using default credentials from the Environment Variables.  Use it as a FastAPI dependency: Depends(get_bigquery_client)"""
 
-    bigquery_client_helper = BigQueryClientHelper(project_id=os.environ.get("STORYSPARK_GCP_BQ_PROJECT_ID"),
-                                                  dataset_id=os.environ.get("STORYSPARK_GCP_BQ_DATASET_ID"),
-                                                  source_table_id=os.environ.get("STORYSPARK_GCP_BQ_SOURCE_TABLE_ID"),
-                                                  embeddings_table_id=os.environ.get("STORYSPARK_GCP_BQ_EMBEDDINGS_TABLE_ID"),
-                                                  client=bigquery.Client(project=os.environ.get("STORYSPARK_GCP_BQ_PROJECT_ID")))
-    
-    return bigquery_client_helper
\ No newline at end of file
+    return BigQueryClients.get()
@@ -0,0 +1,180 @@
+import os
+import io
+import time
+import uuid
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Final
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+from app.books.helpers.bigquery_client_helper import BigQueryClientHelper
+from app.books.helpers.query_runner import QueryRunner, WritePendingError
+
+class ColumnarWriter:
+    """
+    All-or-nothing bulk inserts of Arrow tables.
+
+    Each table is written as Parquet and loaded into a staging table of its own with load jobs, CHUNK_ROWS rows per
+    load, so large ingests are uploaded in bounded pieces and nothing goes through query parameters.  One transaction
+    then copies every staging table into its target, so the targets get all of the rows or none of them; a load that
+    fails leaves the targets untouched.  The transaction goes through QueryRunner.run_write, so it is never
+    cancelled; if it outlasts the write timeout, insert raises WritePendingError and the staging tables are left
+    for it to read.  Staging tables are dropped afterwards, and expire after STAGING_TTL_SECONDS in case the drop
+    never happens.
+
+    Load jobs are free and take columnar data as is, where DML with the rows in JSON parameters had BigQuery parse
+    every value (and every embedding float) from text, and was capped by the query parameter size limit.
+    """
+    CHUNK_ROWS: Final[int] = int(os.environ.get("STORYSPARK_BULK_WRITE_CHUNK_ROWS", "10000"))
+    STAGING_TTL_SECONDS: Final[int] = int(os.environ.get("STORYSPARK_BULK_WRITE_STAGING_TTL_SECONDS", "3600"))
+
+    # metrics
+    _writes: int = 0
+    _failed: int = 0
+    _pending: int = 0
+    _rows: int = 0
+    _load_jobs: int = 0
+    _parquet_bytes: int = 0
+    _seconds: float = 0.0
+
+    # ---------- public API ----------
+    @staticmethod
+    async def insert(bigquery_client_helper: BigQueryClientHelper, tables: dict[str, pa.Table]):
+        """
+        Inserts the rows of each Arrow table into the BigQuery table of the same id (within the helper's dataset),
+        atomically across all of them.  Arrow column names and types must match the target's columns.
+        """
+        tables = {table_id: table for table_id, table in tables.items() if table.num_rows}
+        if not tables:
+            return
+
+        started_at = time.perf_counter()
+        ColumnarWriter._writes += 1
+        staging_ids = {table_id: f"{table_id}_staging_{uuid.uuid4().hex}" for table_id in tables}
+        pending = False
+        try:
+            # The tables are staged side by side, each one's chunks in order
+            await asyncio.gather(*(
+                asyncio.to_thread(ColumnarWriter._stage, bigquery_client_helper, staging_ids[table_id], table)
+                for table_id, table in tables.items()
+            ))
+            # Waiting on the result means we wait for the COMMIT to finish.  Not tied to any request: once
+            # submitted, the write is seen through.
+            await QueryRunner.run_write(bigquery_client_helper, ColumnarWriter._transaction_script(bigquery_client_helper, tables, staging_ids))
+            ColumnarWriter._rows += sum(table.num_rows for table in tables.values())
+        except Exception as e:
+            pending = isinstance(e, WritePendingError)
+            if pending:
+                ColumnarWriter._pending += 1
+            else:
+                ColumnarWriter._failed += 1
+            raise
+        finally:
+            ColumnarWriter._seconds += time.perf_counter() - started_at
+            if not pending:
+                # A transaction still running reads them; those are left to expire
+                await asyncio.gather(*(
+                    asyncio.to_thread(ColumnarWriter._drop, bigquery_client_helper, staging_id)
+                    for staging_id in staging_ids.values()
+                ))
+
+    @staticmethod
+    def to_dict():
+        return {
+            "CHUNK_ROWS": ColumnarWriter.CHUNK_ROWS,
+            "STAGING_TTL_SECONDS": ColumnarWriter.STAGING_TTL_SECONDS,
+            "writes": ColumnarWriter._writes,
+            "failed": ColumnarWriter._failed,
+            "pending": ColumnarWriter._pending,
+            "rows": ColumnarWriter._rows,
+            "load_jobs": ColumnarWriter._load_jobs,
+            "parquet_bytes": ColumnarWriter._parquet_bytes,
+            "seconds": ColumnarWriter._seconds,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _table_ref(bigquery_client_helper: BigQueryClientHelper, table_id: str) -> str:
+        return f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{table_id}"
+
+    @staticmethod
+    def _stage(bigquery_client_helper: BigQueryClientHelper, staging_id: str, table: pa.Table):
+        """
+        Creates the staging table and loads the Arrow table into it, CHUNK_ROWS rows per load job.  Blocking.
+        """
+        client = bigquery_client_helper.client
+        schema = [ColumnarWriter._schema_field(field) for field in table.schema]
+
+        staging_table = bigquery.Table(ColumnarWriter._table_ref(bigquery_client_helper, staging_id), schema=schema)
+        staging_table.expires = datetime.now(timezone.utc) + timedelta(seconds=ColumnarWriter.STAGING_TTL_SECONDS)
+        client.create_table(staging_table)
+
+        parquet_options = bigquery.ParquetOptions()
+        # Read Parquet LIST columns as REPEATED fields rather than as records with a "list" field
+        parquet_options.enable_list_inference = True
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        job_config.parquet_options = parquet_options
+
+        chunk_rows = max(ColumnarWriter.CHUNK_ROWS, 1)
+        for offset in range(0, table.num_rows, chunk_rows):
+            buffer = io.BytesIO()
+            pq.write_table(table.slice(offset, chunk_rows), buffer, compression="snappy")
+            ColumnarWriter._parquet_bytes += buffer.tell()
+            buffer.seek(0)
+
+            ColumnarWriter._load_jobs += 1
+            load_job = client.load_table_from_file(buffer, staging_table.reference, job_config=job_config, rewind=True)
+            load_job.result(timeout=QueryRunner.TIMEOUT_SECONDS)
+
+    @staticmethod
+    def _drop(bigquery_client_helper: BigQueryClientHelper, staging_id: str):
+        try:
+            bigquery_client_helper.client.delete_table(ColumnarWriter._table_ref(bigquery_client_helper, staging_id), not_found_ok=True)
+        except Exception as e:
+            # It expires on its own
+            print(f"Failed to drop staging table {staging_id}: {e}")
+
+    @staticmethod
+    def _transaction_script(bigquery_client_helper: BigQueryClientHelper, tables: dict[str, pa.Table], staging_ids: dict[str, str]) -> str:
+        inserts = []
+        for table_id, table in tables.items():
+            columns = ", ".join(table.schema.names)
+            inserts.append(f"""
+    INSERT INTO `{ColumnarWriter._table_ref(bigquery_client_helper, table_id)}` ({columns})
+    SELECT {columns} FROM `{ColumnarWriter._table_ref(bigquery_client_helper, staging_ids[table_id])}`;
+""")
+
+        return f"""
+    BEGIN TRANSACTION;
+{"".join(inserts)}
+    COMMIT TRANSACTION;
+    """
+
+    @staticmethod
+    def _schema_field(field: pa.Field) -> bigquery.SchemaField:
+        arrow_type = field.type
+        mode = "NULLABLE"
+        if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+            arrow_type = arrow_type.value_type
+            mode = "REPEATED"
+
+        if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+            field_type = "STRING"
+        elif pa.types.is_floating(arrow_type):
+            # float32 widens to FLOAT64 exactly
+            field_type = "FLOAT64"
+        elif pa.types.is_integer(arrow_type):
+            field_type = "INT64"
+        elif pa.types.is_boolean(arrow_type):
+            field_type = "BOOL"
+        elif pa.types.is_timestamp(arrow_type):
+            field_type = "TIMESTAMP"
+        else:
+            raise ValueError(f"No BigQuery type for Arrow column {field.name} of type {field.type}")
+        return bigquery.SchemaField(field.name, field_type, mode=mode)
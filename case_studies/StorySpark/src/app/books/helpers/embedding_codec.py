@@ -0,0 +1,42 @@
+import base64
+from typing import Final
+import numpy as np
+import pyarrow as pa
+
+# Embeddings are float32 from the ONNX model onwards.  On the wire they travel as little-endian float32 bytes
+# (base64 inside JSON) or as Arrow float32 lists, which is 4 bytes per value instead of ~20 characters of decimal
+# text, and is exact.
+WIRE_DTYPE: Final[np.dtype] = np.dtype("<f4")
+
+def to_bytes(embedding: np.ndarray) -> bytes:
+    return np.ascontiguousarray(embedding, dtype=WIRE_DTYPE).tobytes()
+
+def from_bytes(data: bytes) -> np.ndarray:
+    """
+    Zero-copy, read-only view over the bytes.
+    """
+    return np.frombuffer(data, dtype=WIRE_DTYPE)
+
+def to_base64(embedding: np.ndarray) -> str:
+    return base64.b64encode(to_bytes(embedding)).decode("ascii")
+
+def from_base64(data: str) -> np.ndarray:
+    return from_bytes(base64.b64decode(data))
+
+def to_list(embedding: np.ndarray) -> list[float]:
+    """
+    For APIs that only take Python floats (e.g. BigQuery FLOAT64 array parameters).  One conversion, at the boundary.
+    """
+    return np.asarray(embedding, dtype=np.float32).tolist()
+
+def to_arrow_list(embeddings: list[np.ndarray]) -> pa.ListArray:
+    """
+    The embeddings as an Arrow list<float32> column, one row each, for columnar writes (Parquet loads widen it to
+    FLOAT64 exactly).  The values are one contiguous float32 buffer, copied into Arrow once.
+    """
+    if not embeddings:
+        return pa.array([], type=pa.list_(pa.float32()))
+    values = np.ascontiguousarray(np.stack(embeddings), dtype=WIRE_DTYPE)
+    rows, dim = values.shape
+    offsets = pa.array(np.arange(0, (rows + 1) * dim, dim, dtype=np.int32))
+    return pa.ListArray.from_arrays(offsets, pa.array(values.reshape(-1)))
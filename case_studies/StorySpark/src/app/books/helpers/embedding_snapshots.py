@@ -0,0 +1,285 @@
+"""
+Per-owner snapshots of the embedding rows VectorIndex ranks against, as memory-mapped float32 .npy files.
+
+Export (or refresh) snapshots from the src directory with
+
+    python -m app.books.helpers.embedding_snapshots                 # every owner
+    python -m app.books.helpers.embedding_snapshots --owner a@b.com --compact
+"""
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import argparse
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Final, Iterator, Optional
+import numpy as np
+
+from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+
+class EmbeddingSnapshots:
+    """
+    On-disk copy of each owner's embedding rows, laid out so that loading it is an np.load(mmap_mode="r"): every
+    uvicorn worker (and every reload) maps the same page-cache pages instead of holding its own copy of the matrix.
+
+    <DIR>/<model_name>/<sha256(owner)>/
+        manifest.json   the base segment, the delta segments on top of it, and the watermark
+        <segment>.npy   float32 (rows, dim), rows of an ISBN next to each other
+        <segment>.json  sidecar: isbns, group_starts, contents of those rows
+
+    A snapshot covers embeddings created up to its watermark (the newest created_at it holds).  Books the owner
+    added since are read from BigQuery and appended as a delta segment; once there are more than MAX_DELTAS deltas,
+    or more than COMPACT_RATIO of the rows are in deltas or belong to removed books, the owner is compacted into a
+    new base.  Snapshots of another model are never read, because the directory is per model_name.
+
+    Segment files are never modified: new ones are written under fresh names, then manifest.json is replaced
+    atomically, then the old ones are unlinked (existing mappings stay valid until they are dropped).  Writers of
+    one owner are serialized with a file lock, so several workers can share DIR.
+    """
+    # Unset disables snapshots; indexes are then read from BigQuery in full
+    DIR: Final[Optional[str]] = os.environ.get("STORYSPARK_EMBEDDING_SNAPSHOT_DIR") or None
+    MAX_DELTAS: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_SNAPSHOT_MAX_DELTAS", "4"))
+    COMPACT_RATIO: Final[float] = float(os.environ.get("STORYSPARK_EMBEDDING_SNAPSHOT_COMPACT_RATIO", "0.25"))
+
+    @dataclass
+    class Segment:
+        name: str
+        isbns: list[str]
+        group_starts: np.ndarray
+        contents: list[str]
+        # Read-only memory map
+        matrix: np.ndarray
+
+    @dataclass
+    class Snapshot:
+        base: "EmbeddingSnapshots.Segment"
+        deltas: list["EmbeddingSnapshots.Segment"]
+        watermark: Optional[datetime]
+        # Bumped by every manifest write; a writer only replaces the manifest it read
+        generation: int
+
+    # metrics
+    _loads: int = 0
+    _load_seconds: float = 0.0
+    _load_failures: int = 0
+    _deltas_written: int = 0
+    _compactions: int = 0
+    _write_seconds: float = 0.0
+
+    # ---------- public API ----------
+    @staticmethod
+    def enabled() -> bool:
+        return EmbeddingSnapshots.DIR is not None
+
+    @staticmethod
+    def load(owner: str) -> Optional[Snapshot]:
+        """
+        The owner's current snapshot, memory-mapped, or None if there is none (or it cannot be read).
+        """
+        manifest = EmbeddingSnapshots._read_manifest(owner)
+        if manifest is None:
+            return None
+        started_at = time.perf_counter()
+        try:
+            directory = EmbeddingSnapshots._owner_dir(owner)
+            snapshot = EmbeddingSnapshots.Snapshot(
+                base=EmbeddingSnapshots._read_segment(directory, manifest["base"]),
+                deltas=[EmbeddingSnapshots._read_segment(directory, name) for name in manifest["deltas"]],
+                watermark=datetime.fromisoformat(manifest["watermark"]) if manifest["watermark"] else None,
+                generation=manifest["generation"],
+            )
+        except Exception as e:
+            # e.g. a segment unlinked by a compaction between reading the manifest and opening it
+            EmbeddingSnapshots._load_failures += 1
+            print(f"Failed to load embedding snapshot for {owner}: {e}")
+            return None
+        EmbeddingSnapshots._loads += 1
+        EmbeddingSnapshots._load_seconds += time.perf_counter() - started_at
+        return snapshot
+
+    @staticmethod
+    def needs_compaction(snapshot: Snapshot, dead_rows: int) -> bool:
+        """
+        dead_rows: rows of the snapshot that no longer count (removed books, re-embedded ISBNs).
+        """
+        rows = len(snapshot.base.matrix) + sum(len(delta.matrix) for delta in snapshot.deltas)
+        stale = dead_rows + sum(len(delta.matrix) for delta in snapshot.deltas)
+        return len(snapshot.deltas) > EmbeddingSnapshots.MAX_DELTAS or stale > EmbeddingSnapshots.COMPACT_RATIO * max(rows, 1)
+
+    @staticmethod
+    def append_delta(owner: str, generation: int, isbns: list[str], group_starts: np.ndarray, contents: list[str], matrix: np.ndarray, watermark: Optional[datetime]) -> Optional[int]:
+        """
+        Adds a delta segment to the snapshot of that generation and returns the new generation.  Returns None (and
+        writes nothing) if another writer replaced the manifest in the meantime; its snapshot is at least as new.
+        """
+        started_at = time.perf_counter()
+        with EmbeddingSnapshots._locked(owner):
+            manifest = EmbeddingSnapshots._read_manifest(owner)
+            if manifest is None or manifest["generation"] != generation:
+                return None
+            name = EmbeddingSnapshots._write_segment(owner, isbns, group_starts, contents, matrix)
+            manifest["deltas"].append(name)
+            manifest["watermark"] = EmbeddingSnapshots._later(manifest["watermark"], watermark)
+            EmbeddingSnapshots._write_manifest(owner, manifest)
+        EmbeddingSnapshots._deltas_written += 1
+        EmbeddingSnapshots._write_seconds += time.perf_counter() - started_at
+        return manifest["generation"]
+
+    @staticmethod
+    def write_base(owner: str, generation: int, isbns: list[str], group_starts: np.ndarray, contents: list[str], matrix: np.ndarray, watermark: Optional[datetime]) -> Optional[int]:
+        """
+        Replaces the snapshot of that generation (0: there is none yet) with a single base segment of these rows,
+        i.e. an initial export or a compaction.  Returns the new generation, or None if another writer got there
+        first.
+        """
+        started_at = time.perf_counter()
+        with EmbeddingSnapshots._locked(owner):
+            manifest = EmbeddingSnapshots._read_manifest(owner)
+            if (manifest["generation"] if manifest is not None else 0) != generation:
+                return None
+            name = EmbeddingSnapshots._write_segment(owner, isbns, group_starts, contents, matrix)
+            watermark_text = EmbeddingSnapshots._later(manifest["watermark"] if manifest is not None else None, watermark)
+            replacement = {
+                "owner": owner,
+                "model_name": EmbeddingsGenerator.MODEL_FILE,
+                "base": name,
+                "deltas": [],
+                "watermark": watermark_text,
+                "generation": generation,
+            }
+            EmbeddingSnapshots._write_manifest(owner, replacement)
+            if manifest is not None:
+                for old in [manifest["base"]] + manifest["deltas"]:
+                    EmbeddingSnapshots._remove_segment(owner, old)
+        if manifest is not None:
+            EmbeddingSnapshots._compactions += 1
+        EmbeddingSnapshots._write_seconds += time.perf_counter() - started_at
+        return replacement["generation"]
+
+    @staticmethod
+    def to_dict():
+        return {
+            "DIR": EmbeddingSnapshots.DIR,
+            "MAX_DELTAS": EmbeddingSnapshots.MAX_DELTAS,
+            "COMPACT_RATIO": EmbeddingSnapshots.COMPACT_RATIO,
+            "loads": EmbeddingSnapshots._loads,
+            "load_ms_mean": EmbeddingSnapshots._load_seconds / EmbeddingSnapshots._loads * 1000.0 if EmbeddingSnapshots._loads else None,
+            "load_failures": EmbeddingSnapshots._load_failures,
+            "deltas_written": EmbeddingSnapshots._deltas_written,
+            "compactions": EmbeddingSnapshots._compactions,
+            "write_seconds": EmbeddingSnapshots._write_seconds,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _owner_dir(owner: str) -> str:
+        model = re.sub(r"[^A-Za-z0-9._-]", "_", EmbeddingsGenerator.MODEL_FILE or "unknown")
+        return os.path.join(EmbeddingSnapshots.DIR, model, hashlib.sha256(owner.encode("utf-8")).hexdigest()[:32])
+
+    @staticmethod
+    def _read_manifest(owner: str) -> Optional[dict]:
+        path = os.path.join(EmbeddingSnapshots._owner_dir(owner), "manifest.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_manifest(owner: str, manifest: dict):
+        manifest["generation"] += 1
+        EmbeddingSnapshots._write_atomically(
+            os.path.join(EmbeddingSnapshots._owner_dir(owner), "manifest.json"),
+            json.dumps(manifest).encode("utf-8"),
+        )
+
+    @staticmethod
+    def _read_segment(directory: str, name: str) -> Segment:
+        with open(os.path.join(directory, f"{name}.json"), "r", encoding="utf-8") as f:
+            sidecar = json.load(f)
+        return EmbeddingSnapshots.Segment(
+            name=name,
+            isbns=sidecar["isbns"],
+            group_starts=np.asarray(sidecar["group_starts"], dtype=np.int64),
+            contents=sidecar["contents"],
+            matrix=np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"),
+        )
+
+    @staticmethod
+    def _write_segment(owner: str, isbns: list[str], group_starts: np.ndarray, contents: list[str], matrix: np.ndarray) -> str:
+        directory = EmbeddingSnapshots._owner_dir(owner)
+        name = uuid.uuid4().hex
+        tmp_path = os.path.join(directory, f"{name}.npy.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+        os.replace(tmp_path, os.path.join(directory, f"{name}.npy"))
+        sidecar = {"isbns": isbns, "group_starts": np.asarray(group_starts).tolist(), "contents": contents}
+        EmbeddingSnapshots._write_atomically(os.path.join(directory, f"{name}.json"), json.dumps(sidecar).encode("utf-8"))
+        return name
+
+    @staticmethod
+    def _remove_segment(owner: str, name: str):
+        for extension in (".npy", ".json"):
+            try:
+                os.remove(os.path.join(EmbeddingSnapshots._owner_dir(owner), name + extension))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _write_atomically(path: str, data: bytes):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    @contextmanager
+    def _locked(owner: str) -> Iterator[None]:
+        directory = EmbeddingSnapshots._owner_dir(owner)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _later(watermark_text: Optional[str], watermark: Optional[datetime]) -> Optional[str]:
+        if watermark is None:
+            return watermark_text
+        if watermark_text is None or watermark > datetime.fromisoformat(watermark_text):
+            return watermark.isoformat()
+        return watermark_text
+
+def main():
+    from app.books.helpers.bigquery_client_helper import get_bigquery_client
+    from app.books.helpers.vector_index import VectorIndex
+    from google.cloud import bigquery
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--owner", nargs="*", help="Owners to export.  Default: every owner in the source table")
+    parser.add_argument("--compact", action="store_true", help="Rewrite each snapshot as a single base segment")
+    args = parser.parse_args()
+    if not EmbeddingSnapshots.enabled():
+        parser.error("Set STORYSPARK_EMBEDDING_SNAPSHOT_DIR")
+
+    bigquery_client_helper = get_bigquery_client()
+    owners = args.owner
+    if not owners:
+        source_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.source_table_id}"
+        query_job = bigquery_client_helper.client.query(f"SELECT DISTINCT owner FROM `{source_table_id}`", job_config=bigquery.QueryJobConfig())
+        owners = [row["owner"] for row in query_job.result()]
+
+    for owner in owners:
+        index = VectorIndex._read_index(bigquery_client_helper, owner, compact=args.compact)
+        print(f"{owner}: {len(index.isbns)} ISBNs, {len(index)} rows")
+    print(EmbeddingSnapshots.to_dict())
+
+if __name__ == "__main__":
+    main()
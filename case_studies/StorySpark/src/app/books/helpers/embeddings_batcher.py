@@ -0,0 +1,205 @@
+import os
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field, replace
+from typing import Final, Optional
+import numpy as np
+from tokenizers import Encoding
+
+from app.books.helpers.embeddings_cache import EmbeddingsCache
+from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+
+class EmbeddingsBatcher:
+    """
+    Async micro-batcher in front of the ONNX session.
+
+    Concurrent requests each submit a single text.  The first text to arrive opens a batching window; any
+    texts that arrive before the window closes (or before the padded token budget is used up) are run
+    together as one padded ONNX batch, and each caller gets back its own vector.  Texts in a batch that normalize
+    to the same cache key (repeated recommendation queries, typically) are run once and the vector is shared.
+    """
+    # How long the first text in a batch waits for company before the batch is run anyway
+    MAX_WAIT_MS: Final[float] = float(os.environ.get("STORYSPARK_EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+    # Budget on padded tokens (rows * longest row) per ONNX call
+    MAX_BATCH_TOKENS: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_BATCH_MAX_TOKENS", "8192"))
+    MAX_BATCH_SIZE: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_BATCH_MAX_SIZE", "64"))
+    # Number of recent batches kept for the percentile metrics
+    METRICS_WINDOW: Final[int] = 2048
+
+    @dataclass
+    class _PendingText:
+        text: str
+        # EmbeddingsGenerator._cache_key: equal keys embed to the same vector
+        key: str
+        encoding: Encoding
+        future: asyncio.Future
+        enqueued_at: float = field(default_factory=time.perf_counter)
+
+    _queue: Optional[asyncio.Queue] = None
+    _worker: Optional[asyncio.Task] = None
+    _carry: Optional[_PendingText] = None
+
+    # metrics
+    _batches: int = 0
+    _texts: int = 0
+    _unbatched_texts: int = 0
+    _deduplicated_texts: int = 0
+    _batch_sizes: deque = deque(maxlen=METRICS_WINDOW)
+    _batch_tokens: deque = deque(maxlen=METRICS_WINDOW)
+    _queue_waits_ms: deque = deque(maxlen=METRICS_WINDOW)
+
+    # ---------- public API ----------
+    @staticmethod
+    async def embed(text: str) -> EmbeddingsGenerator.EmbeddingsInfo:
+        """
+        Returns the embedding for a single text, batched together with any other texts submitted concurrently.
+        """
+        if EmbeddingsGenerator._sess is None or EmbeddingsGenerator._tokenizer is None:
+            await asyncio.to_thread(EmbeddingsGenerator._ensure_model_loaded, model_path=EmbeddingsGenerator.MODEL_PATH)
+
+        if text:
+            cached = EmbeddingsGenerator._lookup_cached(text, disk=False)
+            if cached is None and EmbeddingsCache.DISK_PATH is not None:
+                # The disk tier is SQLite I/O, so it is checked off the event loop
+                cached = await asyncio.to_thread(EmbeddingsGenerator._lookup_cached, text)
+            if cached is not None:
+                return cached
+
+        encoding = EmbeddingsGenerator._tokenizer.encode(text, add_special_tokens=True) if text else None
+        if encoding is None or len(encoding.ids) > EmbeddingsGenerator._model_max_length:
+            # Empty and long (chunked) texts do not fit into a single padded row; let the generator handle them directly
+            EmbeddingsBatcher._unbatched_texts += 1
+            return (await asyncio.to_thread(EmbeddingsGenerator.generate_embeddings, tags=None, relevant_text=[text]))[0]
+
+        EmbeddingsBatcher._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        pending = EmbeddingsBatcher._PendingText(text=text, key=EmbeddingsGenerator._cache_key(text), encoding=encoding, future=future)
+        await EmbeddingsBatcher._queue.put(pending)
+        return await future
+
+    @staticmethod
+    async def stop():
+        """
+        Cancels the batching worker.  Texts still waiting in the queue are failed rather than left hanging.
+        """
+        if EmbeddingsBatcher._worker is not None:
+            EmbeddingsBatcher._worker.cancel()
+            try:
+                await EmbeddingsBatcher._worker
+            except asyncio.CancelledError:
+                pass
+        pending = [EmbeddingsBatcher._carry] if EmbeddingsBatcher._carry else []
+        while EmbeddingsBatcher._queue is not None and not EmbeddingsBatcher._queue.empty():
+            pending.append(EmbeddingsBatcher._queue.get_nowait())
+        for item in pending:
+            if not item.future.done():
+                item.future.set_exception(RuntimeError("Embeddings batcher stopped"))
+        EmbeddingsBatcher._queue = None
+        EmbeddingsBatcher._worker = None
+        EmbeddingsBatcher._carry = None
+
+    @staticmethod
+    def to_dict():
+        return {
+            "MAX_WAIT_MS": EmbeddingsBatcher.MAX_WAIT_MS,
+            "MAX_BATCH_TOKENS": EmbeddingsBatcher.MAX_BATCH_TOKENS,
+            "MAX_BATCH_SIZE": EmbeddingsBatcher.MAX_BATCH_SIZE,
+            "batches": EmbeddingsBatcher._batches,
+            "texts": EmbeddingsBatcher._texts,
+            "unbatched_texts": EmbeddingsBatcher._unbatched_texts,
+            "deduplicated_texts": EmbeddingsBatcher._deduplicated_texts,
+            "queue_depth": EmbeddingsBatcher._queue.qsize() if EmbeddingsBatcher._queue is not None else 0,
+            "batch_size": EmbeddingsBatcher._summarize(EmbeddingsBatcher._batch_sizes),
+            "batch_padded_tokens": EmbeddingsBatcher._summarize(EmbeddingsBatcher._batch_tokens),
+            "queue_wait_ms": EmbeddingsBatcher._summarize(EmbeddingsBatcher._queue_waits_ms),
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _ensure_worker():
+        loop = asyncio.get_running_loop()
+        worker = EmbeddingsBatcher._worker
+        if worker is not None and not worker.done() and worker.get_loop() is loop:
+            return
+        EmbeddingsBatcher._queue = asyncio.Queue()
+        EmbeddingsBatcher._carry = None
+        EmbeddingsBatcher._worker = loop.create_task(EmbeddingsBatcher._run_worker())
+
+    @staticmethod
+    def _padded_tokens(batch: list[_PendingText]) -> int:
+        # Duplicates share a row
+        return len({item.key for item in batch}) * max(len(item.encoding.ids) for item in batch)
+
+    @staticmethod
+    async def _next_batch() -> list[_PendingText]:
+        queue = EmbeddingsBatcher._queue
+        first = EmbeddingsBatcher._carry or await queue.get()
+        EmbeddingsBatcher._carry = None
+
+        batch = [first]
+        deadline = first.enqueued_at + EmbeddingsBatcher.MAX_WAIT_MS / 1000.0
+        while len(batch) < EmbeddingsBatcher.MAX_BATCH_SIZE:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0 and queue.empty():
+                break
+            try:
+                item = queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(queue.get(), timeout)
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            if EmbeddingsBatcher._padded_tokens(batch + [item]) > EmbeddingsBatcher.MAX_BATCH_TOKENS:
+                # Does not fit; it opens the next batch instead
+                EmbeddingsBatcher._carry = item
+                break
+            batch.append(item)
+        return batch
+
+    @staticmethod
+    async def _run_worker():
+        while True:
+            batch = await EmbeddingsBatcher._next_batch()
+
+            started_at = time.perf_counter()
+            EmbeddingsBatcher._batches += 1
+            EmbeddingsBatcher._texts += len(batch)
+            EmbeddingsBatcher._batch_sizes.append(len(batch))
+            EmbeddingsBatcher._batch_tokens.append(EmbeddingsBatcher._padded_tokens(batch))
+            EmbeddingsBatcher._queue_waits_ms.extend((started_at - item.enqueued_at) * 1000.0 for item in batch)
+
+            # One row per distinct text; every caller of that text gets its vector
+            rows: dict[str, list[EmbeddingsBatcher._PendingText]] = {}
+            for item in batch:
+                rows.setdefault(item.key, []).append(item)
+            EmbeddingsBatcher._deduplicated_texts += len(batch) - len(rows)
+            firsts = [items[0] for items in rows.values()]
+
+            try:
+                # ONNX releases the GIL, so running it in a thread keeps the event loop (and the queue) moving
+                infos = await asyncio.to_thread(
+                    EmbeddingsGenerator._embed_encodings,
+                    [item.text for item in firsts],
+                    [item.encoding for item in firsts],
+                )
+            except Exception as e:
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+
+            for items, info in zip(rows.values(), infos):
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_result(info if item is items[0] else replace(info, text=item.text))
+
+    @staticmethod
+    def _summarize(values: deque) -> dict:
+        if not values:
+            return {"count": 0}
+        arr = np.fromiter(values, dtype=np.float64)
+        return {
+            "count": int(arr.size),
+            "mean": float(arr.mean()),
+            "p50": float(np.percentile(arr, 50)),
+            "p99": float(np.percentile(arr, 99)),
+            "max": float(arr.max()),
+        }
@@ -0,0 +1,265 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Final, Optional
+import numpy as np
+
+from app.books.helpers import embedding_codec
+
+class EmbeddingsCache:
+    """
+    Content-addressed cache of (raw, normalized) embedding vectors.
+
+    Entries are keyed by the model file plus a hash of the normalized text, so switching models never serves
+    stale vectors.  There is a bounded in-memory LRU tier and an optional SQLite tier on disk that survives
+    restarts and can be shared by several processes on the same host (the embedding worker pool does).  Disk
+    lookups are blocking I/O: async callers check the memory tier with get(key, disk=False) and go to disk on a
+    thread.  A disk tier that errors (locked by another process, say) counts as a miss, never as a failure.
+    """
+    # Size budget for the in-memory tier, in bytes of vector data
+    MAX_BYTES: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    # SQLite file for the on-disk tier.  Unset disables it.
+    DISK_PATH: Final[Optional[str]] = os.environ.get("STORYSPARK_EMBEDDING_CACHE_DISK_PATH") or None
+    DISK_MAX_BYTES: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+    # Disk hits are written back (for LRU order) in batches of this many
+    DISK_ACCESS_FLUSH: Final[int] = 256
+    # The file's real size (all processes) is summed after this many bytes were written by this one
+    DISK_SIZE_CHECK_BYTES: Final[int] = max(1, DISK_MAX_BYTES // 100)
+
+    _memory: "OrderedDict[str, tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+    _memory_bytes: int = 0
+    # Guards the memory tier only, so the event loop never waits on disk I/O
+    _lock: threading.Lock = threading.Lock()
+    # Serializes use of the SQLite connection
+    _disk_lock: threading.Lock = threading.Lock()
+    _disk: Optional[sqlite3.Connection] = None
+    # Keys hit on disk since the last flush, with when
+    _disk_accesses: dict[str, float] = {}
+    _disk_written_since_check: int = 0
+    # Size of the disk tier as last summed from the file
+    _disk_bytes: int = 0
+
+    # metrics
+    _memory_hits: int = 0
+    _disk_hits: int = 0
+    _misses: int = 0
+    _evictions: int = 0
+    _disk_evictions: int = 0
+    _disk_errors: int = 0
+
+    # ---------- public API ----------
+    @staticmethod
+    def key(model_file: str, normalized_text: str) -> str:
+        return hashlib.sha256(f"{model_file}\0{normalized_text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get(key: str, disk: bool = True) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """
+        The cached entry for key, or None.  With disk False only the memory tier is checked, and a miss there is
+        not counted when there is a disk tier left to check.
+        """
+        with EmbeddingsCache._lock:
+            entry = EmbeddingsCache._memory.get(key)
+            if entry is not None:
+                EmbeddingsCache._memory.move_to_end(key)
+                EmbeddingsCache._memory_hits += 1
+                return entry
+        if not disk and EmbeddingsCache.DISK_PATH is not None:
+            return None
+
+        entry = EmbeddingsCache._disk_get(key) if disk else None
+        with EmbeddingsCache._lock:
+            if entry is not None:
+                EmbeddingsCache._disk_hits += 1
+                EmbeddingsCache._memory_put(key, entry)
+                return entry
+            EmbeddingsCache._misses += 1
+            return None
+
+    @staticmethod
+    def put(key: str, embedding_raw: np.ndarray, embedding_normalized: np.ndarray):
+        # Copy so a cached row never keeps the whole batch array it was sliced from alive
+        entry = (
+            np.array(embedding_raw, dtype=np.float32),
+            np.array(embedding_normalized, dtype=np.float32),
+        )
+        # Cached arrays are shared between callers, so nobody gets to modify them in place
+        for arr in entry:
+            arr.setflags(write=False)
+        with EmbeddingsCache._lock:
+            EmbeddingsCache._memory_put(key, entry)
+        EmbeddingsCache._disk_put(key, entry)
+
+    @staticmethod
+    def clear():
+        """
+        Empties both tiers.  The disk tier is shared, so this clears it for every process using the file.
+        """
+        with EmbeddingsCache._lock:
+            EmbeddingsCache._memory.clear()
+            EmbeddingsCache._memory_bytes = 0
+        with EmbeddingsCache._disk_lock:
+            EmbeddingsCache._disk_accesses.clear()
+            try:
+                conn = EmbeddingsCache._disk_connection()
+                if conn is not None:
+                    conn.execute("DELETE FROM embeddings")
+                    EmbeddingsCache._disk_bytes = 0
+                    EmbeddingsCache._disk_written_since_check = 0
+            except sqlite3.Error as e:
+                EmbeddingsCache._disk_error("clear", e)
+
+    @staticmethod
+    def to_dict():
+        lookups = EmbeddingsCache._memory_hits + EmbeddingsCache._disk_hits + EmbeddingsCache._misses
+        return {
+            "MAX_BYTES": EmbeddingsCache.MAX_BYTES,
+            "DISK_PATH": EmbeddingsCache.DISK_PATH,
+            "DISK_MAX_BYTES": EmbeddingsCache.DISK_MAX_BYTES,
+            "entries": len(EmbeddingsCache._memory),
+            "bytes": EmbeddingsCache._memory_bytes,
+            "disk_bytes": EmbeddingsCache._disk_bytes,
+            "memory_hits": EmbeddingsCache._memory_hits,
+            "disk_hits": EmbeddingsCache._disk_hits,
+            "misses": EmbeddingsCache._misses,
+            "hit_ratio": (EmbeddingsCache._memory_hits + EmbeddingsCache._disk_hits) / lookups if lookups else None,
+            "evictions": EmbeddingsCache._evictions,
+            "disk_evictions": EmbeddingsCache._disk_evictions,
+            "disk_errors": EmbeddingsCache._disk_errors,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _memory_put(key: str, entry: tuple[np.ndarray, np.ndarray]):
+        # Caller holds _lock
+        nbytes = entry[0].nbytes + entry[1].nbytes
+        if nbytes > EmbeddingsCache.MAX_BYTES:
+            return
+        previous = EmbeddingsCache._memory.pop(key, None)
+        if previous is not None:
+            EmbeddingsCache._memory_bytes -= previous[0].nbytes + previous[1].nbytes
+        EmbeddingsCache._memory[key] = entry
+        EmbeddingsCache._memory_bytes += nbytes
+
+        while EmbeddingsCache._memory_bytes > EmbeddingsCache.MAX_BYTES:
+            _, evicted = EmbeddingsCache._memory.popitem(last=False)
+            EmbeddingsCache._memory_bytes -= evicted[0].nbytes + evicted[1].nbytes
+            EmbeddingsCache._evictions += 1
+
+    @staticmethod
+    def _disk_connection() -> Optional[sqlite3.Connection]:
+        # Caller holds _disk_lock
+        if EmbeddingsCache.DISK_PATH is None:
+            return None
+        if EmbeddingsCache._disk is None:
+            os.makedirs(os.path.dirname(os.path.abspath(EmbeddingsCache.DISK_PATH)), exist_ok=True)
+            conn = sqlite3.connect(EmbeddingsCache.DISK_PATH, check_same_thread=False, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS embeddings (
+                        key TEXT PRIMARY KEY,
+                        embedding_raw BLOB NOT NULL,
+                        embedding_normalized BLOB NOT NULL,
+                        nbytes INTEGER NOT NULL,
+                        last_access REAL NOT NULL
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+                EmbeddingsCache._disk_bytes = EmbeddingsCache._disk_size(conn)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            EmbeddingsCache._disk = conn
+        return EmbeddingsCache._disk
+
+    @staticmethod
+    def _disk_get(key: str) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        with EmbeddingsCache._disk_lock:
+            try:
+                conn = EmbeddingsCache._disk_connection()
+                if conn is None:
+                    return None
+                row = conn.execute(
+                    "SELECT embedding_raw, embedding_normalized FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                EmbeddingsCache._disk_accesses[key] = time.time()
+                if len(EmbeddingsCache._disk_accesses) >= EmbeddingsCache.DISK_ACCESS_FLUSH:
+                    EmbeddingsCache._flush_accesses(conn)
+            except sqlite3.Error as e:
+                EmbeddingsCache._disk_error("lookup", e)
+                return None
+        # frombuffer views over immutable bytes are already read-only
+        return embedding_codec.from_bytes(row[0]), embedding_codec.from_bytes(row[1])
+
+    @staticmethod
+    def _disk_put(key: str, entry: tuple[np.ndarray, np.ndarray]):
+        if EmbeddingsCache.DISK_PATH is None:
+            return
+        raw, normalized = (embedding_codec.to_bytes(arr) for arr in entry)
+        nbytes = len(raw) + len(normalized)
+        with EmbeddingsCache._disk_lock:
+            try:
+                conn = EmbeddingsCache._disk_connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding_raw, embedding_normalized, nbytes, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, raw, normalized, nbytes, time.time())
+                )
+                EmbeddingsCache._disk_accesses.pop(key, None)
+                EmbeddingsCache._disk_written_since_check += nbytes
+                if EmbeddingsCache._disk_written_since_check >= EmbeddingsCache.DISK_SIZE_CHECK_BYTES:
+                    EmbeddingsCache._disk_trim(conn)
+            except sqlite3.Error as e:
+                EmbeddingsCache._disk_error("write", e)
+
+    @staticmethod
+    def _disk_trim(conn: sqlite3.Connection):
+        # Caller holds _disk_lock.  Other processes write to the same file, so go by its real size.
+        EmbeddingsCache._disk_written_since_check = 0
+        EmbeddingsCache._disk_bytes = EmbeddingsCache._disk_size(conn)
+        if EmbeddingsCache._disk_bytes <= EmbeddingsCache.DISK_MAX_BYTES:
+            return
+
+        # Recent hits decide what is least recently used
+        EmbeddingsCache._flush_accesses(conn)
+        # Trim the least recently used rows down to 90% of the budget so we are not evicting on every insert
+        target = int(EmbeddingsCache.DISK_MAX_BYTES * 0.9)
+        while EmbeddingsCache._disk_bytes > target:
+            oldest = conn.execute(
+                "SELECT key, nbytes FROM embeddings ORDER BY last_access ASC LIMIT 256"
+            ).fetchall()
+            if not oldest:
+                break
+            evicted = []
+            for evict_key, evict_bytes in oldest:
+                if EmbeddingsCache._disk_bytes <= target:
+                    break
+                evicted.append((evict_key,))
+                EmbeddingsCache._disk_bytes -= evict_bytes
+            conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            EmbeddingsCache._disk_evictions += len(evicted)
+
+    @staticmethod
+    def _flush_accesses(conn: sqlite3.Connection):
+        # Caller holds _disk_lock
+        accesses = EmbeddingsCache._disk_accesses
+        EmbeddingsCache._disk_accesses = {}
+        if accesses:
+            conn.executemany(
+                "UPDATE embeddings SET last_access = MAX(last_access, ?) WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in accesses.items()]
+            )
+
+    @staticmethod
+    def _disk_size(conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def _disk_error(operation: str, e: sqlite3.Error):
+        EmbeddingsCache._disk_errors += 1
+        print(f"Embeddings disk cache {operation} failed: {e}")
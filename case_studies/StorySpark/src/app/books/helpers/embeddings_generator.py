@@ -2,6 +2,8 @@ from importlib.resources import files
 import os
 import math
 import gc
+import threading
+import time
 from typing import Final, Optional, List
 import numpy as np
 import onnxruntime as ort
@@ -9,9 +11,29 @@ import onnxruntime as ort
 from tokenizers import Tokenizer, Encoding 
 from dataclasses import dataclass
 
+from app.books.helpers.embeddings_cache import EmbeddingsCache
+from app.books.helpers.onnx_session_factory import OnnxSessionFactory
+
+MODEL_VARIANTS: Final[tuple[str, ...]] = ("fp32", "int8")
+
+def variant_model_file(model_file: Optional[str], variant: str) -> Optional[str]:
+    """
+    all-MiniLM-L6-v2.onnx -> all-MiniLM-L6-v2.int8.onnx.  fp32 is the file as exported.  Must match model_export/main.py.
+    """
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant '{variant}'.  Expected one of {MODEL_VARIANTS}")
+    if model_file is None or variant == "fp32":
+        return model_file
+    stem, ext = os.path.splitext(model_file)
+    return f"{stem}.{variant}{ext}"
+
 class EmbeddingsGenerator:
     # keep the user's requested constants; resolve MODEL_PATH at runtime
-    MODEL_FILE: Final[str] = os.environ.get("STORYSPARK_MODEL_FILE")
+    BASE_MODEL_FILE: Final[str] = os.environ.get("STORYSPARK_MODEL_FILE")
+    # Which exported variant to serve.  int8 (dynamically quantized) is roughly half the latency and memory of fp32 on CPU.
+    MODEL_VARIANT: Final[str] = os.environ.get("STORYSPARK_MODEL_VARIANT", "fp32").strip().lower()
+    # The variant's file name is also what gets recorded as model_name next to every embedding
+    MODEL_FILE: Final[str] = variant_model_file(BASE_MODEL_FILE, MODEL_VARIANT)
     MODEL_EXPORT_BUCKET_NAME: Final[str] = os.environ.get("STORYSPARK_MODEL_EXPORT_BUCKET_NAME")
     MODEL_PATH: Final[str] = f"{os.environ.get('STORYSPARK_MODEL_EXPORT_BUCKET_NAME')}/{os.environ.get('STORYSPARK_IMAGE_MODEL_DIR')}/{MODEL_FILE}"
     
@@ -28,9 +50,12 @@ class EmbeddingsGenerator:
         # })
 
         return {
+            "BASE_MODEL_FILE": EmbeddingsGenerator.BASE_MODEL_FILE,
+            "MODEL_VARIANT": EmbeddingsGenerator.MODEL_VARIANT,
             "MODEL_FILE": EmbeddingsGenerator.MODEL_FILE,
             "MODEL_PATH": EmbeddingsGenerator.MODEL_PATH,
             "MODEL_EXPORT_BUCKET_NAME": EmbeddingsGenerator.MODEL_EXPORT_BUCKET_NAME,
+            "onnx_session": OnnxSessionFactory.to_dict(),
             # "MODEL_DIR": EmbeddingsGenerator.MODEL_DIR,
             # "TOKENIZER_JSON_PATH": EmbeddingsGenerator.TOKENIZER_JSON_PATH,
             # "MODEL_DIRECTORY_FILES": files
@@ -41,12 +66,19 @@ class EmbeddingsGenerator:
     _sess: Optional[ort.InferenceSession] = None
     _output_name: Optional[str] = None
     _model_max_length: int = 512 # Default value
+    _load_lock: threading.Lock = threading.Lock()
+
+    # Limits for each length bucket in generate_embeddings: rows per ONNX call, and padded tokens (rows * longest row) per ONNX call
+    BUCKET_MAX_SIZE: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_BUCKET_MAX_SIZE", "128"))
+    BUCKET_MAX_TOKENS: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_BUCKET_MAX_TOKENS", "16384"))
 
     @dataclass
     class EmbeddingsInfo:
+        # float32 (D,) arrays.  Treat them as read-only: they may be views into a batch or entries shared through
+        # EmbeddingsCache.  Convert with embedding_codec only at the storage/API boundary.
         text: str
-        embedding_raw: list[float]
-        embedding_normalized: list[float]
+        embedding_raw: np.ndarray
+        embedding_normalized: np.ndarray
 
     # ---------- public API ----------
     @staticmethod
@@ -65,150 +97,147 @@ class EmbeddingsGenerator:
             { tag.lower().strip() for tag in tags.split(';') if tag.strip() }
         ) if tags is not None else []
 
-        vectors: list[EmbeddingsGenerator.EmbeddingsInfo] = []
-
-        # ---------- 2) embed tags (batch them together, preserve mapping) ----------
-        if parsed_tags:
-            max_tag_batch = 128
-            for start in range(0, len(parsed_tags), max_tag_batch):
-                batch_tags = parsed_tags[start : start + max_tag_batch]
-                
-                # NEW: Use encode_batch for tokenizers library
-                toks_encodings: List[Encoding] = EmbeddingsGenerator._tokenizer.encode_batch(
-                    batch_tags, 
-                    is_pretokenized=False # input is raw text
-                )
-                
-                # Convert encodings to numpy arrays for ONNX
-                input_ids = np.array([e.ids for e in toks_encodings], dtype=np.int64)
-                attention_mask = np.array([e.attention_mask for e in toks_encodings], dtype=np.int64)
-
-                embedding_raw = EmbeddingsGenerator._run_onnx_batch(input_ids, attention_mask)  # (B, D)
-                embedding_normalized = EmbeddingsGenerator._l2_normalize(embedding_raw)  # (B, D)
-                
-                for i in range(embedding_raw.shape[0]):
-                    vectors.append(
-                        EmbeddingsGenerator.EmbeddingsInfo(
-                            text=batch_tags[i],
-                            embedding_raw=embedding_raw[i].tolist(),
-                            embedding_normalized=embedding_normalized[i].tolist()
-                        )
-                    )
-
-        # ---------- 3) embed each freeform_text (chunk + aggregate) ----------
-        default_chunk_size = min(256, EmbeddingsGenerator._model_max_length)
-        default_stride = min(64, default_chunk_size // 2)
+        texts: list[str] = parsed_tags + list(relevant_text)
+        vectors: list[Optional[EmbeddingsGenerator.EmbeddingsInfo]] = [None] * len(texts)
 
-        for text in relevant_text:
+        dim = EmbeddingsGenerator._sess.get_outputs()[0].shape[-1]
+        for i, text in enumerate(texts):
+            if not text:
+                vectors[i] = EmbeddingsGenerator._zero_embeddings_info(text, dim)
+
+        # ---------- 2) serve repeated strings from the embeddings cache ----------
+        pending: dict[str, list[int]] = {}
+        for i, text in enumerate(texts):
             if not text:
-                dim = EmbeddingsGenerator._sess.get_outputs()[0].shape[-1]
-                vectors.append(EmbeddingsGenerator.EmbeddingsInfo(
-                    text=text,
-                    embedding_raw=np.zeros((dim,), dtype=np.float32).tolist(),
-                    embedding_normalized=np.zeros((dim,), dtype=np.float32).tolist()
-                ))
                 continue
-            
-            # Use Tokenizer.encode for length check
-            token_ids = EmbeddingsGenerator._tokenizer.encode(text).ids
-            token_len = len(token_ids)
-            
-            if token_len <= EmbeddingsGenerator._model_max_length:
-                # NEW: Single text encoding
-                tok_encoding = EmbeddingsGenerator._tokenizer.encode(text, add_special_tokens=True)
-                
-                # Convert single encoding to numpy arrays for ONNX (batch size 1)
-                input_ids = np.array([tok_encoding.ids], dtype=np.int64)
-                attention_mask = np.array([tok_encoding.attention_mask], dtype=np.int64)
-
-                embedding_raw = EmbeddingsGenerator._run_onnx_batch(input_ids, attention_mask)[0]  # (B, D)
-                embedding_normalized = EmbeddingsGenerator._l2_normalize(embedding_raw)  # (B, D)
-                
-                vectors.append(
-                    EmbeddingsGenerator.EmbeddingsInfo(
-                        text=text,
-                        embedding_raw=embedding_raw.tolist(),
-                        embedding_normalized=embedding_normalized.tolist()
-                    )
-                )
+            cached = EmbeddingsGenerator._lookup_cached(text)
+            if cached is not None:
+                vectors[i] = cached
             else:
-                chunks = EmbeddingsGenerator._chunk_text_to_strings(
-                    text, chunk_size=default_chunk_size, stride=default_stride
-                )
-                chunk_embs_list: list[np.ndarray] = []
-                chunk_batch_size = 8
-
-                for i in range(0, len(chunks), chunk_batch_size):
-                    batch = chunks[i : i + chunk_batch_size]
-
-                    # Batch encode the text chunks
-                    toks_encodings: List[Encoding] = EmbeddingsGenerator._tokenizer.encode_batch(batch)
-
-                    # Convert encodings to numpy arrays for ONNX
-                    input_ids = np.array([e.ids for e in toks_encodings], dtype=np.int64)
-                    attention_mask = np.array([e.attention_mask for e in toks_encodings], dtype=np.int64)
-
-                    emb_batch = EmbeddingsGenerator._run_onnx_batch(input_ids, attention_mask)  # (b, D)
-                    chunk_embs_list.append(emb_batch)
-
-                if chunk_embs_list:
-                    chunk_embs = np.vstack(chunk_embs_list)           # (total_chunks, D)
-                    doc_emb_raw = np.mean(chunk_embs, axis=0)         # (D,) raw averaged embedding
-                    doc_emb_norm = EmbeddingsGenerator._l2_normalize(doc_emb_raw)  # (D,) normalized
-
-                    vectors.append(
-                        EmbeddingsGenerator.EmbeddingsInfo(
-                            text=text,
-                            embedding_raw=doc_emb_raw.tolist(),
-                            embedding_normalized=doc_emb_norm.tolist(),
-                        )
-                    )
-                else:
-                    dim = EmbeddingsGenerator._sess.get_outputs()[0].shape[-1]
-                    zero_vec = np.zeros((dim,), dtype=np.float32).tolist()
-                    vectors.append(
-                        EmbeddingsGenerator.EmbeddingsInfo(
-                            text=text,
-                            embedding_raw=zero_vec,
-                            embedding_normalized=zero_vec,
-                        )
-                    )
+                # Duplicates within this call are only embedded once
+                pending.setdefault(text, []).append(i)
+
+        # ---------- 3) tokenize every remaining input exactly once ----------
+        unique_texts = list(pending)
+        encodings: List[Encoding] = EmbeddingsGenerator._tokenizer.encode_batch(
+            unique_texts,
+            add_special_tokens=True
+        ) if unique_texts else []
+
+        # ---------- 4) embed everything that fits in the model in length-bucketed, padded batches ----------
+        short = [(text, e) for text, e in zip(unique_texts, encodings) if len(e.ids) <= EmbeddingsGenerator._model_max_length]
+        if short:
+            infos = EmbeddingsGenerator._embed_bucketed(
+                [text for text, _ in short],
+                [e for _, e in short]
+            )
+            for (text, _), info in zip(short, infos):
+                for i in pending[text]:
+                    vectors[i] = info
+
+        # ---------- 5) embed each long freeform text (chunk + aggregate) ----------
+        default_chunk_size = min(256, EmbeddingsGenerator._model_max_length)
+        default_stride = min(64, default_chunk_size // 2)
 
+        long_texts = [(text, e) for text, e in zip(unique_texts, encodings) if len(e.ids) > EmbeddingsGenerator._model_max_length]
+        if long_texts:
+            # Windows are cut straight from the encodings we already have; no decode and no second tokenizer pass
+            windows = [
+                EmbeddingsGenerator._chunk_encoding(e, chunk_size=default_chunk_size, stride=default_stride)
+                for _, e in long_texts
+            ]
+            window_embs = EmbeddingsGenerator._run_windows(
+                np.concatenate([ids for ids, _ in windows]),
+                np.concatenate([mask for _, mask in windows])
+            )  # (total_windows, D), windows of all long texts together
+
+            offset = 0
+            for (text, _), (ids, _) in zip(long_texts, windows):
+                chunk_embs = window_embs[offset : offset + ids.shape[0]]
+                offset += ids.shape[0]
+
+                doc_emb_raw = np.mean(chunk_embs, axis=0)         # (D,) raw averaged embedding
+                doc_emb_norm = EmbeddingsGenerator._l2_normalize(doc_emb_raw)  # (D,) normalized
+
+                EmbeddingsCache.put(EmbeddingsGenerator._cache_key(text), doc_emb_raw, doc_emb_norm)
+                info = EmbeddingsGenerator.EmbeddingsInfo(
+                    text=text,
+                    embedding_raw=doc_emb_raw,
+                    embedding_normalized=doc_emb_norm,
+                )
+                for i in pending[text]:
+                    vectors[i] = info
 
         # free memory if needed
         gc.collect()
         return vectors
 
+    @staticmethod
+    def warm_up(sequence_lengths: tuple[int, ...] = (8, 32, 128, 512), batch_sizes: tuple[int, ...] = (1, 8)) -> dict:
+        """
+        Load the tokenizer and ONNX session and run a few throwaway batches across sequence lengths so that the first
+        real request does not pay for model loading, arena growth and first-run kernel setup.
+        Returns timings (ms) for logging.  Nothing is written to the embeddings cache.
+        """
+        timings: dict = {}
+        start = time.perf_counter()
+        EmbeddingsGenerator._ensure_model_loaded(model_path=EmbeddingsGenerator.MODEL_PATH)
+        timings["load_ms"] = (time.perf_counter() - start) * 1000.0
+
+        # Real token ids (rather than zeros) so the embedding lookup touches the same memory a real request would
+        encoding = EmbeddingsGenerator._tokenizer.encode("warm up the story spark embeddings model " * 64)
+        for seq_len in sequence_lengths:
+            seq_len = min(seq_len, EmbeddingsGenerator._model_max_length, len(encoding.ids))
+            for batch_size in batch_sizes:
+                input_ids = np.tile(np.asarray(encoding.ids[:seq_len], dtype=np.int64), (batch_size, 1))
+                attention_mask = np.ones_like(input_ids)
+                start = time.perf_counter()
+                EmbeddingsGenerator._run_onnx_batch(input_ids, attention_mask)
+                timings[f"seq_{seq_len}_batch_{batch_size}_ms"] = (time.perf_counter() - start) * 1000.0
+
+        return timings
+
     # ---------- helpers ----------
     @staticmethod
-    def _ensure_model_loaded(model_path: str, tokenizer_name: Optional[str] = None, provider: Optional[str] = None):
+    def _ensure_model_loaded(model_path: str, tokenizer_name: Optional[str] = None, provider: Optional[str] = None, intra_op_threads: Optional[int] = None):
         """
         Lazily load tokenizer (from local JSON) and ONNX session.
+        intra_op_threads overrides the configured ONNX Runtime thread count (worker processes use 1).
         """
         if EmbeddingsGenerator._sess is not None and EmbeddingsGenerator._tokenizer is not None:
             return
 
-        model_dir = os.path.dirname(model_path)
-        tokenizer_json_path = os.path.join(model_dir, "tokenizer.json")
+        # The warm-up thread and early requests can race to load; only one of them should do it
+        with EmbeddingsGenerator._load_lock:
+            if EmbeddingsGenerator._sess is not None and EmbeddingsGenerator._tokenizer is not None:
+                return
+
+            model_dir = os.path.dirname(model_path)
+            tokenizer_json_path = os.path.join(model_dir, "tokenizer.json")
 
-        # NEW: Load tokenizer using the pre-exported local tokenizer JSON file
-        try:
-            EmbeddingsGenerator._tokenizer = Tokenizer.from_file(tokenizer_json_path)
-        except Exception as e:
-            raise RuntimeError(f"Error loading tokenizer from {tokenizer_json_path}. Ensure it contains a 'tokenizer.json' exported file.") from e
+            # NEW: Load tokenizer using the pre-exported local tokenizer JSON file
+            try:
+                EmbeddingsGenerator._tokenizer = Tokenizer.from_file(tokenizer_json_path)
+            except Exception as e:
+                raise RuntimeError(f"Error loading tokenizer from {tokenizer_json_path}. Ensure it contains a 'tokenizer.json' exported file.") from e
 
-        # load ONNX session
-        providers = [provider] if provider else ["CPUExecutionProvider"]
-        EmbeddingsGenerator._sess = ort.InferenceSession(model_path, providers=providers)
-        EmbeddingsGenerator._output_name = EmbeddingsGenerator._sess.get_outputs()[0].name
+            # load ONNX session
+            if not os.path.exists(model_path):
+                raise RuntimeError(f"Model file {model_path} does not exist.  Check that the '{EmbeddingsGenerator.MODEL_VARIANT}' variant was exported and uploaded with the models.")
+            providers = [provider] if provider else ["CPUExecutionProvider"]
+            sess = OnnxSessionFactory.create(model_path, providers=providers, intra_op_threads=intra_op_threads)
+            EmbeddingsGenerator._output_name = sess.get_outputs()[0].name
         
-        # Determine model max length from ONNX inputs
-        input_names = EmbeddingsGenerator._sess.get_inputs()
-        # The second input is typically the attention mask, which has the sequence length
-        max_len = input_names[1].shape[-1] 
+            # Determine model max length from ONNX inputs
+            input_names = sess.get_inputs()
+            # The second input is typically the attention mask, which has the sequence length
+            max_len = input_names[1].shape[-1] 
         
-        # Set max length, defaulting to 512 if it's dynamic/unknown
-        EmbeddingsGenerator._model_max_length = max_len if isinstance(max_len, int) and max_len > 0 else 512
+            # Set max length, defaulting to 512 if it's dynamic/unknown
+            EmbeddingsGenerator._model_max_length = max_len if isinstance(max_len, int) and max_len > 0 else 512
+
+            # Published last: the unlocked check above treats a non-None session as fully loaded
+            EmbeddingsGenerator._sess = sess
 
     @staticmethod
     def _run_onnx_batch(input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
@@ -216,11 +245,108 @@ class EmbeddingsGenerator:
             "input_ids": input_ids.astype(np.int64),
             "attention_mask": attention_mask.astype(np.int64),
         }
-        outputs = EmbeddingsGenerator._sess.run([EmbeddingsGenerator._output_name], ort_inputs)
+        outputs = EmbeddingsGenerator._sess.run([EmbeddingsGenerator._output_name], ort_inputs, OnnxSessionFactory.run_options())
         emb = outputs[0]
         # ensure float32 numpy array
         return np.asarray(emb, dtype=np.float32)
 
+    @staticmethod
+    def _pad_encodings(encodings: List[Encoding]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Right-pad a ragged list of encodings into (B, T) input_ids/attention_mask arrays.
+        The exported model mean-pools with the attention mask, so padded positions do not change the embedding.
+        """
+        max_len = max(len(e.ids) for e in encodings)
+        input_ids = np.zeros((len(encodings), max_len), dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), max_len), dtype=np.int64)
+        for i, e in enumerate(encodings):
+            input_ids[i, : len(e.ids)] = e.ids
+            attention_mask[i, : len(e.ids)] = e.attention_mask
+        return input_ids, attention_mask
+
+    @staticmethod
+    def _embed_encodings(texts: list[str], encodings: List[Encoding]) -> list[EmbeddingsInfo]:
+        """
+        Run already-tokenized texts (each within the model max length) through ONNX as one padded batch.
+        """
+        input_ids, attention_mask = EmbeddingsGenerator._pad_encodings(encodings)
+        embedding_raw = EmbeddingsGenerator._run_onnx_batch(input_ids, attention_mask)  # (B, D)
+        embedding_normalized = EmbeddingsGenerator._l2_normalize(embedding_raw)  # (B, D)
+
+        for i, text in enumerate(texts):
+            EmbeddingsCache.put(EmbeddingsGenerator._cache_key(text), embedding_raw[i], embedding_normalized[i])
+
+        return [
+            EmbeddingsGenerator.EmbeddingsInfo(
+                text=texts[i],
+                embedding_raw=embedding_raw[i],
+                embedding_normalized=embedding_normalized[i]
+            )
+            for i in range(embedding_raw.shape[0])
+        ]
+
+    @staticmethod
+    def _embed_bucketed(texts: list[str], encodings: List[Encoding]) -> list[EmbeddingsInfo]:
+        """
+        Embed many already-tokenized texts, returned in input order.
+        Inputs are sorted by token length and cut into buckets of similar length so that padding each
+        bucket to its longest row wastes little compute; each bucket is a single ONNX call.
+        """
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i].ids))
+        results: list[Optional[EmbeddingsGenerator.EmbeddingsInfo]] = [None] * len(encodings)
+
+        bucket: list[int] = []
+        for i in order + [None]:
+            if bucket and (
+                i is None
+                or len(bucket) >= EmbeddingsGenerator.BUCKET_MAX_SIZE
+                # sorted ascending, so the incoming row is the longest one in the bucket
+                or (len(bucket) + 1) * len(encodings[i].ids) > EmbeddingsGenerator.BUCKET_MAX_TOKENS
+            ):
+                infos = EmbeddingsGenerator._embed_encodings(
+                    [texts[j] for j in bucket],
+                    [encodings[j] for j in bucket]
+                )
+                for j, info in zip(bucket, infos):
+                    results[j] = info
+                bucket = []
+            if i is not None:
+                bucket.append(i)
+
+        return results
+
+    @staticmethod
+    def _cache_key(text: str) -> str:
+        """
+        Cache key for a text under the current model.  The text is normalized the same way the tokenizer will
+        normalize it (and whitespace runs collapsed, which the pre-tokenizer splits on anyway) so that strings
+        which embed identically share an entry.
+        """
+        normalizer = EmbeddingsGenerator._tokenizer.normalizer
+        normalized = normalizer.normalize_str(text) if normalizer is not None else text
+        return EmbeddingsCache.key(EmbeddingsGenerator.MODEL_FILE, " ".join(normalized.split()))
+
+    @staticmethod
+    def _lookup_cached(text: str, disk: bool = True) -> Optional[EmbeddingsInfo]:
+        cached = EmbeddingsCache.get(EmbeddingsGenerator._cache_key(text), disk=disk)
+        if cached is None:
+            return None
+        return EmbeddingsGenerator.EmbeddingsInfo(
+            text=text,
+            embedding_raw=cached[0],
+            embedding_normalized=cached[1]
+        )
+
+    @staticmethod
+    def _zero_embeddings_info(text: str, dim: int) -> EmbeddingsInfo:
+        zero_vec = np.zeros((dim,), dtype=np.float32)
+        zero_vec.setflags(write=False)
+        return EmbeddingsGenerator.EmbeddingsInfo(
+            text=text,
+            embedding_raw=zero_vec,
+            embedding_normalized=zero_vec,
+        )
+
     @staticmethod
     def _l2_normalize(v: np.ndarray, eps: float = 1e-12) -> np.ndarray:
         # Avoid division by zero
@@ -228,37 +354,45 @@ class EmbeddingsGenerator:
         return v / (norm + eps)
 
     @staticmethod
-    def _chunk_text_to_strings(text: str, chunk_size: int, stride: int) -> list[str]:
+    def _chunk_encoding(encoding: Encoding, chunk_size: int, stride: int) -> tuple[np.ndarray, np.ndarray]:
         """
-        Chunk a single text into token-level chunks (decoded back to text).
-        Returns list of chunk strings.
+        Chunk a single long encoding into overlapping token windows of at most chunk_size tokens.
+        The special tokens the tokenizer added around the whole text (e.g. [CLS] ... [SEP]) are added around every
+        window instead, so each window looks exactly like a normally tokenized input.
+        Returns (input_ids, attention_mask) arrays of shape (num_windows, width); the last window is right-padded.
         """
-        if not text:
-            return [""]
-        
-        # NEW: Use Tokenizer.encode and access the IDs
-        token_ids = EmbeddingsGenerator._tokenizer.encode(text).ids
-        
-        if len(token_ids) <= chunk_size:
-            return [text]
-            
-        chunks = []
-        start = 0
-        while start < len(token_ids):
-            chunk_ids = token_ids[start : start + chunk_size]
-            
-            # NEW: Use Tokenizer.decode
-            chunk_text = EmbeddingsGenerator._tokenizer.decode(
-                chunk_ids, 
-                skip_special_tokens=True, # This is the default and equivalent
-                # clean_up_tokenization_spaces is handled implicitly by the Tokenizer
-            )
-            
-            chunks.append(chunk_text)
-            
-            if start + chunk_size >= len(token_ids):
-                break
-                
-            start += chunk_size - stride
-            
-        return chunks
\ No newline at end of file
+        ids = np.asarray(encoding.ids, dtype=np.int64)
+        content_positions = np.flatnonzero(np.asarray(encoding.special_tokens_mask) == 0)
+        if content_positions.size == 0:
+            return ids[np.newaxis, :chunk_size], np.ones((1, min(len(ids), chunk_size)), dtype=np.int64)
+
+        prefix = ids[: content_positions[0]]
+        content = ids[content_positions[0] : content_positions[-1] + 1]
+        suffix = ids[content_positions[-1] + 1 :]
+
+        window = max(1, chunk_size - len(prefix) - len(suffix))
+        step = max(1, window - stride)
+        starts = [0]
+        while starts[-1] + window < len(content):
+            starts.append(starts[-1] + step)
+
+        width = len(prefix) + min(window, len(content)) + len(suffix)
+        input_ids = np.zeros((len(starts), width), dtype=np.int64)
+        attention_mask = np.zeros((len(starts), width), dtype=np.int64)
+        for row, start in enumerate(starts):
+            window_ids = np.concatenate([prefix, content[start : start + window], suffix])
+            input_ids[row, : len(window_ids)] = window_ids
+            attention_mask[row, : len(window_ids)] = 1
+
+        return input_ids, attention_mask
+
+    @staticmethod
+    def _run_windows(input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        """
+        Run equal-width token windows through ONNX in batches that respect the bucket row and padded-token budgets.
+        """
+        rows_per_batch = max(1, min(EmbeddingsGenerator.BUCKET_MAX_SIZE, EmbeddingsGenerator.BUCKET_MAX_TOKENS // input_ids.shape[1]))
+        return np.vstack([
+            EmbeddingsGenerator._run_onnx_batch(input_ids[start : start + rows_per_batch], attention_mask[start : start + rows_per_batch])
+            for start in range(0, input_ids.shape[0], rows_per_batch)
+        ])
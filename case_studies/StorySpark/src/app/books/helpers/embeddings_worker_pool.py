@@ -0,0 +1,241 @@
+import os
+import asyncio
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from typing import Callable, Final, Optional, TypeVar
+
+from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+
+T = TypeVar("T")
+
+# Cap on the default worker count, whatever the core count
+DEFAULT_MAX_WORKERS: Final[int] = 2
+# Resident memory of one worker once its model is loaded (MiniLM fp32 session, tokenizer, interpreter), and what
+# to leave for the API process with its own model, caches and vector indexes.  Compare the first against
+# worker_max_rss_mb in /metrics.
+WORKER_RSS_MB: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_WORKER_RSS_MB", "350"))
+API_RESERVE_MB: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_WORKER_API_RESERVE_MB", "640"))
+
+def _default_workers() -> int:
+    # CPUs this process may actually run on, which can be fewer than the machine has
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    workers = min(cores, DEFAULT_MAX_WORKERS)
+    memory_mb = _memory_limit_mb()
+    if memory_mb is not None:
+        # However many fit next to the API process; 0 embeds on a thread in the API process instead
+        workers = min(workers, max(0, (memory_mb - API_RESERVE_MB) // max(WORKER_RSS_MB, 1)))
+    return workers
+
+def _memory_limit_mb() -> Optional[int]:
+    """
+    The container's memory limit (cgroup v2, then v1), else the machine's physical memory, or None if unknown.
+    """
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # "max", or a huge number on v1, when there is no limit
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value) // (1024 * 1024)
+        break
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def _worker_initializer():
+    """
+    Runs once in each worker process.  Every worker holds its own tokenizer and ONNX session, pinned to one
+    intra-op thread so N workers use N cores instead of fighting over them.
+    """
+    try:
+        EmbeddingsGenerator._ensure_model_loaded(model_path=EmbeddingsGenerator.MODEL_PATH, intra_op_threads=1)
+    except Exception as e:
+        # Do not kill the worker (that breaks the whole pool); the first task will raise the same error to its caller
+        print(f"Embeddings worker {os.getpid()} failed to load the model: {e}")
+
+def _worker_ready() -> int:
+    # Peak resident memory in MB (ru_maxrss is in KB on Linux), taken after the initializer loaded the model
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+def _worker_generate_embeddings(tags: str, relevant_text: list[str]) -> list[EmbeddingsGenerator.EmbeddingsInfo]:
+    return EmbeddingsGenerator.generate_embeddings(tags=tags, relevant_text=relevant_text)
+
+class EmbeddingsWorkerPool:
+    """
+    Pool of worker processes for bulk embedding (add_book, seeding, imports).
+
+    ONNX inference for a large batch of ISBNs would otherwise run on the API process: it blocks the event loop
+    when called inline and, with the GIL around the Python parts of tokenizing/batching, gets little out of more
+    than one core.  Each worker process loads its own model, so a multi-core instance embeds that many batches in
+    parallel while the API process keeps serving.  Results come back as float32 arrays, which pickle cheaply.
+
+    Interactive single-text queries stay on EmbeddingsBatcher in the API process.  run() puts other CPU-bound work
+    (HNSW graph builds) on the same workers.
+
+    Every worker is a spawned interpreter holding its own copy of the model and tokenizer, on top of the API
+    process's copy, so the default is conservative: one worker per available CPU, but at most DEFAULT_MAX_WORKERS,
+    and only as many as fit in the container's memory limit at WORKER_RSS_MB each after API_RESERVE_MB for the API
+    process.  Set STORYSPARK_EMBEDDING_WORKERS to override.
+    """
+    # Number of worker processes.  Unset/empty: see above.  0: no pool, embed on a thread in the API process.
+    WORKERS: Final[int] = int(os.environ.get("STORYSPARK_EMBEDDING_WORKERS") or _default_workers())
+
+    _executor: Optional[ProcessPoolExecutor] = None
+
+    # metrics
+    _submitted: int = 0
+    _completed: int = 0
+    _failed: int = 0
+    _in_flight: int = 0
+    _restarts: int = 0
+    _busy_seconds: float = 0.0
+    _worker_max_rss_mb: Optional[int] = None
+
+    # ---------- public API ----------
+    @staticmethod
+    def start():
+        """
+        Creates the pool and starts its workers in the background.  Worker processes are spawned (not forked: the
+        API process has threads and an event loop running) and load the model when they start.
+        """
+        if EmbeddingsWorkerPool.WORKERS <= 0 or EmbeddingsWorkerPool._executor is not None:
+            return
+        EmbeddingsWorkerPool._executor = ProcessPoolExecutor(
+            max_workers=EmbeddingsWorkerPool.WORKERS,
+            mp_context=get_context("spawn"),
+            initializer=_worker_initializer,
+        )
+        # Workers are spawned on demand; ask for all of them now so they import and load the model during startup
+        # rather than on the first add_book
+        for _ in range(EmbeddingsWorkerPool.WORKERS):
+            EmbeddingsWorkerPool._executor.submit(_worker_ready).add_done_callback(EmbeddingsWorkerPool._record_rss)
+
+    @staticmethod
+    def stop():
+        """
+        Waits for running batches to finish and drops any that have not started.
+        """
+        executor = EmbeddingsWorkerPool._executor
+        EmbeddingsWorkerPool._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    async def generate_embeddings(tags: str, relevant_text: list[str]) -> list[EmbeddingsGenerator.EmbeddingsInfo]:
+        """
+        Same contract as EmbeddingsGenerator.generate_embeddings, run on a worker process without blocking the event loop.
+        """
+        return await EmbeddingsWorkerPool.run(_worker_generate_embeddings, tags, relevant_text)
+
+    @staticmethod
+    async def generate_embeddings_grouped(relevant_texts: list[list[str]]) -> list[list[EmbeddingsGenerator.EmbeddingsInfo]]:
+        """
+        generate_embeddings(tags="", relevant_text=texts) for each list of texts (one per ISBN, say), as about
+        WORKERS jobs: the lists are split into contiguous chunks of similar text counts and each chunk is embedded
+        as one flat list, so its texts share length-bucketed batches and the pool gets one job per worker.
+        """
+        total = sum(len(texts) for texts in relevant_texts)
+        if total == 0:
+            return [[] for _ in relevant_texts]
+        chunk_texts = -(-total // max(1, EmbeddingsWorkerPool.WORKERS))
+        chunks: list[list[list[str]]] = [[]]
+        count = 0
+        for texts in relevant_texts:
+            if count >= chunk_texts:
+                chunks.append([])
+                count = 0
+            chunks[-1].append(texts)
+            count += len(texts)
+
+        results = await asyncio.gather(*(
+            EmbeddingsWorkerPool.generate_embeddings(tags="", relevant_text=[text for texts in chunk for text in texts])
+            for chunk in chunks
+        ))
+        # One result per input text, in order: cut each chunk's results back into its lists
+        grouped: list[list[EmbeddingsGenerator.EmbeddingsInfo]] = []
+        for chunk, infos in zip(chunks, results):
+            offset = 0
+            for texts in chunk:
+                grouped.append(infos[offset:offset + len(texts)])
+                offset += len(texts)
+        return grouped
+
+    @staticmethod
+    async def run(fn: Callable[..., T], *args) -> T:
+        """
+        fn(*args) on a worker process, for other CPU-bound work that should stay off the API process (HNSW builds).
+        fn must be a module-level function or static method, and args and result must pickle.  Without a pool, runs
+        on a thread in the API process.
+        """
+        started_at = time.perf_counter()
+        EmbeddingsWorkerPool._submitted += 1
+        EmbeddingsWorkerPool._in_flight += 1
+        try:
+            executor = EmbeddingsWorkerPool._executor
+            if executor is None:
+                # Pool disabled (or not started, e.g. outside the app lifespan)
+                result = await asyncio.to_thread(fn, *args)
+            else:
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+                except BrokenProcessPool:
+                    # A worker died (e.g. killed for memory).  Replace the pool so later calls work, and fail this one.
+                    EmbeddingsWorkerPool._restart(executor)
+                    raise
+            EmbeddingsWorkerPool._completed += 1
+            return result
+        except Exception:
+            EmbeddingsWorkerPool._failed += 1
+            raise
+        finally:
+            EmbeddingsWorkerPool._in_flight -= 1
+            EmbeddingsWorkerPool._busy_seconds += time.perf_counter() - started_at
+
+    @staticmethod
+    def is_running() -> bool:
+        return EmbeddingsWorkerPool._executor is not None
+
+    @staticmethod
+    def to_dict():
+        return {
+            "WORKERS": EmbeddingsWorkerPool.WORKERS,
+            "WORKER_RSS_MB": WORKER_RSS_MB,
+            "API_RESERVE_MB": API_RESERVE_MB,
+            "memory_limit_mb": _memory_limit_mb(),
+            "worker_max_rss_mb": EmbeddingsWorkerPool._worker_max_rss_mb,
+            "running": EmbeddingsWorkerPool._executor is not None,
+            "submitted": EmbeddingsWorkerPool._submitted,
+            "completed": EmbeddingsWorkerPool._completed,
+            "failed": EmbeddingsWorkerPool._failed,
+            "in_flight": EmbeddingsWorkerPool._in_flight,
+            "restarts": EmbeddingsWorkerPool._restarts,
+            "busy_seconds": EmbeddingsWorkerPool._busy_seconds,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _record_rss(future):
+        # Runs on the pool's management thread
+        if future.cancelled() or future.exception() is not None:
+            return
+        EmbeddingsWorkerPool._worker_max_rss_mb = max(future.result(), EmbeddingsWorkerPool._worker_max_rss_mb or 0)
+
+    @staticmethod
+    def _restart(broken: ProcessPoolExecutor):
+        if EmbeddingsWorkerPool._executor is not broken:
+            # Someone else already replaced it
+            return
+        print("Embeddings worker pool is broken, starting a new one")
+        EmbeddingsWorkerPool._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+        EmbeddingsWorkerPool._restarts += 1
+        EmbeddingsWorkerPool.start()
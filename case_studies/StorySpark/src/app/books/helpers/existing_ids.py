@@ -0,0 +1,95 @@
+import os
+from typing import Final, Optional
+from cachetools import TTLCache
+from google.cloud import bigquery
+
+from app.books.helpers.bigquery_client_helper import BigQueryClientHelper
+from app.books.helpers.query_runner import QueryRunner
+
+class ExistingIds:
+    """
+    Set-based "which of these ids already exist" checks against a table, one IN UNNEST query per call.
+
+    Ids seen to exist (or written by this instance) are remembered for TTL_SECONDS so repeated adds of the same
+    books skip BigQuery entirely.  Only existence is cached, never absence, and deletes made through this instance
+    call forget(); the TTL bounds staleness from deletes made through other instances.
+    """
+    MAX_ENTRIES: Final[int] = int(os.environ.get("STORYSPARK_EXISTING_IDS_CACHE_MAX_ENTRIES", "65536"))
+    TTL_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_EXISTING_IDS_CACHE_TTL_SECONDS", "60"))
+
+    # (table_id, id) -> True
+    _known: TTLCache = TTLCache(maxsize=MAX_ENTRIES, ttl=TTL_SECONDS)
+
+    # metrics
+    _queries: int = 0
+    _ids_checked: int = 0
+    _cache_hits: int = 0
+
+    # ---------- public API ----------
+    @staticmethod
+    async def find(bigquery_client_helper: BigQueryClientHelper, table_id: str, id_column: str, ids: list[str]) -> set[str]:
+        """
+        The subset of ids that exist in table_id's id_column.
+        """
+        ids = list(dict.fromkeys(ids))
+        ExistingIds._ids_checked += len(ids)
+        found = {id for id in ids if (table_id, id) in ExistingIds._known}
+        ExistingIds._cache_hits += len(found)
+        unknown = [id for id in ids if id not in found]
+        if unknown:
+            ExistingIds._queries += 1
+            existing = await ExistingIds._query(bigquery_client_helper, table_id, id_column, unknown)
+            ExistingIds.remember(table_id, existing)
+            found.update(existing)
+        return found
+
+    @staticmethod
+    def remember(table_id: str, ids):
+        if ExistingIds.MAX_ENTRIES <= 0:
+            return
+        for id in ids:
+            ExistingIds._known[(table_id, id)] = True
+
+    @staticmethod
+    def forget(table_id: Optional[str] = None, ids=None):
+        """
+        Forgets the given ids of a table, or everything when table_id is None.
+        """
+        if table_id is None:
+            ExistingIds._known.clear()
+            return
+        for id in ids or ():
+            ExistingIds._known.pop((table_id, id), None)
+
+    @staticmethod
+    def to_dict():
+        return {
+            "MAX_ENTRIES": ExistingIds.MAX_ENTRIES,
+            "TTL_SECONDS": ExistingIds.TTL_SECONDS,
+            "entries": len(ExistingIds._known),
+            "queries": ExistingIds._queries,
+            "ids_checked": ExistingIds._ids_checked,
+            "cache_hits": ExistingIds._cache_hits,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    async def _query(bigquery_client_helper: BigQueryClientHelper, table_id: str, id_column: str, ids: list[str]) -> set[str]:
+        table_ref = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{table_id}"
+        query = f"""
+            SELECT DISTINCT
+                {id_column} AS id
+            FROM
+                `{table_ref}`
+            WHERE
+                {id_column} IN UNNEST(@ids)
+        """
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("ids", "STRING", ids)
+            ]
+        )
+
+        rows = await QueryRunner.run(bigquery_client_helper, query, job_config=job_config)
+        return {row["id"] for row in rows}
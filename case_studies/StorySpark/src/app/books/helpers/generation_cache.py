@@ -0,0 +1,108 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable, Iterator, Optional
+from cachetools import TTLCache
+
+class GenerationCache:
+    """
+    Bounded TTL + LRU cache of values computed per owner, shared by RecommendationCache and LibraryCache.
+
+    Callers asking for a key that is being computed wait for that computation instead of starting their own
+    (single-flight).  invalidate(owner) bumps the owner's generation, which makes all of their cached values, and
+    any computation that started before it, stale at once; invalidate() does that for every owner.  The TTL bounds
+    staleness from writes made through other instances.  max_entries of 0 turns caching off (single-flight stays).
+    """
+    @dataclass
+    class _Entry:
+        generation: tuple[int, int]
+        value: Any
+        compute_seconds: float
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: TTLCache = TTLCache(maxsize=max_entries, ttl=ttl_seconds)
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+        self._generations: dict[str, int] = {}
+        # Bumped by invalidate() without an owner
+        self._epoch = 0
+
+        # metrics
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._invalidations = 0
+        self._saved_seconds = 0.0
+
+    # ---------- public API ----------
+    async def get_or_compute(self, owner: str, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        The current value of (owner, key); compute() runs only if there is none and none is being computed.  The
+        value is shared between callers, so treat it as read-only.
+        """
+        generation = self._generation(owner)
+        entry_key = (owner, key)
+        entry = self._entries.get(entry_key) if self.max_entries > 0 else None
+        if entry is not None and entry.generation == generation:
+            self._hits += 1
+            self._saved_seconds += entry.compute_seconds
+            return entry.value
+
+        flight_key = (entry_key, generation)
+        task = self._in_flight.get(flight_key)
+        if task is not None:
+            self._coalesced += 1
+        else:
+            self._misses += 1
+            task = asyncio.create_task(self._compute(entry_key, generation, compute))
+            self._in_flight[flight_key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(flight_key, None))
+        # shield: a caller that disconnects must not cancel the computation the others are waiting on
+        return await asyncio.shield(task)
+
+    def invalidate(self, owner: Optional[str] = None):
+        """
+        Makes one owner's values stale, or everyone's when owner is None.
+        """
+        self._invalidations += 1
+        if owner is None:
+            self._epoch += 1
+            self._entries.clear()
+            return
+        self._generations[owner] = self._generations.get(owner, 0) + 1
+
+    def values(self) -> Iterator[Any]:
+        """
+        The cached values, current or not.
+        """
+        return (entry.value for entry in list(self._entries.values()))
+
+    def to_dict(self):
+        lookups = self._hits + self._misses + self._coalesced
+        return {
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "hit_ratio": (self._hits + self._coalesced) / lookups if lookups else None,
+            "invalidations": self._invalidations,
+            # Latency the hits would have cost, going by how long their cached value took to compute
+            "saved_seconds": self._saved_seconds,
+            "saved_ms_per_hit": self._saved_seconds / self._hits * 1000.0 if self._hits else None,
+        }
+
+    # ---------- helpers ----------
+    def _generation(self, owner: str) -> tuple[int, int]:
+        return self._epoch, self._generations.get(owner, 0)
+
+    async def _compute(self, entry_key: tuple, generation: tuple[int, int], compute: Callable[[], Awaitable[Any]]) -> Any:
+        started_at = time.perf_counter()
+        value = await compute()
+        compute_seconds = time.perf_counter() - started_at
+        owner = entry_key[0]
+        if self.max_entries > 0 and self._generation(owner) == generation:
+            # Only keep it if nothing was written for this owner while we were computing
+            self._entries[entry_key] = GenerationCache._Entry(generation=generation, value=value, compute_seconds=compute_seconds)
+        return value
@@ -0,0 +1,323 @@
+import os
+import heapq
+import json
+import math
+import threading
+from typing import Optional
+import numpy as np
+
+class HnswIndex:
+    """
+    Hierarchical Navigable Small World graph (Malkov & Yashunin) over L2-normalized float32 vectors, scored by
+    dot product (= cosine similarity).
+
+    Every node carries the (isbn, content) of the embedding row it was built from.  Removing a book tombstones its
+    nodes: they still route searches through the graph but are never returned.  Thread-safe: inserts, tombstones
+    and searches each take a lock, so inserts can run on a worker thread while queries keep being served.
+
+    Building is pure Python and CPU-bound, so the service does it in a worker process (see synced); the graph
+    pickles as the same compact arrays save() writes.
+    """
+    def __init__(self, dim: int, m: int = 16, ef_construction: int = 100, ef_search: int = 64, seed: int = 0):
+        self.dim = dim
+        self.m = m
+        # Layer 0 carries most of the search, so it gets twice the links (as in the paper)
+        self.m0 = 2 * m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._level_mult = 1.0 / math.log(max(m, 2))
+        self._rng = np.random.default_rng(seed)
+
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.count = 0
+        self.levels: list[int] = []
+        # neighbors[node][level] -> node ids
+        self.neighbors: list[list[list[int]]] = []
+        self.isbns: list[str] = []
+        self.contents: list[str] = []
+        self.deleted: set[int] = set()
+        self._nodes_by_isbn: dict[str, list[int]] = {}
+        self.entry_point: Optional[int] = None
+        self.max_level = -1
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.count - len(self.deleted)
+
+    # ---------- public API ----------
+    def add(self, vector: np.ndarray, isbn: str, content: str) -> int:
+        with self._lock:
+            return self._insert(np.asarray(vector, dtype=np.float32), isbn, content)
+
+    def add_many(self, rows: list[tuple[str, str, np.ndarray]]):
+        """
+        rows: (isbn, content, embedding_normalized).  The lock is taken per row so searches are not held up for
+        the whole batch.
+        """
+        for isbn, content, vector in rows:
+            self.add(vector, isbn, content)
+
+    def mark_deleted(self, isbn: str):
+        with self._lock:
+            self.deleted.update(self._nodes_by_isbn.pop(isbn, ()))
+
+    def live_keys(self) -> set[tuple[str, str]]:
+        """
+        (isbn, content) of every node that is not tombstoned.
+        """
+        with self._lock:
+            return {
+                (isbn, self.contents[node])
+                for isbn, nodes in self._nodes_by_isbn.items()
+                for node in nodes
+            }
+
+    def tombstone_ratio(self) -> float:
+        return len(self.deleted) / self.count if self.count else 0.0
+
+    def search(self, query: np.ndarray, k: int, ef: Optional[int] = None) -> list[tuple[int, float]]:
+        """
+        Approximate top-k live nodes as (node, cosine similarity), best first.  A larger ef trades latency for recall.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        with self._lock:
+            if self.entry_point is None:
+                return []
+            entry = [self.entry_point]
+            for level in range(self.max_level, 0, -1):
+                entry = [max(self._search_layer(query, entry, 1, level))[1]]
+            # Tombstoned nodes take up slots in the beam, so widen it by the share of them
+            ef = max(ef or self.ef_search, k)
+            ef = int(ef / max(1.0 - self.tombstone_ratio(), 0.1))
+            found = self._search_layer(query, entry, ef, 0)
+            live = sorted(((sim, node) for sim, node in found if node not in self.deleted), reverse=True)
+        return [(node, sim) for sim, node in live[:k]]
+
+    def to_dict(self):
+        return {
+            "M": self.m,
+            "EF_CONSTRUCTION": self.ef_construction,
+            "EF_SEARCH": self.ef_search,
+            "nodes": self.count,
+            "tombstones": len(self.deleted),
+            "max_level": self.max_level,
+        }
+
+    # ---------- persistence ----------
+    def save(self, path: str):
+        """
+        Writes the graph to a single .npz file (via a temp file and rename, so readers never see a partial file).
+        """
+        arrays = self._to_arrays()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "HnswIndex":
+        with np.load(path, allow_pickle=False) as data:
+            return HnswIndex._from_arrays(data)
+
+    def __getstate__(self) -> dict:
+        return self._to_arrays()
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(HnswIndex._from_arrays(state).__dict__)
+
+    @staticmethod
+    def synced(
+        ann: Optional["HnswIndex"],
+        path: Optional[str],
+        rows: tuple[list[str], list[str], np.ndarray, np.ndarray],
+        m: int,
+        ef_construction: int,
+        ef_search: int,
+        max_tombstone_ratio: float,
+        build: bool = True
+        ) -> Optional["HnswIndex"]:
+        """
+        A graph in line with rows (isbns, contents, matrix, group_starts of an OwnerVectorIndex): rows it does not
+        have are inserted and books that are gone are tombstoned.  Starts from ann, else the graph saved at path,
+        else an empty one, and saves the result to path if it changed.  With build False nothing is inserted: the
+        result is None unless the starting graph already holds every row.  Blocking and CPU-bound.
+        """
+        isbns, contents, matrix, group_starts = rows
+        dim = matrix.shape[1]
+        if ann is None and path is not None and os.path.exists(path):
+            try:
+                ann = HnswIndex.load(path)
+            except Exception as e:
+                print(f"Failed to load HNSW graph {path}, rebuilding it: {e}")
+        if ann is not None and (ann.dim != dim or ann.tombstone_ratio() > max_tombstone_ratio):
+            ann = None
+        if ann is None:
+            if not build:
+                return None
+            ann = HnswIndex(dim, m=m, ef_construction=ef_construction, ef_search=ef_search)
+
+        live = ann.live_keys()
+        row_isbns = np.repeat(np.arange(len(isbns)), np.diff(np.append(group_starts, matrix.shape[0])))
+        missing = [
+            (isbns[group], contents[row], matrix[row])
+            for row, group in enumerate(row_isbns.tolist())
+            if (isbns[group], contents[row]) not in live
+        ]
+        if missing and not build:
+            return None
+
+        removed = {isbn for isbn, _ in live} - set(isbns)
+        for isbn in removed:
+            ann.mark_deleted(isbn)
+        ann.add_many(missing)
+
+        if path is not None and (missing or removed):
+            try:
+                ann.save(path)
+            except Exception as e:
+                print(f"Failed to save HNSW graph {path}: {e}")
+        return ann
+
+    def _to_arrays(self) -> dict:
+        with self._lock:
+            adjacency: list[int] = []
+            pointers = [0]
+            for node in range(self.count):
+                for links in self.neighbors[node]:
+                    adjacency.extend(links)
+                    pointers.append(len(adjacency))
+            meta = {
+                "dim": self.dim,
+                "m": self.m,
+                "ef_construction": self.ef_construction,
+                "ef_search": self.ef_search,
+                "entry_point": self.entry_point,
+                "max_level": self.max_level,
+            }
+            return {
+                "meta": np.array(json.dumps(meta)),
+                "vectors": self.vectors[: self.count].copy(),
+                "levels": np.asarray(self.levels, dtype=np.int32),
+                "adjacency": np.asarray(adjacency, dtype=np.int32),
+                "pointers": np.asarray(pointers, dtype=np.int64),
+                "isbns": np.asarray(self.isbns, dtype=str),
+                "contents": np.asarray(self.contents, dtype=str),
+                "deleted": np.asarray(sorted(self.deleted), dtype=np.int32),
+            }
+
+    @staticmethod
+    def _from_arrays(data) -> "HnswIndex":
+        meta = json.loads(str(data["meta"]))
+        index = HnswIndex(dim=meta["dim"], m=meta["m"], ef_construction=meta["ef_construction"], ef_search=meta["ef_search"])
+        index.vectors = np.array(data["vectors"], dtype=np.float32)
+        index.count = index.vectors.shape[0]
+        index.levels = data["levels"].tolist()
+        adjacency = data["adjacency"].tolist()
+        pointers = data["pointers"].tolist()
+        index.isbns = data["isbns"].tolist()
+        index.contents = data["contents"].tolist()
+        index.deleted = set(data["deleted"].tolist())
+
+        slot = 0
+        for level in index.levels:
+            links = []
+            for _ in range(level + 1):
+                links.append(adjacency[pointers[slot]:pointers[slot + 1]])
+                slot += 1
+            index.neighbors.append(links)
+        for node, isbn in enumerate(index.isbns):
+            if node not in index.deleted:
+                index._nodes_by_isbn.setdefault(isbn, []).append(node)
+        index.entry_point = meta["entry_point"]
+        index.max_level = meta["max_level"]
+        return index
+
+    # ---------- helpers (callers hold _lock) ----------
+    def _insert(self, vector: np.ndarray, isbn: str, content: str) -> int:
+        node = self.count
+        if node == self.vectors.shape[0]:
+            grown = np.empty((max(64, 2 * node), self.dim), dtype=np.float32)
+            grown[:node] = self.vectors[:node]
+            self.vectors = grown
+        self.vectors[node] = vector
+        self.count += 1
+
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+        self.levels.append(level)
+        self.neighbors.append([[] for _ in range(level + 1)])
+        self.isbns.append(isbn)
+        self.contents.append(content)
+        self._nodes_by_isbn.setdefault(isbn, []).append(node)
+
+        if self.entry_point is None:
+            self.entry_point, self.max_level = node, level
+            return node
+
+        entry = [self.entry_point]
+        for layer in range(self.max_level, level, -1):
+            entry = [max(self._search_layer(vector, entry, 1, layer))[1]]
+
+        for layer in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(vector, entry, self.ef_construction, layer)
+            max_links = self.m0 if layer == 0 else self.m
+            self.neighbors[node][layer] = self._select_neighbors(found, self.m)
+            for other in self.neighbors[node][layer]:
+                links = self.neighbors[other][layer]
+                links.append(node)
+                if len(links) > max_links:
+                    sims = self.vectors[links] @ self.vectors[other]
+                    self.neighbors[other][layer] = self._select_neighbors(list(zip(sims.tolist(), links)), max_links)
+            entry = [n for _, n in found]
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+        return node
+
+    def _search_layer(self, query: np.ndarray, entry: list[int], ef: int, level: int) -> list[tuple[float, int]]:
+        """
+        Beam search on one layer.  Returns up to ef (similarity, node) pairs, in no particular order.
+        """
+        visited = set(entry)
+        sims = (self.vectors[entry] @ query).tolist()
+        # candidates: max-heap by similarity (negated); results: min-heap holding the best ef so far
+        candidates = [(-sim, node) for sim, node in zip(sims, entry)]
+        heapq.heapify(candidates)
+        results = [(sim, node) for sim, node in zip(sims, entry)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            negative_sim, node = heapq.heappop(candidates)
+            if -negative_sim < results[0][0] and len(results) >= ef:
+                break
+            unvisited = [n for n in self.neighbors[node][level] if n not in visited]
+            if not unvisited:
+                continue
+            visited.update(unvisited)
+            for sim, other in zip((self.vectors[unvisited] @ query).tolist(), unvisited):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, other))
+                    heapq.heappush(results, (sim, other))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return results
+
+    def _select_neighbors(self, candidates: list[tuple[float, int]], m: int) -> list[int]:
+        """
+        Neighbor selection heuristic: take candidates best first, skipping any that is closer to an already chosen
+        neighbor than to the base node, so links spread out in different directions.  Remaining slots are filled
+        with the best skipped candidates.
+        """
+        ordered = sorted(candidates, reverse=True)
+        selected: list[int] = []
+        skipped: list[int] = []
+        for sim, node in ordered:
+            if len(selected) >= m:
+                break
+            if selected and float((self.vectors[selected] @ self.vectors[node]).max()) > sim:
+                skipped.append(node)
+            else:
+                selected.append(node)
+        return selected + skipped[: m - len(selected)]
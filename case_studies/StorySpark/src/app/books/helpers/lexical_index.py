@@ -0,0 +1,62 @@
+import re
+import math
+from collections import Counter
+from typing import Final
+import numpy as np
+
+_TOKEN_PATTERN: Final = re.compile(r"[^\W_]+")
+
+class LexicalIndex:
+    """
+    BM25 (Okapi) inverted index over the content of embedding rows (subjects, description chunks).
+
+    Row numbers are those of the OwnerVectorIndex it was built for, so lexical and vector scores of a row line up.
+    Postings are numpy arrays of (row, term frequency), so scoring a query is a few vectorized adds per term.
+    """
+    K1: Final[float] = 1.2
+    B: Final[float] = 0.75
+
+    def __init__(self, contents: list[str]):
+        self.rows = len(contents)
+        rows_by_term: dict[str, list[int]] = {}
+        frequencies_by_term: dict[str, list[int]] = {}
+        lengths = np.zeros(self.rows, dtype=np.float32)
+        for row, content in enumerate(contents):
+            tokens = LexicalIndex.tokenize(content)
+            lengths[row] = len(tokens)
+            for term, frequency in Counter(tokens).items():
+                rows_by_term.setdefault(term, []).append(row)
+                frequencies_by_term.setdefault(term, []).append(frequency)
+
+        average_length = float(lengths.mean()) if self.rows and lengths.any() else 1.0
+        # Per-row part of the BM25 denominator, computed once
+        self._length_norm = self.K1 * (1.0 - self.B + self.B * lengths / average_length)
+        self.postings: dict[str, tuple[np.ndarray, np.ndarray]] = {
+            term: (np.asarray(rows, dtype=np.int64), np.asarray(frequencies_by_term[term], dtype=np.float32))
+            for term, rows in rows_by_term.items()
+        }
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.postings
+
+    @staticmethod
+    def tokenize(text: str) -> list[str]:
+        """
+        Lower-cased words, with a plain plural "s" dropped so "dinosaurs" finds "dinosaur".
+        """
+        tokens = _TOKEN_PATTERN.findall(text.lower())
+        return [token[:-1] if len(token) > 3 and token.endswith("s") and not token.endswith("ss") else token for token in tokens]
+
+    def score(self, terms: list[str]) -> np.ndarray:
+        """
+        BM25 score of every row for the query terms (0 for rows that contain none of them).
+        """
+        scores = np.zeros(self.rows, dtype=np.float32)
+        for term in set(terms):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            rows, frequencies = posting
+            idf = math.log(1.0 + (self.rows - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * frequencies * (self.K1 + 1.0) / (frequencies + self._length_norm[rows])
+        return scores
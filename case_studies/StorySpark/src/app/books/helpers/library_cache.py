@@ -0,0 +1,130 @@
+import os
+import hashlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Final, Optional
+
+from app.books.helpers.generation_cache import GenerationCache
+
+class LibraryCache:
+    """
+    Per-owner snapshot of the full GET /books response (the serialized JSON and its strong ETag).
+
+    Every write to an owner's books (add, remove, mark read, clear) moves the owner's generation forward, which
+    makes their snapshot, and any load that started before the write, stale at once.  While the snapshot is
+    current, polls are answered from memory, and an If-None-Match that matches its ETag gets a 304 without touching
+    BigQuery.  Concurrent polls of the same owner share one load.  The TTL bounds staleness from writes made through
+    other instances.  See GenerationCache.
+
+    The ETag is a hash of the body, so it is the same on every instance and across restarts for the same books, and
+    a client's cached copy stays valid for as long as the books are unchanged.
+
+    Removals are logged next to the generations, so GET /books?since= can report the ISBNs removed after since.
+    Where this process cannot list them (before it started, after a clear, after a removal still pending in
+    BigQuery, or past the last MAX_REMOVALS_PER_OWNER of an owner), removals_since returns None instead.  Like the
+    generations, the log only covers writes made through this instance.
+    """
+    MAX_OWNERS: Final[int] = int(os.environ.get("STORYSPARK_LIBRARY_CACHE_MAX_OWNERS", "1024"))
+    TTL_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_LIBRARY_CACHE_TTL_SECONDS", "30"))
+    MAX_REMOVALS_PER_OWNER: Final[int] = int(os.environ.get("STORYSPARK_LIBRARY_CACHE_MAX_REMOVALS_PER_OWNER", "1024"))
+
+    @dataclass
+    class Snapshot:
+        body: bytes
+        etag: str
+
+    _cache: GenerationCache = GenerationCache(max_entries=MAX_OWNERS, ttl_seconds=TTL_SECONDS)
+    # owner -> isbn -> when it was removed, oldest first
+    _removals: dict[str, dict[str, datetime]] = {}
+    # Removals before these times cannot be listed: for everyone (process start, last clear), and per owner
+    _removals_known_since: datetime = datetime.now(timezone.utc)
+    _owner_removals_known_since: dict[str, datetime] = {}
+
+    # metrics
+    _not_modified: int = 0
+    _unlisted_removals: int = 0
+
+    # ---------- public API ----------
+    @staticmethod
+    async def get_or_load(owner: str, load: Callable[[], Awaitable[bytes]]) -> "LibraryCache.Snapshot":
+        """
+        The owner's current snapshot; load() (returning the response body) runs only if there is none.
+        """
+        async def snapshot() -> LibraryCache.Snapshot:
+            body = await load()
+            return LibraryCache.Snapshot(body=body, etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+        return await LibraryCache._cache.get_or_compute(owner, None, snapshot)
+
+    @staticmethod
+    def not_modified(snapshot: "LibraryCache.Snapshot", if_none_match: Optional[str]) -> bool:
+        """
+        True if the If-None-Match header lists the snapshot's ETag (or is *).  Compared weakly, as RFC 9110 asks for
+        If-None-Match.
+        """
+        if not if_none_match:
+            return False
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or snapshot.etag in tags:
+            LibraryCache._not_modified += 1
+            return True
+        return False
+
+    @staticmethod
+    def invalidate(owner: Optional[str] = None):
+        """
+        Makes one owner's snapshot stale, or everyone's when owner is None.
+        """
+        LibraryCache._cache.invalidate(owner)
+
+    @staticmethod
+    def record_removal(owner: str, isbn: str):
+        """
+        Logs that the owner's book was removed (after the write committed).
+        """
+        removals = LibraryCache._removals.setdefault(owner, {})
+        removals.pop(isbn, None)
+        removals[isbn] = datetime.now(timezone.utc)
+        while len(removals) > LibraryCache.MAX_REMOVALS_PER_OWNER:
+            oldest = next(iter(removals))
+            LibraryCache._owner_removals_known_since[owner] = removals.pop(oldest)
+
+    @staticmethod
+    def record_unlisted_removals(owner: Optional[str] = None):
+        """
+        The owner's books, or everyone's when owner is None, may have been removed in ways that cannot be listed
+        (a clear, or a removal still pending in BigQuery).
+        """
+        now = datetime.now(timezone.utc)
+        if owner is None:
+            LibraryCache._removals.clear()
+            LibraryCache._owner_removals_known_since.clear()
+            LibraryCache._removals_known_since = now
+            return
+        LibraryCache._removals.pop(owner, None)
+        LibraryCache._owner_removals_known_since[owner] = now
+
+    @staticmethod
+    def removals_since(owner: str, since: datetime) -> Optional[list[str]]:
+        """
+        ISBNs of the owner's books removed after since, or None if there may be removals after since that cannot be
+        listed.
+        """
+        known_since = LibraryCache._removals_known_since
+        known_since = max(known_since, LibraryCache._owner_removals_known_since.get(owner, known_since))
+        if since < known_since:
+            LibraryCache._unlisted_removals += 1
+            return None
+        return [isbn for isbn, removed_at in LibraryCache._removals.get(owner, {}).items() if removed_at > since]
+
+    @staticmethod
+    def to_dict():
+        return {
+            "MAX_OWNERS": LibraryCache.MAX_OWNERS,
+            "TTL_SECONDS": LibraryCache.TTL_SECONDS,
+            **LibraryCache._cache.to_dict(),
+            "bytes": sum(len(snapshot.body) for snapshot in LibraryCache._cache.values()),
+            "not_modified": LibraryCache._not_modified,
+            "MAX_REMOVALS_PER_OWNER": LibraryCache.MAX_REMOVALS_PER_OWNER,
+            "logged_removals": sum(len(removals) for removals in LibraryCache._removals.values()),
+            "unlisted_removals": LibraryCache._unlisted_removals,
+        }
@@ -0,0 +1,205 @@
+import os
+import json
+import hashlib
+from typing import Final, Optional
+import onnxruntime as ort
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+class OnnxSessionFactory:
+    """
+    Builds ONNX Runtime sessions from environment configuration and keeps an optimized copy of the model graph
+    next to the model so that later container starts skip graph optimization.
+    """
+    # 0 lets ONNX Runtime decide (one thread per physical core for intra-op)
+    INTRA_OP_THREADS: Final[int] = int(os.environ.get("STORYSPARK_ORT_INTRA_OP_THREADS", "0"))
+    INTER_OP_THREADS: Final[int] = int(os.environ.get("STORYSPARK_ORT_INTER_OP_THREADS", "0"))
+    # sequential or parallel.  parallel only helps graphs with independent branches; our encoder is one chain.
+    EXECUTION_MODE: Final[str] = os.environ.get("STORYSPARK_ORT_EXECUTION_MODE", "sequential").strip().lower()
+    # disable, basic, extended or all
+    GRAPH_OPTIMIZATION_LEVEL: Final[str] = os.environ.get("STORYSPARK_ORT_GRAPH_OPTIMIZATION_LEVEL", "all").strip().lower()
+    ENABLE_CPU_MEM_ARENA: Final[bool] = _env_bool("STORYSPARK_ORT_ENABLE_CPU_MEM_ARENA", True)
+    ENABLE_MEM_PATTERN: Final[bool] = _env_bool("STORYSPARK_ORT_ENABLE_MEM_PATTERN", True)
+    # Shrink the CPU arena back after every run instead of holding on to the high-water mark
+    ARENA_SHRINK_ON_RUN: Final[bool] = _env_bool("STORYSPARK_ORT_ARENA_SHRINK_ON_RUN", False)
+
+    # Optimized model cache.  Defaults to the model's own directory; point it somewhere writable if that is read-only.
+    OPTIMIZED_MODEL_CACHE: Final[bool] = _env_bool("STORYSPARK_ORT_OPTIMIZED_MODEL_CACHE", True)
+    OPTIMIZED_MODEL_DIR: Final[Optional[str]] = os.environ.get("STORYSPARK_ORT_OPTIMIZED_MODEL_DIR") or None
+    # ort (flatbuffer, fastest to load) or onnx
+    OPTIMIZED_MODEL_FORMAT: Final[str] = os.environ.get("STORYSPARK_ORT_OPTIMIZED_MODEL_FORMAT", "ort").strip().lower()
+    # Written next to the model by model_export/main.py: {"fingerprint", "model_size", "data_size"}
+    FINGERPRINT_MANIFEST_SUFFIX: Final[str] = ".fingerprint.json"
+
+    _GRAPH_OPTIMIZATION_LEVELS: Final[dict] = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    _EXECUTION_MODES: Final[dict] = {
+        "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+        "parallel": ort.ExecutionMode.ORT_PARALLEL,
+    }
+
+    # What the last create() call did, for logging
+    _last_load: dict = {}
+    # manifest or hashed: how the last model fingerprint was obtained
+    _fingerprint_source: Optional[str] = None
+
+    # ---------- public API ----------
+    @staticmethod
+    def create(model_path: str, providers: list[str], intra_op_threads: Optional[int] = None) -> ort.InferenceSession:
+        """
+        Create an inference session for model_path.  If an optimized copy of this exact model (same content, same
+        ONNX Runtime version) was saved by an earlier start or by model_export/main.py, that copy is loaded instead.
+        intra_op_threads overrides STORYSPARK_ORT_INTRA_OP_THREADS (used by worker processes sharing a machine).
+        """
+        cached_path = OnnxSessionFactory._optimized_model_path(model_path)
+
+        if cached_path is not None and os.path.exists(cached_path):
+            try:
+                sess = ort.InferenceSession(cached_path, OnnxSessionFactory._session_options(intra_op_threads), providers=providers)
+                OnnxSessionFactory._last_load = {"source": cached_path, "optimized_model_cache": "hit"}
+                return sess
+            except Exception as e:
+                # A corrupt or incompatible cache entry should never stop the service from starting
+                print(f"Failed to load optimized model {cached_path}, rebuilding it from {model_path}: {e}")
+
+        if cached_path is not None and os.access(os.path.dirname(cached_path), os.W_OK):
+            # Write to a private temp file and rename, so concurrent starts never see a half-written model
+            tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+            saved_level = OnnxSessionFactory._saved_optimization_level()
+            options = OnnxSessionFactory._session_options(intra_op_threads, level=saved_level)
+            options.optimized_model_filepath = tmp_path
+            if OnnxSessionFactory.OPTIMIZED_MODEL_FORMAT == "ort":
+                options.add_session_config_entry("session.save_model_format", "ORT")
+            try:
+                sess = ort.InferenceSession(model_path, options, providers=providers)
+                os.replace(tmp_path, cached_path)
+                if saved_level != OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL:
+                    # Only on the start that builds the cache: reload so the serving session gets the full optimization level
+                    sess = ort.InferenceSession(cached_path, OnnxSessionFactory._session_options(intra_op_threads), providers=providers)
+                OnnxSessionFactory._last_load = {"source": model_path, "optimized_model_cache": "saved", "optimized_model_path": cached_path}
+                return sess
+            except Exception as e:
+                print(f"Failed to save optimized model to {cached_path}, loading {model_path} without it: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        sess = ort.InferenceSession(model_path, OnnxSessionFactory._session_options(intra_op_threads), providers=providers)
+        OnnxSessionFactory._last_load = {"source": model_path, "optimized_model_cache": "disabled" if cached_path is None else "unwritable"}
+        return sess
+
+    @staticmethod
+    def to_dict():
+        return {
+            "INTRA_OP_THREADS": OnnxSessionFactory.INTRA_OP_THREADS,
+            "INTER_OP_THREADS": OnnxSessionFactory.INTER_OP_THREADS,
+            "EXECUTION_MODE": OnnxSessionFactory.EXECUTION_MODE,
+            "GRAPH_OPTIMIZATION_LEVEL": OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL,
+            "ENABLE_CPU_MEM_ARENA": OnnxSessionFactory.ENABLE_CPU_MEM_ARENA,
+            "ENABLE_MEM_PATTERN": OnnxSessionFactory.ENABLE_MEM_PATTERN,
+            "ARENA_SHRINK_ON_RUN": OnnxSessionFactory.ARENA_SHRINK_ON_RUN,
+            "OPTIMIZED_MODEL_CACHE": OnnxSessionFactory.OPTIMIZED_MODEL_CACHE,
+            "OPTIMIZED_MODEL_DIR": OnnxSessionFactory.OPTIMIZED_MODEL_DIR,
+            "OPTIMIZED_MODEL_FORMAT": OnnxSessionFactory.OPTIMIZED_MODEL_FORMAT,
+            "last_load": OnnxSessionFactory._last_load,
+            "fingerprint_source": OnnxSessionFactory._fingerprint_source,
+        }
+
+    @staticmethod
+    def run_options() -> Optional[ort.RunOptions]:
+        if not OnnxSessionFactory.ARENA_SHRINK_ON_RUN:
+            return None
+        run_options = ort.RunOptions()
+        run_options.add_run_config_entry("memory.enable_memory_arena_shrinkage", "cpu:0")
+        return run_options
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _session_options(intra_op_threads: Optional[int], level: Optional[str] = None) -> ort.SessionOptions:
+        if OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL not in OnnxSessionFactory._GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"Unknown STORYSPARK_ORT_GRAPH_OPTIMIZATION_LEVEL '{OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL}'.  Expected one of {list(OnnxSessionFactory._GRAPH_OPTIMIZATION_LEVELS)}")
+        if OnnxSessionFactory.EXECUTION_MODE not in OnnxSessionFactory._EXECUTION_MODES:
+            raise ValueError(f"Unknown STORYSPARK_ORT_EXECUTION_MODE '{OnnxSessionFactory.EXECUTION_MODE}'.  Expected one of {list(OnnxSessionFactory._EXECUTION_MODES)}")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = OnnxSessionFactory.INTRA_OP_THREADS if intra_op_threads is None else intra_op_threads
+        options.inter_op_num_threads = OnnxSessionFactory.INTER_OP_THREADS
+        options.execution_mode = OnnxSessionFactory._EXECUTION_MODES[OnnxSessionFactory.EXECUTION_MODE]
+        options.graph_optimization_level = OnnxSessionFactory._GRAPH_OPTIMIZATION_LEVELS[level or OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL]
+        options.enable_cpu_mem_arena = OnnxSessionFactory.ENABLE_CPU_MEM_ARENA
+        options.enable_mem_pattern = OnnxSessionFactory.ENABLE_MEM_PATTERN
+        return options
+
+    @staticmethod
+    def _saved_optimization_level() -> str:
+        """
+        Layout optimizations at the "all" level are specific to the CPU they were made on, and Cloud Run does not
+        promise the same CPU every start.  The saved graph stops at "extended"; the session re-applies the
+        remaining (cheap) layout pass on every load.
+        """
+        return "extended" if OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL == "all" else OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL
+
+    @staticmethod
+    def _optimized_model_path(model_path: str) -> Optional[str]:
+        """
+        Where the optimized copy of model_path lives, or None when caching is off.
+        The name carries a fingerprint of the source model and the ONNX Runtime version so a re-exported model or a
+        runtime upgrade never picks up a stale graph.
+        """
+        if not OnnxSessionFactory.OPTIMIZED_MODEL_CACHE or OnnxSessionFactory.GRAPH_OPTIMIZATION_LEVEL == "disable":
+            return None
+        if not os.path.exists(model_path):
+            return None
+        if OnnxSessionFactory.OPTIMIZED_MODEL_FORMAT not in ("ort", "onnx"):
+            raise ValueError(f"Unknown STORYSPARK_ORT_OPTIMIZED_MODEL_FORMAT '{OnnxSessionFactory.OPTIMIZED_MODEL_FORMAT}'.  Expected ort or onnx")
+
+        stem = os.path.splitext(os.path.basename(model_path))[0]
+        saved_level = OnnxSessionFactory._saved_optimization_level()
+        file_name = f"{stem}.{OnnxSessionFactory._model_fingerprint(model_path)}.ort{ort.__version__}.{saved_level}.{OnnxSessionFactory.OPTIMIZED_MODEL_FORMAT}"
+        return os.path.join(OnnxSessionFactory.OPTIMIZED_MODEL_DIR or os.path.dirname(model_path), file_name)
+
+    @staticmethod
+    def _model_fingerprint(model_path: str) -> str:
+        """
+        Content hash of the model file plus the size of its side-car .data file (large exports keep their weights
+        there).  Unlike modification times this survives the upload to the models bucket, so model_export/main.py
+        can pre-build the optimized graph for the read-only bucket mount.  Must match model_export/main.py.
+
+        model_export/main.py also writes the fingerprint to a small manifest next to the model; when its recorded
+        sizes still match, the fingerprint is read from there instead of hashing the whole model over the bucket
+        mount on every cold start.
+        """
+        model_size, data_size = OnnxSessionFactory._model_sizes(model_path)
+        manifest_path = f"{model_path}{OnnxSessionFactory.FINGERPRINT_MANIFEST_SUFFIX}"
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("model_size") == model_size and manifest.get("data_size") == data_size:
+                OnnxSessionFactory._fingerprint_source = "manifest"
+                return str(manifest["fingerprint"])
+            print(f"Ignoring {manifest_path}: it was written for a different model file")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            print(f"Ignoring unreadable {manifest_path}: {e}")
+
+        OnnxSessionFactory._fingerprint_source = "hashed"
+        fingerprint = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                fingerprint.update(block)
+        if data_size is not None:
+            fingerprint.update(str(data_size).encode("utf-8"))
+        return fingerprint.hexdigest()[:12]
+
+    @staticmethod
+    def _model_sizes(model_path: str) -> tuple[int, Optional[int]]:
+        data_path = f"{model_path}.data"
+        return os.path.getsize(model_path), os.path.getsize(data_path) if os.path.exists(data_path) else None
@@ -0,0 +1,265 @@
+import os
+import asyncio
+import time
+from typing import Any, AsyncIterator, Callable, Final, Optional
+import pyarrow as pa
+from fastapi import HTTPException, Request
+from google.cloud import bigquery
+
+from app.books.helpers.bigquery_client_helper import BigQueryClientHelper
+
+class WritePendingError(Exception):
+    """
+    Raised by QueryRunner.run_write when it stopped waiting on a write that is still running in BigQuery and may yet
+    commit or roll back.  Routes answer it with 202 Accepted.
+    """
+    def __init__(self, job_id: str, timeout: float):
+        super().__init__(f"Write still running in BigQuery after {timeout:.0f} seconds (job {job_id}); it may still complete")
+        self.job_id = job_id
+        self.timeout = timeout
+
+    def to_dict(self):
+        return {"status": "pending", "job_id": self.job_id, "detail": str(self)}
+
+class QueryRunner:
+    """
+    Runs BigQuery jobs without blocking the event loop.
+
+    The job is submitted on a worker thread, then polled from the event loop (each poll is one short jobs.get on a
+    worker thread) with exponential backoff, and its rows are fetched on a worker thread once it is done.  No thread
+    is held while BigQuery works, so a worker can have many queries in flight.
+
+    At most MAX_CONCURRENT_QUERIES run at once per process; the rest wait their turn.  Only read-only queries (run,
+    run_arrow, stream_arrow) are cancelled in BigQuery when they take longer than their timeout or their caller went
+    away (the request disconnected, or the task was cancelled).  Writes go through run_write, which never cancels a
+    submitted job: once WRITE_TIMEOUT_SECONDS have passed it stops waiting and raises WritePendingError, as the
+    write may still commit.  The concurrency cap is per event loop.
+
+    run_arrow returns the rows as an Arrow table instead of Row objects.  Results of at least STORAGE_READ_MIN_ROWS
+    rows are streamed as Arrow record batches through the BigQuery Storage Read API; smaller ones come back through
+    the REST API, whose first page usually already holds them, as opening a read session would only add latency.
+    """
+    MAX_CONCURRENT_QUERIES: Final[int] = int(os.environ.get("STORYSPARK_BIGQUERY_MAX_CONCURRENT_QUERIES", "32"))
+    TIMEOUT_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_BIGQUERY_QUERY_TIMEOUT_SECONDS", "60"))
+    WRITE_TIMEOUT_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_BIGQUERY_WRITE_TIMEOUT_SECONDS", "300"))
+    # Backoff between job polls
+    POLL_INITIAL_SECONDS: Final[float] = 0.05
+    POLL_MAX_SECONDS: Final[float] = 1.0
+    STORAGE_READ_MIN_ROWS: Final[int] = int(os.environ.get("STORYSPARK_BIGQUERY_STORAGE_READ_MIN_ROWS", "5000"))
+
+    _semaphore: Optional[asyncio.Semaphore] = None
+    # The loop _semaphore belongs to; a semaphore cannot be shared between event loops
+    _semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # metrics
+    _waiting: int = 0
+    _in_flight: int = 0
+    _completed: int = 0
+    _failed: int = 0
+    _timeouts: int = 0
+    _write_timeouts: int = 0
+    _cancelled: int = 0
+    _polls: int = 0
+    _seconds: float = 0.0
+    _rest_reads: int = 0
+    _storage_reads: int = 0
+    _arrow_rows: int = 0
+
+    # ---------- public API ----------
+    @staticmethod
+    async def run(
+        bigquery_client_helper: BigQueryClientHelper,
+        query: str,
+        job_config: Optional[bigquery.QueryJobConfig] = None,
+        request: Optional[Request] = None,
+        timeout: Optional[float] = None
+        ) -> list[Any]:
+        """
+        Runs the query and returns all of its rows.  Pass the request to have the query cancelled when the client
+        disconnects (HTTPException 499); leave it out where the result is shared by several callers or must not be
+        abandoned halfway.  Raises HTTPException(504) when the query runs longer than timeout (default
+        TIMEOUT_SECONDS).
+        """
+        return await QueryRunner._run(bigquery_client_helper, query, job_config, request, timeout, lambda job: list(job.result()))
+
+    @staticmethod
+    async def run_write(
+        bigquery_client_helper: BigQueryClientHelper,
+        statement: str,
+        job_config: Optional[bigquery.QueryJobConfig] = None,
+        timeout: Optional[float] = None
+        ) -> list[Any]:
+        """
+        Runs a DML statement or transaction script and returns its rows.  The job is never cancelled, not when the
+        caller goes away and not on timeout: after timeout (default WRITE_TIMEOUT_SECONDS) this stops waiting and
+        raises WritePendingError, and the write commits or rolls back in BigQuery on its own.
+        """
+        return await QueryRunner._run(bigquery_client_helper, statement, job_config, None, timeout, lambda job: list(job.result()), write=True)
+
+    @staticmethod
+    async def run_arrow(
+        bigquery_client_helper: BigQueryClientHelper,
+        query: str,
+        job_config: Optional[bigquery.QueryJobConfig] = None,
+        request: Optional[Request] = None,
+        timeout: Optional[float] = None
+        ) -> pa.Table:
+        """
+        Like run, but returns the rows as an Arrow table.
+        """
+        return await QueryRunner._run(
+            bigquery_client_helper, query, job_config, request, timeout,
+            lambda job: QueryRunner.fetch_arrow(bigquery_client_helper, job)
+        )
+
+    @staticmethod
+    async def stream_arrow(
+        bigquery_client_helper: BigQueryClientHelper,
+        query: str,
+        job_config: Optional[bigquery.QueryJobConfig] = None,
+        request: Optional[Request] = None,
+        timeout: Optional[float] = None
+        ) -> AsyncIterator[pa.RecordBatch]:
+        """
+        Like run_arrow, but yields the rows as record batches as they are downloaded (a REST page or a Storage Read
+        API message at a time) instead of collecting them first.  The concurrency slot is only held until the job is
+        done; the download runs at the pace of whoever consumes the batches.
+        """
+        rows = await QueryRunner._run(bigquery_client_helper, query, job_config, request, timeout, lambda job: job.result())
+        batches = rows.to_arrow_iterable(bqstorage_client=QueryRunner._read_client(bigquery_client_helper, rows))
+        while True:
+            # Each step blocks on the network
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                return
+            QueryRunner._arrow_rows += batch.num_rows
+            yield batch
+
+    @staticmethod
+    def fetch_arrow(bigquery_client_helper: BigQueryClientHelper, job: bigquery.QueryJob, timeout: Optional[float] = None) -> pa.Table:
+        """
+        The rows of a query job as an Arrow table, through the Storage Read API when there are enough of them.
+        Blocking (waits for the job up to timeout); for callers already on a worker thread.
+        """
+        rows = job.result(timeout=timeout)
+        table = rows.to_arrow(bqstorage_client=QueryRunner._read_client(bigquery_client_helper, rows), create_bqstorage_client=False)
+        QueryRunner._arrow_rows += table.num_rows
+        return table
+
+    @staticmethod
+    def to_dict():
+        finished = QueryRunner._completed + QueryRunner._failed
+        return {
+            "MAX_CONCURRENT_QUERIES": QueryRunner.MAX_CONCURRENT_QUERIES,
+            "TIMEOUT_SECONDS": QueryRunner.TIMEOUT_SECONDS,
+            "waiting": QueryRunner._waiting,
+            "in_flight": QueryRunner._in_flight,
+            "completed": QueryRunner._completed,
+            "failed": QueryRunner._failed,
+            "timeouts": QueryRunner._timeouts,
+            "WRITE_TIMEOUT_SECONDS": QueryRunner.WRITE_TIMEOUT_SECONDS,
+            "write_timeouts": QueryRunner._write_timeouts,
+            "cancelled": QueryRunner._cancelled,
+            "polls_per_query": QueryRunner._polls / finished if finished else None,
+            "seconds": QueryRunner._seconds,
+            "STORAGE_READ_MIN_ROWS": QueryRunner.STORAGE_READ_MIN_ROWS,
+            "rest_reads": QueryRunner._rest_reads,
+            "storage_reads": QueryRunner._storage_reads,
+            "arrow_rows": QueryRunner._arrow_rows,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    async def _run(
+        bigquery_client_helper: BigQueryClientHelper,
+        query: str,
+        job_config: Optional[bigquery.QueryJobConfig],
+        request: Optional[Request],
+        timeout: Optional[float],
+        fetch: Callable[[bigquery.QueryJob], Any],
+        write: bool = False
+        ) -> Any:
+        """
+        A write is never cancelled; on timeout it raises WritePendingError instead of HTTPException(504).
+        """
+        if timeout is None:
+            timeout = QueryRunner.WRITE_TIMEOUT_SECONDS if write else QueryRunner.TIMEOUT_SECONDS
+        semaphore = QueryRunner._get_semaphore()
+        QueryRunner._waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            QueryRunner._waiting -= 1
+
+        QueryRunner._in_flight += 1
+        started_at = time.perf_counter()
+        job = None
+        try:
+            job = await asyncio.to_thread(bigquery_client_helper.client.query, query, job_config=job_config)
+            delay = QueryRunner.POLL_INITIAL_SECONDS
+            while not await asyncio.to_thread(job.done):
+                QueryRunner._polls += 1
+                if time.perf_counter() - started_at > timeout:
+                    if write:
+                        QueryRunner._write_timeouts += 1
+                        # Accepted, not failed: the job keeps running and may still commit
+                        raise WritePendingError(job.job_id, timeout)
+                    QueryRunner._timeouts += 1
+                    raise HTTPException(status_code=504, detail=f"Query timed out after {timeout:.0f} seconds")
+                if request is not None and await request.is_disconnected():
+                    QueryRunner._cancelled += 1
+                    # Nobody is left to read the response
+                    raise HTTPException(status_code=499, detail="Client closed the request")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, QueryRunner.POLL_MAX_SECONDS)
+
+            result = await asyncio.to_thread(fetch, job)
+            QueryRunner._completed += 1
+            job = None
+            return result
+        except asyncio.CancelledError:
+            QueryRunner._cancelled += 1
+            raise
+        except (HTTPException, WritePendingError):
+            raise
+        except Exception:
+            QueryRunner._failed += 1
+            job = None
+            raise
+        finally:
+            QueryRunner._in_flight -= 1
+            QueryRunner._seconds += time.perf_counter() - started_at
+            semaphore.release()
+            if job is not None and not write:
+                # Abandoned before it finished; stop it so it does not keep using slots
+                QueryRunner._cancel_in_background(job)
+
+    @staticmethod
+    def _read_client(bigquery_client_helper: BigQueryClientHelper, rows: bigquery.table.RowIterator):
+        """
+        The Storage Read API client if the result is large enough to be worth a read session, else None (REST).
+        """
+        read_client = bigquery_client_helper.read_client
+        if read_client is not None and (rows.total_rows or 0) >= QueryRunner.STORAGE_READ_MIN_ROWS:
+            QueryRunner._storage_reads += 1
+            return read_client
+        QueryRunner._rest_reads += 1
+        return None
+
+    @staticmethod
+    def _get_semaphore() -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if QueryRunner._semaphore is None or QueryRunner._semaphore_loop is not loop:
+            QueryRunner._semaphore = asyncio.Semaphore(QueryRunner.MAX_CONCURRENT_QUERIES)
+            QueryRunner._semaphore_loop = loop
+        return QueryRunner._semaphore
+
+    @staticmethod
+    def _cancel_in_background(job: bigquery.QueryJob):
+        def cancel():
+            try:
+                job.cancel()
+            except Exception as e:
+                print(f"Failed to cancel BigQuery job {job.job_id}: {e}")
+        # Not awaited: the caller is already on its way out (cancelled or timed out)
+        asyncio.get_running_loop().run_in_executor(None, cancel)
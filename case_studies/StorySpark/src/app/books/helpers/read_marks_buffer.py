@@ -0,0 +1,197 @@
+import os
+import asyncio
+import time
+from datetime import datetime
+from typing import Final, Optional
+import pyarrow as pa
+from google.cloud import bigquery
+
+from app.books.helpers.bigquery_client_helper import BigQueryClientHelper
+from app.books.helpers.query_runner import QueryRunner
+
+class ReadMarksBuffer:
+    """
+    Write-behind buffer for mark_read.
+
+    Marks are kept in memory, latest last_read per (owner, isbn), and written to BigQuery together in one MERGE every
+    FLUSH_INTERVAL_SECONDS, or as soon as MAX_BATCH_SIZE books are waiting, instead of one DML transaction per mark.
+    A burst of marks from a reading session becomes one job, well inside BigQuery's DML concurrency limits.
+
+    Until its MERGE has committed, a mark is visible to this instance's reads through overlay().  The MERGE never
+    moves last_read backwards, so a retried or late batch cannot undo a newer mark.  A failed flush keeps its marks
+    for the next one; stop() flushes whatever is left at shutdown.  Marks acknowledged in the last
+    FLUSH_INTERVAL_SECONDS before a crash are lost.  A FLUSH_INTERVAL_SECONDS of 0 writes every mark through.
+    """
+    FLUSH_INTERVAL_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_MARK_READ_FLUSH_INTERVAL_SECONDS", "2"))
+    MAX_BATCH_SIZE: Final[int] = int(os.environ.get("STORYSPARK_MARK_READ_MAX_BATCH_SIZE", "500"))
+
+    # (owner, isbn) -> last_read, waiting for the next flush
+    _pending: dict[tuple[str, str], datetime] = {}
+    # The batch being written right now; still part of the overlay until it has committed
+    _flushing: dict[tuple[str, str], datetime] = {}
+    _bigquery_client_helper: Optional[BigQueryClientHelper] = None
+    _worker: Optional[asyncio.Task] = None
+    _wake: Optional[asyncio.Event] = None
+    _flush_lock: Optional[asyncio.Lock] = None
+
+    # metrics
+    _marks: int = 0
+    _coalesced: int = 0
+    _flushes: int = 0
+    _flushed_rows: int = 0
+    _failed_flushes: int = 0
+    _flush_seconds: float = 0.0
+
+    # ---------- public API ----------
+    @staticmethod
+    async def mark(bigquery_client_helper: BigQueryClientHelper, owner: str, isbn: str, last_read: datetime):
+        """
+        Records the mark; it reaches BigQuery with the next flush.
+        """
+        ReadMarksBuffer._marks += 1
+        ReadMarksBuffer._bigquery_client_helper = bigquery_client_helper
+        key = (owner, isbn)
+        if key in ReadMarksBuffer._pending:
+            ReadMarksBuffer._coalesced += 1
+        ReadMarksBuffer._pending[key] = max(last_read, ReadMarksBuffer._pending.get(key, last_read))
+
+        if ReadMarksBuffer.FLUSH_INTERVAL_SECONDS <= 0:
+            await ReadMarksBuffer.flush()
+            return
+        ReadMarksBuffer._ensure_worker()
+        if len(ReadMarksBuffer._pending) >= ReadMarksBuffer.MAX_BATCH_SIZE:
+            ReadMarksBuffer._wake.set()
+
+    @staticmethod
+    def overlay(owner: str) -> dict[str, datetime]:
+        """
+        isbn -> last_read of the owner's marks not yet committed to BigQuery.  Take it before reading, so a batch that
+        commits in between is covered by either the read or the overlay.
+        """
+        overlay: dict[str, datetime] = {}
+        for marks in (ReadMarksBuffer._flushing, ReadMarksBuffer._pending):
+            for (mark_owner, isbn), last_read in marks.items():
+                if mark_owner == owner:
+                    overlay[isbn] = max(last_read, overlay.get(isbn, last_read))
+        return overlay
+
+    @staticmethod
+    def apply_overlay(rows, overlay: dict[str, datetime]):
+        """
+        A Table or RecordBatch of book rows with last_read moved forward to the overlay's marks.
+        """
+        if not overlay or not rows.num_rows:
+            return rows
+        column = rows.schema.get_field_index("last_read")
+        last_reads = rows.column(column).cast(pa.timestamp("us", tz="UTC")).to_pylist()
+        for i, isbn in enumerate(rows.column("isbn").to_pylist()):
+            marked = overlay.get(isbn)
+            if marked is not None and (last_reads[i] is None or last_reads[i] < marked):
+                last_reads[i] = marked
+        return rows.set_column(column, "last_read", pa.array(last_reads, type=pa.timestamp("us", tz="UTC")))
+
+    @staticmethod
+    async def flush():
+        """
+        Writes every pending mark in one MERGE.  On failure the marks go back to pending (behind any newer ones).
+        """
+        if ReadMarksBuffer._flush_lock is None:
+            ReadMarksBuffer._flush_lock = asyncio.Lock()
+        async with ReadMarksBuffer._flush_lock:
+            if not ReadMarksBuffer._pending:
+                return
+            batch, ReadMarksBuffer._pending = ReadMarksBuffer._pending, {}
+            ReadMarksBuffer._flushing = batch
+            started_at = time.perf_counter()
+            try:
+                await ReadMarksBuffer._merge(ReadMarksBuffer._bigquery_client_helper, batch)
+                ReadMarksBuffer._flushes += 1
+                ReadMarksBuffer._flushed_rows += len(batch)
+            except BaseException as e:
+                ReadMarksBuffer._failed_flushes += 1
+                # Also when the MERGE is only still running: it never moves last_read back, so a retry is harmless
+                print(f"Failed to flush {len(batch)} read marks; they will be retried: {e}")
+                for key, last_read in batch.items():
+                    ReadMarksBuffer._pending[key] = max(last_read, ReadMarksBuffer._pending.get(key, last_read))
+                if not isinstance(e, Exception):
+                    raise
+            finally:
+                ReadMarksBuffer._flushing = {}
+                ReadMarksBuffer._flush_seconds += time.perf_counter() - started_at
+
+    @staticmethod
+    async def stop():
+        """
+        Stops the flush worker and writes what is still pending.
+        """
+        if ReadMarksBuffer._worker is not None:
+            ReadMarksBuffer._worker.cancel()
+            try:
+                await ReadMarksBuffer._worker
+            except asyncio.CancelledError:
+                pass
+            ReadMarksBuffer._worker = None
+        await ReadMarksBuffer.flush()
+        if ReadMarksBuffer._pending:
+            print(f"{len(ReadMarksBuffer._pending)} read marks could not be written at shutdown")
+
+    @staticmethod
+    def to_dict():
+        return {
+            "FLUSH_INTERVAL_SECONDS": ReadMarksBuffer.FLUSH_INTERVAL_SECONDS,
+            "MAX_BATCH_SIZE": ReadMarksBuffer.MAX_BATCH_SIZE,
+            "pending": len(ReadMarksBuffer._pending),
+            "flushing": len(ReadMarksBuffer._flushing),
+            "marks": ReadMarksBuffer._marks,
+            "coalesced": ReadMarksBuffer._coalesced,
+            "flushes": ReadMarksBuffer._flushes,
+            "flushed_rows": ReadMarksBuffer._flushed_rows,
+            "failed_flushes": ReadMarksBuffer._failed_flushes,
+            "flush_seconds": ReadMarksBuffer._flush_seconds,
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _ensure_worker():
+        loop = asyncio.get_running_loop()
+        worker = ReadMarksBuffer._worker
+        if worker is not None and not worker.done() and worker.get_loop() is loop:
+            return
+        ReadMarksBuffer._wake = asyncio.Event()
+        ReadMarksBuffer._worker = loop.create_task(ReadMarksBuffer._run_worker())
+
+    @staticmethod
+    async def _run_worker():
+        while True:
+            try:
+                # Flush on the interval, or early once a full batch is waiting
+                await asyncio.wait_for(ReadMarksBuffer._wake.wait(), ReadMarksBuffer.FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            ReadMarksBuffer._wake.clear()
+            await ReadMarksBuffer.flush()
+
+    @staticmethod
+    async def _merge(bigquery_client_helper: BigQueryClientHelper, batch: dict[tuple[str, str], datetime]):
+        merge_statement = f"""
+        MERGE `{bigquery_client_helper.dataset_id}.{bigquery_client_helper.source_table_id}` AS t
+        USING UNNEST(@marks) AS m
+        ON t.owner = m.owner AND t.isbn = m.isbn
+        WHEN MATCHED AND (t.last_read IS NULL OR t.last_read < m.last_read) THEN
+            UPDATE SET last_read = m.last_read
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("marks", "STRUCT", [
+                    bigquery.StructQueryParameter(
+                        None,
+                        bigquery.ScalarQueryParameter("owner", "STRING", owner),
+                        bigquery.ScalarQueryParameter("isbn", "STRING", isbn),
+                        bigquery.ScalarQueryParameter("last_read", "TIMESTAMP", last_read)
+                    )
+                    for (owner, isbn), last_read in batch.items()
+                ])
+            ]
+        )
+        # Not tied to any request, and never cancelled
+        await QueryRunner.run_write(bigquery_client_helper, merge_statement, job_config=job_config)
@@ -0,0 +1,53 @@
+import os
+from typing import Any, Awaitable, Callable, Final, Optional
+
+from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+from app.books.helpers.generation_cache import GenerationCache
+
+class RecommendationCache:
+    """
+    Bounded TTL + LRU cache of recommendation results keyed by (owner, normalized text, limit, search mode).
+
+    Identical queries that arrive while one is being computed wait for that computation instead of starting their
+    own (single-flight).  Every write to an owner's books bumps the owner's generation, which makes all of their
+    cached results, and any computation that started before the write, stale at once.  The TTL bounds staleness
+    from writes made through other instances.  See GenerationCache.
+    """
+    MAX_ENTRIES: Final[int] = int(os.environ.get("STORYSPARK_RECOMMENDATION_CACHE_MAX_ENTRIES", "4096"))
+    TTL_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_RECOMMENDATION_CACHE_TTL_SECONDS", "60"))
+
+    _cache: GenerationCache = GenerationCache(max_entries=MAX_ENTRIES, ttl_seconds=TTL_SECONDS)
+
+    # ---------- public API ----------
+    @staticmethod
+    async def get_or_compute(owner: str, text: str, limit: int, search_mode: Optional[str], compute: Callable[[], Awaitable[Any]]) -> Any:
+        key = (RecommendationCache._normalize(text), limit, search_mode)
+        # Every caller gets its own list
+        return list(await RecommendationCache._cache.get_or_compute(owner, key, compute))
+
+    @staticmethod
+    def invalidate(owner: Optional[str] = None):
+        """
+        Makes one owner's results stale, or everyone's when owner is None.
+        """
+        RecommendationCache._cache.invalidate(owner)
+
+    @staticmethod
+    def to_dict():
+        return {
+            "MAX_ENTRIES": RecommendationCache.MAX_ENTRIES,
+            "TTL_SECONDS": RecommendationCache.TTL_SECONDS,
+            **RecommendationCache._cache.to_dict(),
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _normalize(text: str) -> str:
+        """
+        Texts that embed identically share an entry: the tokenizer's own normalization (e.g. lower-casing) once it
+        is loaded, plus collapsed whitespace.
+        """
+        tokenizer = EmbeddingsGenerator._tokenizer
+        if tokenizer is not None and tokenizer.normalizer is not None:
+            text = tokenizer.normalizer.normalize_str(text)
+        return " ".join(text.split())
@@ -0,0 +1,835 @@
+import os
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Final, Optional
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from google.cloud import bigquery
+
+from app.books.helpers.bigquery_client_helper import BigQueryClientHelper
+from app.books.helpers.embedding_snapshots import EmbeddingSnapshots
+from app.books.helpers.embeddings_worker_pool import EmbeddingsWorkerPool
+from app.books.helpers.hnsw_index import HnswIndex
+from app.books.helpers.lexical_index import LexicalIndex
+from app.books.helpers.query_runner import QueryRunner
+
+SEARCH_MODES: Final[tuple[str, ...]] = ("exact", "approximate", "two_stage", "hybrid")
+
+@dataclass
+class VectorMatch:
+    isbn: str
+    content: str
+    # None for keyword matches found without embedding the query
+    cosine_similarity: Optional[float]
+
+class OwnerVectorIndex:
+    """
+    All embedding rows of one owner's books as one contiguous float32 matrix.
+
+    Rows of the same ISBN are kept next to each other (group_starts[i] is where ISBN i's rows start), so the best
+    row per ISBN is a single np.maximum.reduceat over the scores.  Embeddings are L2 normalized, so the dot product
+    is the cosine similarity.
+
+    centroids[i] is the normalized mean of ISBN i's rows, one compact vector per book, used by search_two_stage
+    to pick the books worth scoring in full.  The BM25 index over the row contents is built on first use and
+    dropped whenever rows are added or removed.
+    """
+    def __init__(self, isbns: list[str], group_starts: np.ndarray, contents: list[str], matrix: np.ndarray):
+        self.isbns = isbns
+        self._isbn_set = set(isbns)
+        self.group_starts = group_starts
+        self.contents = contents
+        self.matrix = matrix
+        self.centroids = OwnerVectorIndex._centroids(matrix, group_starts)
+        self.loaded_at = time.monotonic()
+        # Bumped on every add/remove; the ANN graph is current when ann_version matches
+        self.version = 0
+        self.ann: Optional[HnswIndex] = None
+        self.ann_version = -1
+        # Last version a sync was started for, so one that could not produce a graph is not retried every query
+        self.ann_attempted_version = -1
+        self.lexical: Optional[LexicalIndex] = None
+        # Version the lexical index was built from; it is current when this matches version
+        self.lexical_version = -1
+
+    @staticmethod
+    def from_rows(rows: list[tuple[str, str, np.ndarray]], dim: Optional[int] = None) -> "OwnerVectorIndex":
+        """
+        rows: (isbn, content, embedding_normalized), grouped by ISBN or not.
+        """
+        rows = sorted(rows, key=lambda row: row[0])
+        if dim is None:
+            dim = rows[0][2].shape[0] if rows else 0
+
+        isbns: list[str] = []
+        starts: list[int] = []
+        for i, (isbn, _, _) in enumerate(rows):
+            if not isbns or isbns[-1] != isbn:
+                isbns.append(isbn)
+                starts.append(i)
+
+        matrix = np.empty((len(rows), dim), dtype=np.float32)
+        for i, (_, _, embedding) in enumerate(rows):
+            matrix[i] = embedding
+        return OwnerVectorIndex(
+            isbns=isbns,
+            group_starts=np.asarray(starts, dtype=np.int64),
+            contents=[content for _, content, _ in rows],
+            matrix=matrix,
+        )
+
+    @staticmethod
+    def from_arrow(table: pa.Table, dim: int) -> "OwnerVectorIndex":
+        """
+        table: isbn, content and embedding_normalized (lists of exactly dim values) columns, grouped by ISBN or
+        not.  The matrix is one cast of the flat Arrow values buffer, with no Python object per vector or value.
+        """
+        # Stable, so rows of an ISBN keep their order as in from_rows
+        table = table.take(pc.sort_indices(table, sort_keys=[("isbn", "ascending")]))
+        isbn_column = table.column("isbn").to_pylist()
+
+        isbns: list[str] = []
+        starts: list[int] = []
+        for i, isbn in enumerate(isbn_column):
+            if not isbns or isbns[-1] != isbn:
+                isbns.append(isbn)
+                starts.append(i)
+
+        values = pc.list_flatten(table.column("embedding_normalized")).to_numpy()
+        return OwnerVectorIndex(
+            isbns=isbns,
+            group_starts=np.asarray(starts, dtype=np.int64),
+            contents=table.column("content").to_pylist(),
+            matrix=values.astype(np.float32).reshape(table.num_rows, dim),
+        )
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    def __contains__(self, isbn: str) -> bool:
+        return isbn in self._isbn_set
+
+    def search(self, query: np.ndarray, limit: int) -> list[VectorMatch]:
+        """
+        Top `limit` ISBNs by their best-matching row, best first.
+        """
+        return self.search_many(np.asarray(query, dtype=np.float32)[None, :], limit)[0]
+
+    def search_many(self, queries: np.ndarray, limit: int) -> list[list[VectorMatch]]:
+        """
+        search() for a (Q, D) batch of queries, scored in one matrix-matrix product.
+        """
+        if len(self) == 0 or limit <= 0:
+            return [[] for _ in range(queries.shape[0])]
+        scores = self.matrix @ np.asarray(queries, dtype=np.float32).T  # (N, Q)
+        best = np.maximum.reduceat(scores, self.group_starts, axis=0)  # (ISBNs, Q)
+
+        results = []
+        for q in range(scores.shape[1]):
+            top = _top_k(best[:, q], limit)
+            matches = []
+            for group in top:
+                start, end = self._group_bounds(group)
+                row = start + int(np.argmax(scores[start:end, q]))
+                matches.append(VectorMatch(isbn=self.isbns[group], content=self.contents[row], cosine_similarity=float(scores[row, q])))
+            results.append(matches)
+        return results
+
+    def search_two_stage(self, queries: np.ndarray, limit: int, candidates: int) -> tuple[list[list[VectorMatch]], int]:
+        """
+        search_many() in two stages: rank books by centroid similarity, then score every row of only the best
+        `candidates` books (at least `limit`) and rank those by their best row.  A book whose best row matches well
+        but whose rows are otherwise far from the query can be missed, so this trades a little recall for scoring
+        about candidates * rows-per-book + books vectors per query instead of all of them.
+
+        Returns the matches and how many vectors were scored.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        candidates = max(candidates, limit)
+        if len(self) == 0 or limit <= 0 or candidates >= len(self.isbns):
+            # Nothing to prune
+            return self.search_many(queries, limit), len(self) * queries.shape[0]
+
+        centroid_scores = self.centroids @ queries.T  # (ISBNs, Q)
+        results = []
+        scored = centroid_scores.size
+        for q in range(queries.shape[0]):
+            groups = np.argpartition(-centroid_scores[:, q], candidates - 1)[:candidates]
+            best, best_rows = self._score_groups(queries[q], groups)
+            scored += int(self._group_lengths(groups).sum())
+            results.append([
+                VectorMatch(isbn=self.isbns[groups[i]], content=self.contents[best_rows[i]], cosine_similarity=float(best[i]))
+                for i in _top_k(best, limit)
+            ])
+        return results, scored
+
+    def search_lexical(self, terms: list[str], limit: int) -> list[VectorMatch]:
+        """
+        Top `limit` ISBNs by the BM25 score of their best row, without any vector.  Needs lexical_is_current().
+        """
+        if len(self) == 0 or limit <= 0:
+            return []
+        scores = self.lexical.score(terms)
+        best = np.maximum.reduceat(scores, self.group_starts)
+        matches = []
+        for group in _top_k(best, limit):
+            if best[group] <= 0:
+                break
+            start, end = self._group_bounds(group)
+            row = start + int(np.argmax(scores[start:end]))
+            matches.append(VectorMatch(isbn=self.isbns[group], content=self.contents[row], cosine_similarity=None))
+        return matches
+
+    def search_hybrid(self, query: np.ndarray, terms: list[str], limit: int, candidates: int, rrf_k: int) -> tuple[list[VectorMatch], int]:
+        """
+        Fuses lexical and vector ranking with reciprocal rank fusion (score = sum of 1 / (rrf_k + rank)).
+
+        Candidates are the best `candidates` books by BM25 plus the best `candidates` by centroid similarity; only
+        their rows are scored against the query.  Needs lexical_is_current().  Returns the matches and how many
+        vectors were scored.
+        """
+        if len(self) == 0 or limit <= 0:
+            return [], 0
+        query = np.asarray(query, dtype=np.float32)
+        candidates = max(candidates, limit)
+
+        lexical_best = np.maximum.reduceat(self.lexical.score(terms), self.group_starts)
+        lexical_groups = _top_k(lexical_best, candidates)
+        lexical_groups = lexical_groups[lexical_best[lexical_groups] > 0]
+        centroid_scores = self.centroids @ query
+        vector_groups = _top_k(centroid_scores, candidates)
+        groups = np.union1d(lexical_groups, vector_groups)
+
+        best, best_rows = self._score_groups(query, groups)
+        fused = np.zeros(len(groups), dtype=np.float64)
+        fused[_top_k(best, len(groups))] += 1.0 / (rrf_k + np.arange(1, len(groups) + 1))
+        lexical_order = _top_k(lexical_best[groups], len(groups))
+        lexical_order = lexical_order[lexical_best[groups][lexical_order] > 0]
+        fused[lexical_order] += 1.0 / (rrf_k + np.arange(1, len(lexical_order) + 1))
+
+        matches = [
+            VectorMatch(isbn=self.isbns[groups[i]], content=self.contents[best_rows[i]], cosine_similarity=float(best[i]))
+            for i in _top_k(fused, limit)
+        ]
+        return matches, len(self.centroids) + int(self._group_lengths(groups).sum())
+
+    def build_lexical(self) -> LexicalIndex:
+        """
+        The BM25 index of the current rows, building it if needed.  CPU bound; callers run it on a worker thread.
+        Rows can be added or removed meanwhile, so the result is only kept as self.lexical if the version did not
+        change; check lexical_is_current() on the event loop before scoring.
+        """
+        version = self.version
+        contents = self.contents
+        if self.lexical_is_current():
+            return self.lexical
+        lexical = LexicalIndex(contents)
+        if self.version == version and lexical.rows == len(self):
+            self.lexical = lexical
+            self.lexical_version = version
+        return lexical
+
+    def lexical_is_current(self) -> bool:
+        lexical = self.lexical
+        return lexical is not None and self.lexical_version == self.version and lexical.rows == len(self)
+
+    def search_approximate(self, query: np.ndarray, limit: int, ef: Optional[int] = None) -> list[VectorMatch]:
+        """
+        Same result shape as search, from the HNSW graph.  Several rows of one ISBN can be near the query, so more
+        rows than `limit` are fetched before taking the best row per ISBN.
+        """
+        if limit <= 0:
+            return []
+        ef = ef or self.ann.ef_search
+        best: dict[str, tuple[int, float]] = {}
+        for node, sim in self.ann.search(query, k=max(ef, 4 * limit), ef=max(ef, 4 * limit)):
+            isbn = self.ann.isbns[node]
+            # The graph can still hold a book removed since it was last synced
+            if isbn in self and (isbn not in best or sim > best[isbn][1]):
+                best[isbn] = (node, sim)
+        ranked = sorted(best.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            VectorMatch(isbn=isbn, content=self.ann.contents[node], cosine_similarity=sim)
+            for isbn, (node, sim) in ranked
+        ]
+
+    def rows_for(self, isbn: str) -> list[tuple[str, str, np.ndarray]]:
+        group = self.isbns.index(isbn)
+        start, end = self._group_bounds(group)
+        return [(isbn, self.contents[row], self.matrix[row]) for row in range(start, end)]
+
+    def add(self, rows: list[tuple[str, str, np.ndarray]]):
+        """
+        Appends rows of ISBNs that are not in the index yet (an ISBN's embeddings are always written together).
+        """
+        rows = [row for row in rows if row[0] not in self]
+        if not rows:
+            return
+        added = OwnerVectorIndex.from_rows(rows, dim=self.matrix.shape[1] if len(self) else None)
+        self.group_starts = np.concatenate([self.group_starts, added.group_starts + len(self)])
+        self.isbns = self.isbns + added.isbns
+        self._isbn_set.update(added.isbns)
+        self.contents = self.contents + added.contents
+        self.matrix = np.concatenate([self.matrix, added.matrix]) if len(self) else added.matrix
+        self.centroids = np.concatenate([self.centroids, added.centroids]) if len(self.centroids) else added.centroids
+        self.lexical = None
+        self.version += 1
+
+    def remove(self, isbn: str):
+        if isbn not in self:
+            return
+        group = self.isbns.index(isbn)
+        start, end = self._group_bounds(group)
+        self.matrix = np.delete(self.matrix, np.s_[start:end], axis=0)
+        self.contents = self.contents[:start] + self.contents[end:]
+        self.isbns = self.isbns[:group] + self.isbns[group + 1:]
+        self._isbn_set.discard(isbn)
+        self.group_starts = np.concatenate([self.group_starts[:group], self.group_starts[group + 1:] - (end - start)])
+        self.centroids = np.delete(self.centroids, group, axis=0)
+        self.lexical = None
+        self.version += 1
+
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.centroids.nbytes
+
+    def _group_lengths(self, groups: np.ndarray) -> np.ndarray:
+        return np.append(self.group_starts[1:], len(self))[groups] - self.group_starts[groups]
+
+    def _score_groups(self, query: np.ndarray, groups: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Scores every row of the given ISBN groups.  Returns each group's best similarity and the row it came from.
+        """
+        starts = self.group_starts[groups]
+        lengths = self._group_lengths(groups)
+        local_starts = np.cumsum(lengths) - lengths
+        # Row numbers of the groups, each group's rows still contiguous
+        rows = np.arange(int(lengths.sum())) + np.repeat(starts - local_starts, lengths)
+        scores = self.matrix[rows] @ query
+        best = np.maximum.reduceat(scores, local_starts)
+        best_rows = np.array(
+            [rows[start + int(np.argmax(scores[start:start + length]))] for start, length in zip(local_starts.tolist(), lengths.tolist())],
+            dtype=np.int64,
+        )
+        return best, best_rows
+
+    @staticmethod
+    def _centroids(matrix: np.ndarray, group_starts: np.ndarray) -> np.ndarray:
+        if len(group_starts) == 0:
+            return np.empty((0, matrix.shape[1]), dtype=np.float32)
+        sums = np.add.reduceat(matrix, group_starts, axis=0)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # The mean of unit vectors is shorter than 1; normalizing it makes the centroid score a cosine again
+        return (sums / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    def _group_bounds(self, group: int) -> tuple[int, int]:
+        start = int(self.group_starts[group])
+        end = int(self.group_starts[group + 1]) if group + 1 < len(self.group_starts) else len(self)
+        return start, end
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, highest first.
+    """
+    k = min(k, scores.shape[0])
+    top = np.argpartition(-scores, k - 1)[:k] if k < scores.shape[0] else np.arange(scores.shape[0])
+    return top[np.argsort(-scores[top], kind="stable")]
+
+class VectorIndex:
+    """
+    In-process, per-owner vector index that get_recommendation ranks against instead of scanning the
+    embeddings table in BigQuery on every query.
+
+    An owner's index is loaded from BigQuery the first time it is needed and kept (LRU over owners) until it is
+    TTL_SECONDS old, after which the next query reloads it; that picks up books added through other instances.
+    Books added or removed through this instance are applied to a loaded index right away.  With
+    STORYSPARK_EMBEDDING_SNAPSHOT_DIR set, loads map the owner's snapshot files (see EmbeddingSnapshots) and only
+    read what changed since from BigQuery.
+
+    "approximate" search uses an HNSW graph per owner instead of scoring every row.  The graph is built (or brought
+    up to date with added/removed books) in the background on an EmbeddingsWorkerPool process, never in the API
+    process, and with HNSW_DIR set, saved to disk so restarts and reloads only insert what changed.  Until an
+    owner's graph is current, approximate queries are answered exactly, so they never wait on a build and never
+    miss a newly added book.
+
+    "two_stage" prefilters books by their centroid and only scores every row of the best CENTROID_CANDIDATES.
+
+    "hybrid" adds a BM25 index over the row contents.  Short queries whose words all occur in the owner's library
+    (e.g. "canoe", "dinosaurs") are answered from it alone, without embedding the query.  Other queries score the
+    rows of the best HYBRID_CANDIDATES books by BM25 and by centroid, and fuse both rankings.
+    """
+    # How long a loaded index is trusted before it is reloaded from BigQuery
+    TTL_SECONDS: Final[float] = float(os.environ.get("STORYSPARK_VECTOR_INDEX_TTL_SECONDS", "300"))
+    # How many owners' indexes are kept in memory
+    MAX_OWNERS: Final[int] = int(os.environ.get("STORYSPARK_VECTOR_INDEX_MAX_OWNERS", "256"))
+    # exact or approximate, when the request does not say
+    SEARCH_MODE: Final[str] = os.environ.get("STORYSPARK_RECOMMENDATION_SEARCH_MODE", "exact").strip().lower()
+
+    # HNSW: links per node, beam width while building and while searching (higher = better recall, slower)
+    HNSW_M: Final[int] = int(os.environ.get("STORYSPARK_HNSW_M", "16"))
+    HNSW_EF_CONSTRUCTION: Final[int] = int(os.environ.get("STORYSPARK_HNSW_EF_CONSTRUCTION", "100"))
+    HNSW_EF_SEARCH: Final[int] = int(os.environ.get("STORYSPARK_HNSW_EF_SEARCH", "64"))
+    # Directory for saved graphs.  Unset keeps them in memory only.
+    HNSW_DIR: Final[Optional[str]] = os.environ.get("STORYSPARK_HNSW_DIR") or None
+    # Rebuild a graph from scratch once this share of its nodes are tombstones of removed books
+    HNSW_MAX_TOMBSTONE_RATIO: Final[float] = float(os.environ.get("STORYSPARK_HNSW_MAX_TOMBSTONE_RATIO", "0.3"))
+    # two_stage: how many books, by centroid similarity, get all of their rows scored
+    CENTROID_CANDIDATES: Final[int] = int(os.environ.get("STORYSPARK_CENTROID_CANDIDATES", "50"))
+    # hybrid: books taken from each of the lexical and the centroid ranking, and the reciprocal rank fusion constant
+    HYBRID_CANDIDATES: Final[int] = int(os.environ.get("STORYSPARK_HYBRID_CANDIDATES", "50"))
+    HYBRID_RRF_K: Final[int] = int(os.environ.get("STORYSPARK_HYBRID_RRF_K", "60"))
+    # hybrid: queries of at most this many words, all of them in the library, skip the embedding.  0 never skips it.
+    KEYWORD_QUERY_MAX_TERMS: Final[int] = int(os.environ.get("STORYSPARK_KEYWORD_QUERY_MAX_TERMS", "2"))
+
+    _owners: "OrderedDict[str, OwnerVectorIndex]" = OrderedDict()
+    # In-flight loads, so concurrent queries for the same owner share one BigQuery read
+    _loading: dict[str, asyncio.Task] = {}
+    # Bumped by every change to an owner's books (_epoch: to everyone's), so a load that raced with a change is not kept
+    _versions: dict[str, int] = {}
+    _epoch: int = 0
+    # In-flight HNSW builds/syncs
+    _ann_tasks: dict[str, asyncio.Task] = {}
+
+    # metrics
+    _loads: int = 0
+    _load_seconds: float = 0.0
+    _hits: int = 0
+    _evictions: int = 0
+    _searches: int = 0
+    _search_seconds: float = 0.0
+    _approximate_searches: int = 0
+    _approximate_search_seconds: float = 0.0
+    _approximate_fallbacks: int = 0
+    _two_stage_searches: int = 0
+    _two_stage_search_seconds: float = 0.0
+    _two_stage_vectors_scored: int = 0
+    _hybrid_searches: int = 0
+    _hybrid_search_seconds: float = 0.0
+    _hybrid_vectors_scored: int = 0
+    _keyword_searches: int = 0
+    _lexical_builds: int = 0
+    _lexical_build_seconds: float = 0.0
+    _ann_syncs: int = 0
+    _ann_sync_seconds: float = 0.0
+    _ann_unavailable: int = 0
+
+    # ---------- public API ----------
+    @staticmethod
+    async def search(bigquery_client_helper: BigQueryClientHelper, owner: str, query: np.ndarray, limit: int, mode: Optional[str] = None) -> list[VectorMatch]:
+        return (await VectorIndex.search_many(bigquery_client_helper, owner, np.asarray(query, dtype=np.float32)[None, :], limit, mode=mode))[0]
+
+    @staticmethod
+    async def search_many(bigquery_client_helper: BigQueryClientHelper, owner: str, queries: np.ndarray, limit: int, mode: Optional[str] = None) -> list[list[VectorMatch]]:
+        """
+        search() for a (Q, D) batch of queries against the same owner.  Exact search scores them all in one pass.
+        """
+        mode = mode or VectorIndex.SEARCH_MODE
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}'.  Expected one of {SEARCH_MODES}")
+        if mode == "hybrid":
+            raise ValueError("hybrid search needs the query texts; use search_hybrid")
+        index = await VectorIndex.get(bigquery_client_helper, owner)
+
+        if mode == "approximate":
+            if VectorIndex._ann_is_current(owner, index):
+                started_at = time.perf_counter()
+                results = [index.search_approximate(query, limit) for query in queries]
+                VectorIndex._approximate_searches += len(results)
+                VectorIndex._approximate_search_seconds += time.perf_counter() - started_at
+                return results
+            VectorIndex._approximate_fallbacks += queries.shape[0]
+
+        if mode == "two_stage":
+            started_at = time.perf_counter()
+            results, scored = index.search_two_stage(queries, limit, VectorIndex.CENTROID_CANDIDATES)
+            VectorIndex._two_stage_searches += len(results)
+            VectorIndex._two_stage_search_seconds += time.perf_counter() - started_at
+            VectorIndex._two_stage_vectors_scored += scored
+            return results
+
+        started_at = time.perf_counter()
+        results = index.search_many(queries, limit)
+        VectorIndex._searches += len(results)
+        VectorIndex._search_seconds += time.perf_counter() - started_at
+        return results
+
+    @staticmethod
+    async def search_hybrid(
+        bigquery_client_helper: BigQueryClientHelper,
+        owner: str,
+        texts: list[str],
+        limit: int,
+        embed: Callable[[list[str]], Awaitable[np.ndarray]]
+        ) -> list[list[VectorMatch]]:
+        """
+        Hybrid lexical + vector search for each text.  embed returns the (Q, D) normalized embeddings of the texts
+        it is given and is only called for texts that are not keyword queries (not at all if none are).
+        """
+        index = await VectorIndex.get(bigquery_client_helper, owner)
+        lexical = await VectorIndex._lexical(index)
+
+        terms = [LexicalIndex.tokenize(text) for text in texts]
+        keyword = [
+            0 < len(text_terms) <= VectorIndex.KEYWORD_QUERY_MAX_TERMS and all(term in lexical for term in text_terms)
+            for text_terms in terms
+        ]
+        to_embed = [i for i, is_keyword in enumerate(keyword) if not is_keyword]
+        queries = await embed([texts[i] for i in to_embed]) if to_embed else None
+        query_rows = {i: row for row, i in enumerate(to_embed)}
+        while not index.lexical_is_current():
+            # Books were added or removed while we embedded (or built); score against the current rows
+            await VectorIndex._lexical(index)
+
+        started_at = time.perf_counter()
+        results: list[list[VectorMatch]] = []
+        for i, text_terms in enumerate(terms):
+            if keyword[i]:
+                VectorIndex._keyword_searches += 1
+                results.append(index.search_lexical(text_terms, limit))
+                continue
+            matches, scored = index.search_hybrid(
+                queries[query_rows[i]], text_terms, limit, VectorIndex.HYBRID_CANDIDATES, VectorIndex.HYBRID_RRF_K
+            )
+            VectorIndex._hybrid_vectors_scored += scored
+            results.append(matches)
+        VectorIndex._hybrid_searches += len(results)
+        VectorIndex._hybrid_search_seconds += time.perf_counter() - started_at
+        return results
+
+    @staticmethod
+    async def get(bigquery_client_helper: BigQueryClientHelper, owner: str) -> OwnerVectorIndex:
+        index = VectorIndex._owners.get(owner)
+        if index is not None and time.monotonic() - index.loaded_at < VectorIndex.TTL_SECONDS:
+            VectorIndex._owners.move_to_end(owner)
+            VectorIndex._hits += 1
+            return index
+
+        task = VectorIndex._loading.get(owner)
+        if task is None:
+            task = asyncio.create_task(VectorIndex._load(bigquery_client_helper, owner))
+            VectorIndex._loading[owner] = task
+            task.add_done_callback(lambda _: VectorIndex._loading.pop(owner, None))
+        # shield: one caller going away must not cancel the load the others are waiting on
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def add_books(owner: str, isbns: list[str], rows: list[tuple[str, str, np.ndarray]]):
+        """
+        The owner now has these ISBNs.  rows are (isbn, content, embedding_normalized) for ISBNs whose embeddings
+        were just generated; for the others the rows are borrowed from another owner's loaded index.  If neither
+        has them, the owner's index is dropped and reloaded on the next query.
+        """
+        VectorIndex._bump(owner)
+        index = VectorIndex._owners.get(owner)
+        if index is None:
+            return
+
+        rows = list(rows)
+        have = {isbn for isbn, _, _ in rows}
+        for isbn in isbns:
+            if isbn in have or isbn in index:
+                continue
+            donor = next((other for other in VectorIndex._owners.values() if isbn in other), None)
+            if donor is None:
+                VectorIndex.invalidate(owner)
+                return
+            rows.extend(donor.rows_for(isbn))
+        index.add([row for row in rows if row[0] in isbns])
+
+    @staticmethod
+    def remove_book(owner: str, isbn: str):
+        VectorIndex._bump(owner)
+        index = VectorIndex._owners.get(owner)
+        if index is not None:
+            index.remove(isbn)
+
+    @staticmethod
+    def invalidate(owner: Optional[str] = None):
+        """
+        Drops one owner's index, or every index when owner is None.
+        """
+        if owner is None:
+            VectorIndex._epoch += 1
+            VectorIndex._owners.clear()
+            return
+        VectorIndex._bump(owner)
+        VectorIndex._owners.pop(owner, None)
+
+    @staticmethod
+    def to_dict():
+        return {
+            "TTL_SECONDS": VectorIndex.TTL_SECONDS,
+            "MAX_OWNERS": VectorIndex.MAX_OWNERS,
+            "owners": len(VectorIndex._owners),
+            "rows": sum(len(index) for index in VectorIndex._owners.values()),
+            "bytes": sum(index.nbytes() for index in VectorIndex._owners.values()),
+            # Matrices served straight from snapshot files, i.e. shared with other workers through the page cache
+            "mapped_bytes": sum(index.matrix.nbytes for index in VectorIndex._owners.values() if isinstance(index.matrix, np.memmap)),
+            "loads": VectorIndex._loads,
+            "load_seconds": VectorIndex._load_seconds,
+            "hits": VectorIndex._hits,
+            "evictions": VectorIndex._evictions,
+            "searches": VectorIndex._searches,
+            "search_ms_mean": VectorIndex._search_seconds / VectorIndex._searches * 1000.0 if VectorIndex._searches else None,
+            "SEARCH_MODE": VectorIndex.SEARCH_MODE,
+            "HNSW_M": VectorIndex.HNSW_M,
+            "HNSW_EF_CONSTRUCTION": VectorIndex.HNSW_EF_CONSTRUCTION,
+            "HNSW_EF_SEARCH": VectorIndex.HNSW_EF_SEARCH,
+            "HNSW_DIR": VectorIndex.HNSW_DIR,
+            "approximate_searches": VectorIndex._approximate_searches,
+            "approximate_search_ms_mean": VectorIndex._approximate_search_seconds / VectorIndex._approximate_searches * 1000.0 if VectorIndex._approximate_searches else None,
+            "approximate_fallbacks": VectorIndex._approximate_fallbacks,
+            "ann_syncs": VectorIndex._ann_syncs,
+            "ann_sync_seconds": VectorIndex._ann_sync_seconds,
+            "ann_unavailable": VectorIndex._ann_unavailable,
+            "CENTROID_CANDIDATES": VectorIndex.CENTROID_CANDIDATES,
+            "two_stage_searches": VectorIndex._two_stage_searches,
+            "two_stage_search_ms_mean": VectorIndex._two_stage_search_seconds / VectorIndex._two_stage_searches * 1000.0 if VectorIndex._two_stage_searches else None,
+            "two_stage_vectors_scored_mean": VectorIndex._two_stage_vectors_scored / VectorIndex._two_stage_searches if VectorIndex._two_stage_searches else None,
+            "HYBRID_CANDIDATES": VectorIndex.HYBRID_CANDIDATES,
+            "HYBRID_RRF_K": VectorIndex.HYBRID_RRF_K,
+            "KEYWORD_QUERY_MAX_TERMS": VectorIndex.KEYWORD_QUERY_MAX_TERMS,
+            "hybrid_searches": VectorIndex._hybrid_searches,
+            "hybrid_search_ms_mean": VectorIndex._hybrid_search_seconds / VectorIndex._hybrid_searches * 1000.0 if VectorIndex._hybrid_searches else None,
+            # Searches answered from the lexical index alone, i.e. ONNX calls saved
+            "keyword_searches": VectorIndex._keyword_searches,
+            "hybrid_vectors_scored_mean": VectorIndex._hybrid_vectors_scored / (VectorIndex._hybrid_searches - VectorIndex._keyword_searches) if VectorIndex._hybrid_searches > VectorIndex._keyword_searches else None,
+            "lexical_builds": VectorIndex._lexical_builds,
+            "lexical_build_seconds": VectorIndex._lexical_build_seconds,
+            "ann_nodes": sum(index.ann.count for index in VectorIndex._owners.values() if index.ann is not None),
+        }
+
+    # ---------- helpers ----------
+    @staticmethod
+    def _bump(owner: str):
+        VectorIndex._versions[owner] = VectorIndex._versions.get(owner, 0) + 1
+
+    @staticmethod
+    async def _load(bigquery_client_helper: BigQueryClientHelper, owner: str) -> OwnerVectorIndex:
+        version = (VectorIndex._epoch, VectorIndex._versions.get(owner, 0))
+        started_at = time.perf_counter()
+        index = await asyncio.to_thread(VectorIndex._read_index, bigquery_client_helper, owner)
+        VectorIndex._loads += 1
+        VectorIndex._load_seconds += time.perf_counter() - started_at
+
+        if (VectorIndex._epoch, VectorIndex._versions.get(owner, 0)) != version:
+            # The owner's books changed while we were reading; serve this result but do not keep it
+            return index
+        previous = VectorIndex._owners.get(owner)
+        if previous is not None and previous.ann is not None:
+            # Keep the graph; the next sync only inserts/tombstones what changed
+            index.ann = previous.ann
+        VectorIndex._owners[owner] = index
+        VectorIndex._owners.move_to_end(owner)
+        while len(VectorIndex._owners) > VectorIndex.MAX_OWNERS:
+            VectorIndex._owners.popitem(last=False)
+            VectorIndex._evictions += 1
+        return index
+
+    @staticmethod
+    def _read_index(bigquery_client_helper: BigQueryClientHelper, owner: str, compact: bool = False) -> OwnerVectorIndex:
+        """
+        Runs on a worker thread.  Without snapshots, reads all of the owner's rows from BigQuery.  With them, maps
+        the owner's snapshot and reads only the rows of books it does not have (or that were re-embedded since its
+        watermark), saving those as a delta; books the owner no longer has are left out.  compact forces the
+        snapshot to be rewritten as a single base.
+        """
+        if not EmbeddingSnapshots.enabled():
+            index, _, _ = VectorIndex._read_rows(bigquery_client_helper, owner)
+            return index
+
+        snapshot = EmbeddingSnapshots.load(owner)
+        segments = [snapshot.base] + snapshot.deltas if snapshot is not None else []
+        known = sorted({isbn for segment in segments for isbn in segment.isbns})
+        dim = snapshot.base.matrix.shape[1] if snapshot is not None and len(snapshot.base.matrix) else None
+        fresh, current, watermark = VectorIndex._read_rows(
+            bigquery_client_helper, owner, known_isbns=known, watermark=snapshot.watermark if snapshot is not None else None, dim=dim
+        )
+
+        if snapshot is None:
+            EmbeddingSnapshots.write_base(owner, 0, fresh.isbns, fresh.group_starts, fresh.contents, fresh.matrix, watermark)
+            return fresh
+
+        # Keep, newest segment first, the groups of books the owner still has and that were not re-read just now
+        taken = set(fresh.isbns)
+        kept: list[tuple["EmbeddingSnapshots.Segment", list[int]]] = []
+        for segment in reversed(segments):
+            groups = [group for group, isbn in enumerate(segment.isbns) if isbn in current and isbn not in taken]
+            taken.update(segment.isbns[group] for group in groups)
+            kept.append((segment, groups))
+        kept.reverse()
+
+        if len(fresh) == 0 and not snapshot.deltas and len(kept[0][1]) == len(snapshot.base.isbns) and not compact:
+            # Unchanged: serve straight from the mapping, shared with every other worker
+            base = snapshot.base
+            return OwnerVectorIndex(isbns=list(base.isbns), group_starts=base.group_starts, contents=list(base.contents), matrix=base.matrix)
+
+        generation: Optional[int] = snapshot.generation
+        if len(fresh):
+            # None if another worker changed the snapshot meanwhile; it is then left to that worker
+            generation = EmbeddingSnapshots.append_delta(owner, snapshot.generation, fresh.isbns, fresh.group_starts, fresh.contents, fresh.matrix, watermark)
+        index = VectorIndex._merge_segments(kept, fresh)
+
+        dead_rows = sum(len(segment.matrix) for segment in segments) - (len(index) - len(fresh))
+        if generation is not None and (compact or EmbeddingSnapshots.needs_compaction(snapshot, dead_rows)):
+            EmbeddingSnapshots.write_base(owner, generation, index.isbns, index.group_starts, index.contents, index.matrix, watermark)
+        return index
+
+    @staticmethod
+    def _merge_segments(kept: list[tuple["EmbeddingSnapshots.Segment", list[int]]], fresh: OwnerVectorIndex) -> OwnerVectorIndex:
+        """
+        One index (in private memory) of the kept groups of each segment plus the freshly read rows.
+        """
+        isbns: list[str] = []
+        contents: list[str] = []
+        starts: list[int] = []
+        matrices: list[np.ndarray] = []
+        offset = 0
+        for segment, groups in kept + [(fresh, list(range(len(fresh.isbns))))]:
+            if not groups:
+                continue
+            ends = np.append(segment.group_starts[1:], len(segment.matrix))
+            rows = np.concatenate([np.arange(segment.group_starts[group], ends[group]) for group in groups])
+            lengths = ends[groups] - segment.group_starts[groups]
+            starts.extend((offset + np.cumsum(lengths) - lengths).tolist())
+            isbns.extend(segment.isbns[group] for group in groups)
+            contents.extend(segment.contents[row] for row in rows.tolist())
+            matrices.append(np.asarray(segment.matrix[rows], dtype=np.float32))
+            offset += len(rows)
+        dim = next((matrix.shape[1] for matrix in matrices), fresh.matrix.shape[1])
+        return OwnerVectorIndex(
+            isbns=isbns,
+            group_starts=np.asarray(starts, dtype=np.int64),
+            contents=contents,
+            matrix=np.concatenate(matrices) if matrices else np.empty((0, dim), dtype=np.float32),
+        )
+
+    @staticmethod
+    def _read_rows(
+        bigquery_client_helper: BigQueryClientHelper,
+        owner: str,
+        known_isbns: Optional[list[str]] = None,
+        watermark: Optional[datetime] = None,
+        dim: Optional[int] = None
+        ) -> tuple[OwnerVectorIndex, set[str], Optional[datetime]]:
+        """
+        The owner's embedding rows, except those of known_isbns that were created at or before watermark, as an
+        index.  Also returns every ISBN the owner has (with or without rows) and the newest created_at among the
+        returned rows.  The rows are read as Arrow (through the Storage Read API for large libraries), so the
+        vectors never become Python floats.
+        """
+        source_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.source_table_id}"
+        embeddings_table_id = f"{bigquery_client_helper.project_id}.{bigquery_client_helper.dataset_id}.{bigquery_client_helper.embeddings_table_id}"
+        query = f"""
+        SELECT
+            s.isbn,
+            e.content,
+            e.embedding_normalized,
+            e.created_at
+        FROM (
+            SELECT DISTINCT isbn
+            FROM `{source_table_id}`
+            WHERE owner = @owner
+        ) AS s
+        LEFT JOIN `{embeddings_table_id}` AS e
+            ON e.isbn = s.isbn
+            AND (s.isbn NOT IN UNNEST(@known_isbns) OR e.created_at > @watermark)
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("owner", "STRING", owner),
+                bigquery.ArrayQueryParameter("known_isbns", "STRING", known_isbns or []),
+                bigquery.ScalarQueryParameter("watermark", "TIMESTAMP", watermark)
+            ]
+        )
+        # Already on a worker thread (one load shared by every waiting query), so a plain blocking call with a timeout
+        job = bigquery_client_helper.client.query(query, job_config=job_config)
+        table = QueryRunner.fetch_arrow(bigquery_client_helper, job, timeout=QueryRunner.TIMEOUT_SECONDS)
+        current = set(table.column("isbn").to_pylist())
+
+        # A book without (new) embeddings has a single row with no vector
+        lengths = pc.fill_null(pc.list_value_length(table.column("embedding_normalized")), 0).to_numpy()
+        if dim is None:
+            dim = int(lengths[lengths > 0][0]) if (lengths > 0).any() else 0
+        mismatched = (lengths > 0) & (lengths != dim)
+        for isbn, length in zip(table.column("isbn").filter(pa.array(mismatched)).to_pylist(), lengths[mismatched].tolist()):
+            # Left over from a different model; it cannot be compared with the query anyway
+            print(f"Skipping embedding of {isbn} with dimension {length} (expected {dim})")
+        table = table.filter(pa.array((lengths > 0) & ~mismatched))
+
+        newest = pc.max(table.column("created_at")).as_py() if table.num_rows else None
+        return OwnerVectorIndex.from_arrow(table, dim), current, newest
+
+    @staticmethod
+    async def _lexical(index: OwnerVectorIndex) -> LexicalIndex:
+        """
+        index.build_lexical(), on a worker thread when there is anything to build.
+        """
+        if index.lexical_is_current():
+            return index.lexical
+        started_at = time.perf_counter()
+        lexical = await asyncio.to_thread(index.build_lexical)
+        VectorIndex._lexical_builds += 1
+        VectorIndex._lexical_build_seconds += time.perf_counter() - started_at
+        return lexical
+
+    @staticmethod
+    def _ann_is_current(owner: str, index: OwnerVectorIndex) -> bool:
+        """
+        True if the owner's HNSW graph matches its rows.  Otherwise starts a background sync (unless one is running,
+        or one was already tried for these rows) and returns False.
+        """
+        if index.ann is not None and index.ann_version == index.version:
+            return True
+        task = VectorIndex._ann_tasks.get(owner)
+        if task is None and index.ann_attempted_version != index.version:
+            index.ann_attempted_version = index.version
+            task = asyncio.create_task(VectorIndex._sync_ann(owner, index))
+            VectorIndex._ann_tasks[owner] = task
+            task.add_done_callback(lambda done: VectorIndex._ann_sync_done(owner, done))
+        return False
+
+    @staticmethod
+    def _ann_sync_done(owner: str, task: asyncio.Task):
+        VectorIndex._ann_tasks.pop(owner, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"HNSW sync for {owner} failed: {task.exception()}")
+
+    @staticmethod
+    async def _sync_ann(owner: str, index: OwnerVectorIndex):
+        """
+        Brings the owner's graph in line with the index rows (see HnswIndex.synced).  Inserting into the graph is
+        pure-Python, GIL-bound work, so it runs on an EmbeddingsWorkerPool process, on a copy of the graph that
+        replaces the served one when done.  Without a pool the API process only loads a graph saved under HNSW_DIR
+        (by a worker or offline) and uses it if it holds every row; otherwise approximate queries stay exact.
+        """
+        started_at = time.perf_counter()
+        # Snapshot: add/remove replace these attributes rather than mutating them, so this is a consistent view
+        version = index.version
+        rows = (index.isbns, index.contents, index.matrix, index.group_starts)
+        arguments = (
+            index.ann, VectorIndex._ann_path(owner), rows,
+            VectorIndex.HNSW_M, VectorIndex.HNSW_EF_CONSTRUCTION, VectorIndex.HNSW_EF_SEARCH, VectorIndex.HNSW_MAX_TOMBSTONE_RATIO
+        )
+        if EmbeddingsWorkerPool.is_running():
+            ann = await EmbeddingsWorkerPool.run(HnswIndex.synced, *arguments)
+        else:
+            ann = await asyncio.to_thread(HnswIndex.synced, *arguments, build=False)
+        VectorIndex._ann_sync_seconds += time.perf_counter() - started_at
+        if ann is None:
+            VectorIndex._ann_unavailable += 1
+            return
+
+        index.ann = ann
+        index.ann_version = version
+        VectorIndex._ann_syncs += 1
+
+    @staticmethod
+    def _ann_path(owner: str) -> Optional[str]:
+        if VectorIndex.HNSW_DIR is None:
+            return None
+        return os.path.join(VectorIndex.HNSW_DIR, f"{hashlib.sha256(owner.encode('utf-8')).hexdigest()[:32]}.hnsw.npz")
@@ -1,7 +1,9 @@
 from fastapi import APIRouter, Query, Path, Depends
 from datetime import datetime, timezone
 from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
-from google.cloud import bigquery
+from app.books.helpers.library_cache import LibraryCache
+from app.books.helpers.read_marks_buffer import ReadMarksBuffer
+from app.books.helpers.recommendation_cache import RecommendationCache
 from app.models import CleanedISBN, isbn_from_path
 
 router = APIRouter()
@@ -9,41 +11,17 @@ router = APIRouter()
 @router.patch("/books/{isbn}/mark_read", response_model=None, operation_id="MarkBookRead")
 async def mark_book_read(
     owner: str = Query(..., example="user@gmail.com"),
-    isbn: CleanedISBN = Depends(isbn_from_path)
+    isbn: CleanedISBN = Depends(isbn_from_path),
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
     ):
     """
-    Marks a book as read at the current time
+    Marks a book as read at the current time.  Written behind: the mark is batched with others into one MERGE
+    (see ReadMarksBuffer), and this instance's reads see it right away.
     """
-    bigquery_client_helper = get_bigquery_client()
-
-    transaction_script = f"""
-    BEGIN TRANSACTION;
-
-    UPDATE `{bigquery_client_helper.dataset_id}.{bigquery_client_helper.source_table_id}`
-    SET last_read = @last_read
-    WHERE owner = @owner AND isbn = @isbn;
-
-    COMMIT TRANSACTION;
-    """
-
     utc_now = datetime.now(timezone.utc)
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            # Parameters for the source table (Scalar types)
-            bigquery.ScalarQueryParameter("owner", "STRING", owner),
-            bigquery.ScalarQueryParameter("isbn", "STRING", isbn.isbn),
-            bigquery.ScalarQueryParameter("last_read", "TIMESTAMP", utc_now)
-        ]
-    )
-
-    try:
-        query_job = bigquery_client_helper.client.query(transaction_script, job_config=job_config)
-        # Waiting on the result means we wait for the COMMIT to finish
-        query_job.result()
-
-    except Exception as e:
-        print(f"Transaction failed and was rolled back: {e}")
-        raise
+    await ReadMarksBuffer.mark(bigquery_client_helper, owner=owner, isbn=isbn.isbn, last_read=utc_now)
+    # Recommendations carry last_read
+    RecommendationCache.invalidate(owner)
+    LibraryCache.invalidate(owner)
 
     return
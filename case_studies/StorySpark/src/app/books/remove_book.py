@@ -1,20 +1,26 @@
 from fastapi import APIRouter, Query, Path, Depends
+from fastapi.responses import JSONResponse
 from google.cloud import bigquery
-from app.books.helpers.bigquery_client_helper import get_bigquery_client
+from app.books.helpers.bigquery_client_helper import get_bigquery_client, BigQueryClientHelper
+from app.books.add_book import create_source_table_id
+from app.books.helpers.existing_ids import ExistingIds
+from app.books.helpers.library_cache import LibraryCache
+from app.books.helpers.query_runner import QueryRunner, WritePendingError
+from app.books.helpers.recommendation_cache import RecommendationCache
+from app.books.helpers.vector_index import VectorIndex
 from app.models import CleanedISBN, isbn_from_path
 
 router = APIRouter()
 
-@router.delete("/books/{isbn}", response_model=None, operation_id="RemoveBook")
+@router.delete("/books/{isbn}", response_model=None, responses={202: {"description": "The write is still running in BigQuery and may yet commit"}}, operation_id="RemoveBook")
 async def remove_book(
     owner: str = Query(..., example="user@gmail.com"),
-    isbn: CleanedISBN = Depends(isbn_from_path)
+    isbn: CleanedISBN = Depends(isbn_from_path),
+    bigquery_client_helper: BigQueryClientHelper = Depends(get_bigquery_client)
     ):
     """
     Remove a book from the user's collection by its ISBN
     """
-    bigquery_client_helper = get_bigquery_client()
-
     transaction_script = f"""
     BEGIN TRANSACTION;
 
@@ -33,9 +39,23 @@ async def remove_book(
     )
 
     try:
-        query_job = bigquery_client_helper.client.query(transaction_script, job_config=job_config)
         # Waiting on the result means we wait for the COMMIT to finish
-        query_job.result()
+        await QueryRunner.run_write(bigquery_client_helper, transaction_script, job_config=job_config)
+        VectorIndex.remove_book(owner, isbn.isbn)
+        ExistingIds.forget(bigquery_client_helper.source_table_id, [create_source_table_id(owner, isbn.isbn)])
+        RecommendationCache.invalidate(owner)
+        LibraryCache.invalidate(owner)
+        LibraryCache.record_removal(owner, isbn.isbn)
+
+    except WritePendingError as e:
+        # It may still commit or roll back: read this owner's books from BigQuery again rather than guess
+        print(f"Transaction still running: {e}")
+        VectorIndex.invalidate(owner)
+        ExistingIds.forget(bigquery_client_helper.source_table_id, [create_source_table_id(owner, isbn.isbn)])
+        RecommendationCache.invalidate(owner)
+        LibraryCache.invalidate(owner)
+        LibraryCache.record_unlisted_removals(owner)
+        return JSONResponse(status_code=202, content=e.to_dict())
 
     except Exception as e:
         print(f"Transaction failed and was rolled back: {e}")
@@ -2,14 +2,30 @@
 import os
 import atexit
 import asyncio
+from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
 from fastapi import FastAPI, Depends, Request
+from fastapi.responses import JSONResponse
 from app.logging_setup import setup_cloud_logging
+from app.books.helpers.bigquery_client_helper import BigQueryClients
+from app.books.helpers.columnar_writer import ColumnarWriter
+from app.books.helpers.embedding_snapshots import EmbeddingSnapshots
+from app.books.helpers.embeddings_batcher import EmbeddingsBatcher
+from app.books.helpers.embeddings_cache import EmbeddingsCache
+from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+from app.books.helpers.embeddings_worker_pool import EmbeddingsWorkerPool
+from app.books.helpers.existing_ids import ExistingIds
+from app.books.helpers.library_cache import LibraryCache
+from app.books.helpers.query_runner import QueryRunner
+from app.books.helpers.read_marks_buffer import ReadMarksBuffer
+from app.books.helpers.recommendation_cache import RecommendationCache
+from app.books.helpers.vector_index import VectorIndex
 
 from app.books import (
     add_book_router,
     get_recommendation_router,
+    get_recommendation_batch_router,
     mark_read_router,
     remove_book_router,
     get_all_books_router,
@@ -56,23 +72,83 @@ async def get_db(request: Request) -> AsyncGenerator:
 
     yield app.state.db
 
+async def warm_up_embeddings(app: FastAPI):
+    """
+    Loads the tokenizer/ONNX session and runs a warm-up batch, then flips the app to ready.
+    Runs in the background so the server (and /healthz) comes up immediately while /readyz reports not ready.
+    """
+    try:
+        timings = await asyncio.to_thread(EmbeddingsGenerator.warm_up)
+        app.state.warm_up = {"status": "ready", "timings": timings}
+        app.state.ready = True
+        print(f"Embeddings warm-up finished: {timings}")
+    except Exception as e:
+        app.state.warm_up = {"status": "failed", "error": str(e)}
+        print(f"Embeddings warm-up failed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    app.state.warm_up = {"status": "warming_up"}
+    warm_up_task = asyncio.create_task(warm_up_embeddings(app))
+    # Bulk embedding (add_book, seeding) runs in worker processes
+    EmbeddingsWorkerPool.start()
+    # One BigQuery client for every request, so none of them pays for credentials and a new connection.  Created in
+    # the background like the model warm-up, so the server comes up without waiting on credential discovery.
+    bigquery_start_task = asyncio.create_task(asyncio.to_thread(BigQueryClients.start))
+
+    yield
+
+    warm_up_task.cancel()
+    await bigquery_start_task
+    await EmbeddingsBatcher.stop()
+    await asyncio.to_thread(EmbeddingsWorkerPool.stop)
+    # Pending read marks go out while the BigQuery client is still open
+    await ReadMarksBuffer.stop()
+    await asyncio.to_thread(BigQueryClients.stop)
+
 def create_app() -> FastAPI:
-    app = FastAPI(title="StorySpark API", version="0.1")
+    app = FastAPI(title="StorySpark API", version="0.1", lifespan=lifespan)
     app.state.cloud_logging_client = setup_cloud_logging()
 
     # include routers (each router can use Depends(get_db) on endpoints)
     app.include_router(add_book_router)
     app.include_router(get_recommendation_router)
+    app.include_router(get_recommendation_batch_router)
     app.include_router(mark_read_router)
     app.include_router(remove_book_router)
     app.include_router(get_all_books_router)
     app.include_router(clear_database_router)
     app.include_router(clear_and_seed_db_router)
 
+    # Liveness: the process is up
     @app.get("/healthz", tags=["health"])
     async def healthz():
         return {"status": "ok"}
 
+    # Readiness: the embeddings model is loaded and warmed up, so requests will not pay for it
+    @app.get("/readyz", tags=["health"])
+    async def readyz(request: Request):
+        status_code = 200 if getattr(request.app.state, "ready", False) else 503
+        return JSONResponse(status_code=status_code, content=getattr(request.app.state, "warm_up", {"status": "warming_up"}))
+
+    @app.get("/metrics", tags=["health"])
+    async def metrics():
+        return {
+            "bigquery_clients": BigQueryClients.to_dict(),
+            "embeddings_batcher": EmbeddingsBatcher.to_dict(),
+            "embeddings_cache": EmbeddingsCache.to_dict(),
+            "embeddings_worker_pool": EmbeddingsWorkerPool.to_dict(),
+            "query_runner": QueryRunner.to_dict(),
+            "columnar_writer": ColumnarWriter.to_dict(),
+            "existing_ids": ExistingIds.to_dict(),
+            "read_marks_buffer": ReadMarksBuffer.to_dict(),
+            "vector_index": VectorIndex.to_dict(),
+            "embedding_snapshots": EmbeddingSnapshots.to_dict(),
+            "recommendation_cache": RecommendationCache.to_dict(),
+            "library_cache": LibraryCache.to_dict()
+        }
+
     return app
 
 app = create_app()
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, AfterValidator, field_validator
 from pydantic.types import StringConstraints
-from typing import Optional, Annotated, Any
+from typing import Optional, Annotated, Any, Literal
 from datetime import datetime
 from fastapi import HTTPException, Path
 
@@ -73,5 +73,24 @@ class RecommendedBook(BaseModel):
     relevant_text: str
     last_read: Optional[datetime] = None
     created_at: datetime
-    cosine_simularity: float
+    # None when search_mode=hybrid answered a keyword query without embedding it
+    cosine_simularity: Optional[float] = None
 
+class RecommendationBatchRequest(BaseModel):
+    owner: str = Field(..., example="user@gmail.com")
+    texts: list[str] = Field(
+        ...,
+        min_length=1,
+        max_length=64,
+        description="Query texts, e.g. one per themed shelf",
+        example=["trains", "friendship", "dinosaurs"]
+    )
+    limit: int = Field(10, gt=0, description="Maximum number of results per text; must be > 0", example=10)
+    search_mode: Optional[Literal["exact", "approximate", "two_stage", "hybrid"]] = Field(
+        None,
+        description="exact scores every embedding; approximate uses the HNSW index; two_stage prefilters books by their centroid embedding; hybrid fuses keyword (BM25) and embedding ranking.  Defaults to STORYSPARK_RECOMMENDATION_SEARCH_MODE"
+    )
+
+class RecommendationBatchResult(BaseModel):
+    text: str
+    books: list[RecommendedBook]
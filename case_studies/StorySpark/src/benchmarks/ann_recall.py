@@ -0,0 +1,143 @@
+"""
+Recall vs latency of the HNSW ("approximate") and centroid-prefiltered ("two_stage") recommendation searches
+against the exact one.
+
+Builds a synthetic library: ISBNs with several embedding rows each, drawn around topic centers so that, like real
+embeddings, the vectors are clustered rather than uniform.  For each (M, ef_construction) it builds the graph once,
+then for each ef_search reports recall@k of the returned ISBNs against exact search and the query latency.  The
+same is reported for two_stage at each --centroid-candidates.
+
+    python -m benchmarks.ann_recall --books 3000 --rows-per-book 10
+    python -m benchmarks.ann_recall --m 8 16 32 --ef-search 16 32 64 128 256
+    python -m benchmarks.ann_recall --m --centroid-candidates 20 50 100 200   (two_stage only)
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from app.books.helpers.hnsw_index import HnswIndex
+from app.books.helpers.vector_index import OwnerVectorIndex
+from benchmarks.embeddings_throughput import git_commit
+
+def synthetic_library(rng: np.random.Generator, books: int, rows_per_book: int, dim: int, topics: int, spread: float):
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    rows = []
+    for book in range(books):
+        # A book sits near a topic and its rows (subjects, description chunks) sit near the book
+        book_center = centers[rng.integers(topics)] + spread * rng.standard_normal(dim).astype(np.float32)
+        for row in range(int(rng.integers(1, 2 * rows_per_book))):
+            vector = book_center + spread * rng.standard_normal(dim).astype(np.float32)
+            rows.append((f"isbn-{book:06d}", f"row-{row}", vector / np.linalg.norm(vector)))
+    queries = centers[rng.integers(topics, size=200)] + spread * rng.standard_normal((200, dim)).astype(np.float32)
+    return rows, queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=2000)
+    parser.add_argument("--rows-per-book", type=int, default=8, help="Mean embedding rows per ISBN")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=40)
+    parser.add_argument("--spread", type=float, default=0.6)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=10, help="k in recall@k")
+    parser.add_argument("--m", type=int, nargs="*", default=[16], help="Pass no values to skip HNSW")
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[100])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--centroid-candidates", type=int, nargs="*", default=[20, 50, 100])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Default: benchmarks/results/ann_recall-<sha>.json")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    rows, queries = synthetic_library(rng, args.books, args.rows_per_book, args.dim, args.topics, args.spread)
+    queries = queries[: args.queries]
+    index = OwnerVectorIndex.from_rows(rows)
+    print(f"{len(index.isbns)} ISBNs, {len(index)} rows")
+
+    exact_latencies, exact_results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        exact_results.append({match.isbn for match in index.search(query, args.limit)})
+        exact_latencies.append(time.perf_counter() - started)
+    exact = {"p50_ms": float(np.percentile(exact_latencies, 50) * 1000), "p99_ms": float(np.percentile(exact_latencies, 99) * 1000)}
+    print(f"exact: p50 {exact['p50_ms']:.3f} ms  p99 {exact['p99_ms']:.3f} ms")
+
+    two_stage_runs = []
+    for candidates in args.centroid_candidates:
+        latencies, recalls, scored = [], [], []
+        for query, expected in zip(queries, exact_results):
+            started = time.perf_counter()
+            (matches,), vectors = index.search_two_stage(query[None, :], args.limit, candidates)
+            latencies.append(time.perf_counter() - started)
+            recalls.append(len({match.isbn for match in matches} & expected) / len(expected))
+            scored.append(vectors)
+        run = {
+            "centroid_candidates": candidates,
+            "recall_at_k": float(np.mean(recalls)),
+            "vectors_scored_mean": float(np.mean(scored)),
+            "p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        }
+        two_stage_runs.append(run)
+        print(
+            f"two_stage candidates={candidates:<4} recall@{args.limit} {run['recall_at_k']:.3f}  "
+            f"p50 {run['p50_ms']:.3f} ms  p99 {run['p99_ms']:.3f} ms  ({run['vectors_scored_mean']:.0f} of {len(index)} vectors)"
+        )
+
+    runs = []
+    for m in args.m:
+        for ef_construction in args.ef_construction:
+            started = time.perf_counter()
+            ann = HnswIndex(args.dim, m=m, ef_construction=ef_construction)
+            ann.add_many(rows)
+            build_seconds = time.perf_counter() - started
+            index.ann = ann
+
+            for ef_search in args.ef_search:
+                latencies, recalls = [], []
+                for query, expected in zip(queries, exact_results):
+                    started = time.perf_counter()
+                    found = {match.isbn for match in index.search_approximate(query, args.limit, ef=ef_search)}
+                    latencies.append(time.perf_counter() - started)
+                    recalls.append(len(found & expected) / len(expected))
+                run = {
+                    "m": m,
+                    "ef_construction": ef_construction,
+                    "ef_search": ef_search,
+                    "build_seconds": build_seconds,
+                    "recall_at_k": float(np.mean(recalls)),
+                    "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                    "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                }
+                runs.append(run)
+                print(
+                    f"M={m:<3} ef_construction={ef_construction:<4} ef_search={ef_search:<4} "
+                    f"recall@{args.limit} {run['recall_at_k']:.3f}  p50 {run['p50_ms']:.3f} ms  p99 {run['p99_ms']:.3f} ms  "
+                    f"(build {build_seconds:.1f} s)"
+                )
+
+    git = git_commit()
+    results = {
+        "benchmark": "ann_recall",
+        "git": git,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "library": {"isbns": len(index.isbns), "rows": len(index)},
+        "exact": exact,
+        "approximate": runs,
+        "two_stage": two_stage_runs,
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", f"ann_recall-{(git['sha'] or 'unknown')[:12]}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+if __name__ == "__main__":
+    main()
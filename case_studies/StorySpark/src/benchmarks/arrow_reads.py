@@ -0,0 +1,205 @@
+"""
+Client-side rows/sec of the two BigQuery reads that grow with a library: the book listing (GET /books) and the
+embedding scan that loads an owner's vector index.
+
+For each library size it builds the results twice, in the shapes they arrive in from BigQuery: REST tabledata
+JSON pages (what query_job.result() iterates) and an Arrow IPC stream (what the Storage Read API sends as record
+batches).  It then times, per read:
+
+    rest   JSON pages -> Row objects -> a Book model per row -> response JSON (listing),
+           or -> a numpy array per row -> OwnerVectorIndex.from_rows (embedding scan)
+    arrow  record batches -> books_to_json (listing), or -> OwnerVectorIndex.from_arrow (embedding scan)
+
+Network time is not included; both sides start from bytes in memory.  The REST embedding scan is timed on the
+first --rest-max-rows rows only (its JSON is ~30 bytes per float and needs several GB for a large library); rows/sec
+is comparable either way.
+
+    python -m benchmarks.arrow_reads --books 10000 50000
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pyarrow as pa
+from google.cloud import bigquery
+from google.cloud.bigquery import _helpers
+from pydantic import TypeAdapter
+
+from app.models import Book, CleanedISBN
+from app.books.get_all_books import books_to_json
+from app.books.helpers.vector_index import OwnerVectorIndex
+from benchmarks.embeddings_throughput import git_commit
+
+BOOK_SCHEMA = [
+    bigquery.SchemaField("id", "STRING"),
+    bigquery.SchemaField("owner", "STRING"),
+    bigquery.SchemaField("isbn", "STRING"),
+    bigquery.SchemaField("title", "STRING"),
+    bigquery.SchemaField("authors", "STRING", mode="REPEATED"),
+    bigquery.SchemaField("last_read", "TIMESTAMP"),
+    bigquery.SchemaField("created_at", "TIMESTAMP"),
+]
+EMBEDDING_SCHEMA = [
+    bigquery.SchemaField("isbn", "STRING"),
+    bigquery.SchemaField("content", "STRING"),
+    bigquery.SchemaField("embedding_normalized", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("created_at", "TIMESTAMP"),
+]
+
+def synthetic_library(rng: np.random.Generator, books: int, rows_per_book: int, dim: int) -> tuple[pa.Table, pa.Table]:
+    now = datetime.now(timezone.utc)
+    created = [now - timedelta(seconds=int(s)) for s in rng.integers(0, 10_000_000, books)]
+    isbns = [f"978{i:010d}" for i in range(books)]
+    book_table = pa.table({
+        "id": [f"user@gmail.com:{isbn}" for isbn in isbns],
+        "owner": ["user@gmail.com"] * books,
+        "isbn": isbns,
+        "title": [f"Book number {i}" for i in range(books)],
+        "authors": [["Some Author", "Another Author"][: 1 + i % 2] for i in range(books)],
+        "last_read": pa.array([c if i % 3 == 0 else None for i, c in enumerate(created)], type=pa.timestamp("us", tz="UTC")),
+        "created_at": pa.array(created, type=pa.timestamp("us", tz="UTC")),
+    })
+
+    counts = rng.integers(1, 2 * rows_per_book, books)
+    rows = int(counts.sum())
+    vectors = rng.standard_normal((rows, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    offsets = pa.array(np.arange(0, (rows + 1) * dim, dim, dtype=np.int32))
+    embedding_isbns = np.repeat(np.asarray(isbns, dtype=object), counts)
+    embedding_table = pa.table({
+        "isbn": pa.array(embedding_isbns.tolist(), type=pa.string()),
+        "content": [f"text {i}" for i in range(rows)],
+        "embedding_normalized": pa.ListArray.from_arrays(offsets, pa.array(vectors.reshape(-1))),
+        "created_at": pa.array(np.repeat(np.asarray(created, dtype=object), counts).tolist(), type=pa.timestamp("us", tz="UTC")),
+    })
+    return book_table, embedding_table
+
+def to_rest_payload(table: pa.Table) -> bytes:
+    """
+    The table as a REST getQueryResults page: every value a string, timestamps as epoch microseconds.
+    """
+    def cell(value):
+        if value is None:
+            return {"v": None}
+        if isinstance(value, list):
+            return {"v": [cell(item) for item in value]}
+        if isinstance(value, datetime):
+            return {"v": str(int(value.timestamp() * 1_000_000))}
+        return {"v": str(value)}
+
+    rows = [{"f": [cell(value) for value in row.values()]} for row in table.to_pylist()]
+    return json.dumps({"rows": rows}).encode("utf-8")
+
+def to_arrow_payload(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=1024):
+            writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+def read_arrow(payload: bytes) -> pa.Table:
+    return pa.ipc.open_stream(payload).read_all()
+
+def listing_rest(payload: bytes) -> bytes:
+    rows = _helpers._rows_from_json(json.loads(payload)["rows"], BOOK_SCHEMA)
+    books = [
+        Book(
+            id=row["id"],
+            owner=row["owner"],
+            isbn=CleanedISBN(isbn=row["isbn"]),
+            title=row["title"],
+            authors=row["authors"],
+            last_read=row["last_read"],
+            created_at=row["created_at"]
+        )
+        for row in rows
+    ]
+    # What FastAPI does with a response_model
+    return json.dumps(TypeAdapter(list[Book]).dump_python(books, mode="json"), separators=(",", ":")).encode("utf-8")
+
+def listing_arrow(payload: bytes) -> bytes:
+    return books_to_json(read_arrow(payload))
+
+def embeddings_rest(payload: bytes) -> OwnerVectorIndex:
+    rows = _helpers._rows_from_json(json.loads(payload)["rows"], EMBEDDING_SCHEMA)
+    return OwnerVectorIndex.from_rows(
+        [(row["isbn"], row["content"], np.asarray(row["embedding_normalized"], dtype=np.float32)) for row in rows]
+    )
+
+def embeddings_arrow(payload: bytes, dim: int) -> OwnerVectorIndex:
+    return OwnerVectorIndex.from_arrow(read_arrow(payload), dim)
+
+def measure(fn, rows: int, repeats: int) -> dict:
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    seconds = float(np.median(timings))
+    return {"seconds_median": seconds, "rows_per_sec": rows / seconds}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--rows-per-book", type=int, default=5, help="Mean embedding rows per ISBN")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--rest-max-rows", type=int, default=10000, help="Embedding rows the REST scan is timed on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Default: benchmarks/results/arrow_reads-<sha>.json")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    runs = []
+    for books in args.books:
+        book_table, embedding_table = synthetic_library(rng, books, args.rows_per_book, args.dim)
+        book_rest, book_arrow = to_rest_payload(book_table), to_arrow_payload(book_table)
+        rest_sample = embedding_table.slice(0, args.rest_max_rows)
+        embedding_rest, embedding_arrow = to_rest_payload(rest_sample), to_arrow_payload(embedding_table)
+
+        # Same response and same index either way
+        assert json.loads(listing_rest(book_rest)) == json.loads(listing_arrow(book_arrow))
+        assert np.array_equal(embeddings_rest(embedding_rest).matrix, embeddings_arrow(to_arrow_payload(rest_sample), args.dim).matrix)
+
+        run = {
+            "books": books,
+            "embedding_rows": embedding_table.num_rows,
+            "embedding_rows_rest": rest_sample.num_rows,
+            "payload_bytes_per_row": {
+                "listing_rest": len(book_rest) / books, "listing_arrow": len(book_arrow) / books,
+                "embeddings_rest": len(embedding_rest) / rest_sample.num_rows, "embeddings_arrow": len(embedding_arrow) / embedding_table.num_rows,
+            },
+            "listing_rest": measure(lambda: listing_rest(book_rest), books, args.repeats),
+            "listing_arrow": measure(lambda: listing_arrow(book_arrow), books, args.repeats),
+            "embeddings_rest": measure(lambda: embeddings_rest(embedding_rest), rest_sample.num_rows, args.repeats),
+            "embeddings_arrow": measure(lambda: embeddings_arrow(embedding_arrow, args.dim), embedding_table.num_rows, args.repeats),
+        }
+        runs.append(run)
+        for read in ("listing", "embeddings"):
+            rest, arrow = run[f"{read}_rest"], run[f"{read}_arrow"]
+            print(
+                f"{books} books, {read}: rest {rest['rows_per_sec']:,.0f} rows/s  arrow {arrow['rows_per_sec']:,.0f} rows/s  "
+                f"({rest['seconds_median'] / arrow['seconds_median']:.1f}x)"
+            )
+
+    git = git_commit()
+    results = {
+        "benchmark": "arrow_reads",
+        "git": git,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "runs": runs,
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", f"arrow_reads-{(git['sha'] or 'unknown')[:12]}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+if __name__ == "__main__":
+    main()
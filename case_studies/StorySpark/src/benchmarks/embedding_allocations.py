@@ -0,0 +1,81 @@
+"""
+Allocation benchmark for the embedding hand-off from EmbeddingsGenerator to the BigQuery insert payload.
+
+Compares the old path (batch array -> list[float] in EmbeddingsInfo -> list(map(float)) -> JSON numbers) with the
+current one (batch row views in EmbeddingsInfo -> base64 float32 bytes in JSON).  No model is needed; the batch
+output is simulated with random float32 vectors of the model's dimension.
+
+    python -m benchmarks.embedding_allocations --rows 512 --dim 384
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from app.books.helpers import embedding_codec
+
+def old_path(batch_raw: np.ndarray, batch_norm: np.ndarray) -> str:
+    # EmbeddingsInfo held .tolist() copies...
+    infos = [(batch_raw[i].tolist(), batch_norm[i].tolist()) for i in range(batch_raw.shape[0])]
+    # ...add_book then coerced them again and serialized the floats as decimal text
+    rows = [
+        {"embedding_raw": list(map(float, raw)), "embedding_normalized": list(map(float, norm))}
+        for raw, norm in infos
+    ]
+    return json.dumps(rows)
+
+def new_path(batch_raw: np.ndarray, batch_norm: np.ndarray) -> str:
+    infos = [(batch_raw[i], batch_norm[i]) for i in range(batch_raw.shape[0])]
+    rows = [
+        {"embedding_raw": embedding_codec.to_base64(raw), "embedding_normalized": embedding_codec.to_base64(norm)}
+        for raw, norm in infos
+    ]
+    return json.dumps(rows)
+
+def measure(fn, batch_raw: np.ndarray, batch_norm: np.ndarray, repeats: int) -> dict:
+    tracemalloc.start()
+    payload = fn(batch_raw, batch_norm)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn(batch_raw, batch_norm)
+        timings.append(time.perf_counter() - started)
+
+    return {
+        "peak_alloc_bytes": peak,
+        "payload_bytes": len(payload),
+        "seconds_median": float(np.median(timings)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=512)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    batch_raw = rng.standard_normal((args.rows, args.dim)).astype(np.float32)
+    batch_norm = batch_raw / np.linalg.norm(batch_raw, axis=-1, keepdims=True)
+
+    # The wire format must round-trip exactly
+    assert np.array_equal(embedding_codec.from_base64(embedding_codec.to_base64(batch_norm[0])), batch_norm[0])
+
+    results = {
+        "rows": args.rows,
+        "dim": args.dim,
+        "old_list_json": measure(old_path, batch_raw, batch_norm, args.repeats),
+        "float32_base64": measure(new_path, batch_raw, batch_norm, args.repeats),
+    }
+    old, new = results["old_list_json"], results["float32_base64"]
+    results["peak_alloc_reduction"] = 1 - new["peak_alloc_bytes"] / old["peak_alloc_bytes"]
+    results["payload_reduction"] = 1 - new["payload_bytes"] / old["payload_bytes"]
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Throughput/latency benchmark for EmbeddingsGenerator.generate_embeddings.
+
+By default a synthetic model (benchmarks/synthetic_model.py) is built in a temp directory, so this runs anywhere
+without the exported model.  Pass --model-dir to benchmark a real export instead (the directory that holds the
+.onnx file and tokenizer.json).
+
+Every workload runs in a fresh process so its peak RSS is its own.  The embeddings cache is disabled so every
+call does the full tokenize + ONNX work.  Results are written as JSON together with the git commit, so runs from
+different commits can be compared with --baseline.
+
+    python -m benchmarks.embeddings_throughput
+    python -m benchmarks.embeddings_throughput --model-dir ./models --model-file all-MiniLM-L6-v2.onnx --variant int8
+    python -m benchmarks.embeddings_throughput --baseline benchmarks/results/embeddings_throughput-<sha>.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+
+import numpy as np
+
+from benchmarks import synthetic_model
+
+# name -> (tag count, short text count, long text count) per generate_embeddings call
+WORKLOADS: dict[str, tuple[int, int, int]] = {
+    # add_book with user tags only
+    "tags": (32, 0, 0),
+    # add_book metadata: subjects, descriptions, titles
+    "short": (0, 32, 0),
+    "mixed": (16, 24, 2),
+    # descriptions longer than the model max length, chunked into windows
+    "long": (0, 0, 4),
+}
+
+def make_call(rng: np.random.Generator, tag_count: int, short_count: int, long_count: int) -> tuple[str, list[str]]:
+    """
+    One generate_embeddings call's worth of input.  Texts are random word sequences so they are (almost always)
+    unique and nothing is deduplicated.
+    """
+    def words(n: int) -> str:
+        return " ".join(rng.choice(synthetic_model.WORDS, size=n))
+
+    tags = ";".join(words(int(rng.integers(1, 4))) for _ in range(tag_count))
+    texts = [words(int(rng.integers(5, 40))) for _ in range(short_count)]
+    texts += [words(int(rng.integers(600, 1500))) for _ in range(long_count)]
+    return tags, texts
+
+def percentile_ms(values: list[float], q: float) -> float:
+    return float(np.percentile(values, q) * 1000.0)
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def run_workload(name: str, iterations: int, warmup: int, seed: int) -> dict:
+    # Imported here: the generator reads its configuration from the environment at import time, and this runs in
+    # a spawned process that inherits the environment main() set up
+    from app.books.helpers.embeddings_generator import EmbeddingsGenerator
+
+    load_started = time.perf_counter()
+    EmbeddingsGenerator._ensure_model_loaded(model_path=EmbeddingsGenerator.MODEL_PATH)
+    load_seconds = time.perf_counter() - load_started
+    rss_after_load = peak_rss_bytes()
+
+    tag_count, short_count, long_count = WORKLOADS[name]
+    rng = np.random.default_rng(seed)
+    calls = [make_call(rng, tag_count, short_count, long_count) for _ in range(warmup + iterations)]
+
+    for tags, texts in calls[:warmup]:
+        EmbeddingsGenerator.generate_embeddings(tags=tags, relevant_text=texts)
+
+    latencies: list[float] = []
+    texts_embedded = 0
+    tokens_embedded = 0
+    for tags, texts in calls[warmup:]:
+        started = time.perf_counter()
+        infos = EmbeddingsGenerator.generate_embeddings(tags=tags, relevant_text=texts)
+        latencies.append(time.perf_counter() - started)
+
+        texts_embedded += len(infos)
+        tokens_embedded += sum(
+            len(e.ids) for e in EmbeddingsGenerator._tokenizer.encode_batch([info.text for info in infos], add_special_tokens=True)
+        )
+
+    total_seconds = sum(latencies)
+    return {
+        "calls": iterations,
+        "texts": texts_embedded,
+        "tokens": tokens_embedded,
+        "texts_per_sec": texts_embedded / total_seconds,
+        "tokens_per_sec": tokens_embedded / total_seconds,
+        "call_latency_ms": {
+            "mean": total_seconds / iterations * 1000.0,
+            "p50": percentile_ms(latencies, 50),
+            "p99": percentile_ms(latencies, 99),
+            "max": max(latencies) * 1000.0,
+        },
+        "model_load_ms": load_seconds * 1000.0,
+        "rss_after_load_bytes": rss_after_load,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+def git_commit() -> dict:
+    def git(*args: str) -> str:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=True).stdout.strip()
+    try:
+        return {"sha": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except (OSError, subprocess.CalledProcessError):
+        return {"sha": None, "dirty": None}
+
+def compare(results: dict, baseline: dict):
+    print(f"\nvs baseline {baseline['git'].get('sha')}:")
+    for name, current in results["workloads"].items():
+        previous = baseline["workloads"].get(name)
+        if previous is None:
+            continue
+        print(
+            f"  {name:>6}: texts/sec x{current['texts_per_sec'] / previous['texts_per_sec']:.2f}, "
+            f"p99 x{current['call_latency_ms']['p99'] / previous['call_latency_ms']['p99']:.2f}, "
+            f"peak RSS x{current['peak_rss_bytes'] / previous['peak_rss_bytes']:.2f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workloads", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--iterations", type=int, default=50, help="Timed generate_embeddings calls per workload")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model-dir", help="Directory with an exported model and tokenizer.json.  Default: a synthetic model")
+    parser.add_argument("--model-file", default=synthetic_model.MODEL_FILE)
+    parser.add_argument("--variant", default="fp32", help="STORYSPARK_MODEL_VARIANT to benchmark")
+    parser.add_argument("--output", help="Where to write the JSON results.  Default: benchmarks/results/embeddings_throughput-<sha>.json")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="storyspark-bench-") as tmp:
+        model_dir = args.model_dir
+        if model_dir is None:
+            model_dir = os.path.join(tmp, "models")
+            synthetic_model.build(model_dir, model_file=args.model_file)
+
+        model_dir = os.path.abspath(model_dir)
+        os.environ.update({
+            "STORYSPARK_MODEL_EXPORT_BUCKET_NAME": os.path.dirname(model_dir),
+            "STORYSPARK_IMAGE_MODEL_DIR": os.path.basename(model_dir),
+            "STORYSPARK_MODEL_FILE": args.model_file,
+            "STORYSPARK_MODEL_VARIANT": args.variant,
+            # Measure the model, not the cache
+            "STORYSPARK_EMBEDDING_CACHE_MAX_BYTES": "0",
+            "STORYSPARK_EMBEDDING_CACHE_DISK_PATH": "",
+            # Keep optimized graphs out of the (possibly read-only or shared) model directory
+            "STORYSPARK_ORT_OPTIMIZED_MODEL_DIR": tmp,
+        })
+
+        workloads = {}
+        for name in args.workloads:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                workloads[name] = pool.submit(run_workload, name, args.iterations, args.warmup, args.seed).result()
+            result = workloads[name]
+            print(
+                f"{name:>6}: {result['texts_per_sec']:9.1f} texts/sec {result['tokens_per_sec']:11.1f} tokens/sec  "
+                f"p50 {result['call_latency_ms']['p50']:8.2f} ms  p99 {result['call_latency_ms']['p99']:8.2f} ms  "
+                f"peak RSS {result['peak_rss_bytes'] / 2**20:7.1f} MB"
+            )
+
+    git = git_commit()
+    results = {
+        "benchmark": "embeddings_throughput",
+        "git": git,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "model": "synthetic" if args.model_dir is None else os.path.join(args.model_dir, args.model_file),
+            "variant": args.variant,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "workloads": {name: dict(zip(("tags", "short_texts", "long_texts"), WORKLOADS[name])) for name in args.workloads},
+            # Anything else that changes the numbers (thread counts, bucket sizes, ...)
+            "environment": {k: v for k, v in sorted(os.environ.items()) if k.startswith("STORYSPARK_") and k not in (
+                "STORYSPARK_MODEL_EXPORT_BUCKET_NAME", "STORYSPARK_IMAGE_MODEL_DIR", "STORYSPARK_ORT_OPTIMIZED_MODEL_DIR"
+            )},
+        },
+        "workloads": workloads,
+    }
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", f"embeddings_throughput-{(git['sha'] or 'unknown')[:12]}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Tiny stand-in for the exported sentence-transformer, so embeddings can be benchmarked without downloading or
+exporting the real model.
+
+The ONNX graph has the same signature as model_export/main.py produces (int64 input_ids and attention_mask of shape
+(batch, seq) in, float32 "output" of shape (batch, dim) out) and does the same masked mean pooling + L2
+normalization, with a token embedding lookup and one dense layer in place of the transformer.  The tokenizer.json
+is a BERT-style WordPiece tokenizer ([CLS]/[SEP], lower-casing) over a small vocabulary.
+
+    python -m benchmarks.synthetic_model /tmp/storyspark-bucket/models
+"""
+import os
+import string
+import sys
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, processors
+
+MODEL_FILE = "synthetic.onnx"
+
+# Whole-word vocabulary, so generated text tokenizes to roughly one token per word like real English does
+WORDS: list[str] = """
+    the a an and of to in is it on at by for with from as was were be been are this that these those he she they
+    we you i his her their our my your little big old new good bad happy sad brave kind quiet loud small tall
+    train engine track station friend friendship family mother father brother sister grandma grandpa baby
+    dog cat bird fish bear pig pigs frog duck horse mouse lion tiger elephant dinosaur dinosaurs dragon giant
+    princess king queen castle forest river canoe boat ocean island mountain snow winter summer rain sun moon
+    star night day morning home school garden party ball book story stories song music dance game games toy toys
+    gift gifts birthday cake ice cream apple cookie dinner lunch breakfast sleep dream bed hat coat boots
+    went go going came come saw see look looked found find made make played play ran run jumped jump said says
+    wanted want waited waiting shared share helped help learned learn laughed laugh cried cry climbed climb
+    could would should can will did do does had has have not no yes all every some many more most very too
+    up down over under around through into out again then when where why how what who after before because
+""".split()
+
+def build(out_dir: str, model_file: str = MODEL_FILE, dim: int = 384, hidden: int = 384, seed: int = 0) -> str:
+    """
+    Writes model_file and tokenizer.json into out_dir and returns the model path.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    vocab_tokens = (
+        ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+        + list(string.ascii_lowercase) + ["##" + c for c in string.ascii_lowercase]
+        + list(string.digits) + ["##" + c for c in string.digits]
+        + list(string.punctuation)
+        + WORDS
+    )
+    vocab = {token: i for i, token in enumerate(dict.fromkeys(vocab_tokens))}
+
+    tokenizer = Tokenizer(models.WordPiece(vocab=vocab, unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=True)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        pair="[CLS] $A [SEP] $B:1 [SEP]:1",
+        special_tokens=[("[CLS]", vocab["[CLS]"]), ("[SEP]", vocab["[SEP]"])],
+    )
+    tokenizer.save(os.path.join(out_dir, "tokenizer.json"))
+
+    rng = np.random.default_rng(seed)
+    initializers = [
+        numpy_helper.from_array(rng.standard_normal((len(vocab), hidden)).astype(np.float32), "token_embeddings"),
+        numpy_helper.from_array((rng.standard_normal((hidden, dim)) / np.sqrt(hidden)).astype(np.float32), "dense"),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), "seq_axis"),
+        numpy_helper.from_array(np.array([-1], dtype=np.int64), "last_axis"),
+        numpy_helper.from_array(np.array(1e-9, dtype=np.float32), "eps"),
+    ]
+    nodes = [
+        helper.make_node("Gather", ["token_embeddings", "input_ids"], ["tokens"]),
+        helper.make_node("MatMul", ["tokens", "dense"], ["hidden"]),
+        helper.make_node("Tanh", ["hidden"], ["activated"]),
+        # masked mean pooling over the sequence, then L2 normalization
+        helper.make_node("Cast", ["attention_mask"], ["mask"], to=TensorProto.FLOAT),
+        helper.make_node("Unsqueeze", ["mask", "last_axis"], ["mask_3d"]),
+        helper.make_node("Mul", ["activated", "mask_3d"], ["masked"]),
+        helper.make_node("ReduceSum", ["masked", "seq_axis"], ["summed"], keepdims=0),
+        helper.make_node("ReduceSum", ["mask_3d", "seq_axis"], ["counts"], keepdims=0),
+        helper.make_node("Max", ["counts", "eps"], ["counts_clamped"]),
+        helper.make_node("Div", ["summed", "counts_clamped"], ["pooled"]),
+        helper.make_node("LpNormalization", ["pooled"], ["output"], axis=1, p=2),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "synthetic_encoder",
+        [
+            helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "seq"]),
+            helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "seq"]),
+        ],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", dim])],
+        initializer=initializers,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 18)])
+    model.ir_version = 9
+    onnx.checker.check_model(model)
+
+    model_path = os.path.join(out_dir, model_file)
+    onnx.save(model, model_path)
+    return model_path
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: python -m benchmarks.synthetic_model <out_dir>")
+    print(build(sys.argv[1]))
@@ -285,13 +285,32 @@ resource "google_cloud_run_v2_service" "storyspark_service" {
       resources {
         # Using the simplified V2 resource limits block
         limits = {
-          memory = "1Gi"
+          # The API process plus up to two embedding worker processes, each with its own copy of the model (see
+          # EmbeddingsWorkerPool)
+          memory = "2Gi"
         }
       }
       
       ports {
         container_port = 8080
       }
+
+      # Do not route traffic to a new instance until the embeddings model is loaded and warmed up
+      startup_probe {
+        http_get {
+          path = "/readyz"
+        }
+        initial_delay_seconds = 0
+        period_seconds        = 2
+        timeout_seconds       = 2
+        failure_threshold     = 60
+      }
+
+      liveness_probe {
+        http_get {
+          path = "/healthz"
+        }
+      }
       
       volume_mounts {
         name       = var.model_export_bucket_volume_name
@@ -1,12 +1,42 @@
 # export_with_pooling.py
+import json
+import time
+import hashlib
 import torch
 import onnx
 from onnx import shape_inference, checker
 import onnxruntime as ort
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from onnxruntime.quantization.shape_inference import quant_pre_process
 from pathlib import Path
 from transformers import AutoModel, AutoTokenizer
 import numpy as np
 
+# Book-ish strings used to check that the quantized model still agrees with the fp32 one.  Mixes the short
+# OpenLibrary subject strings we embed most often with a few sentence-length descriptions.
+PARITY_CORPUS = [
+    "trains",
+    "friendship",
+    "dinosaurs",
+    "canoe",
+    "elephants",
+    "pigs",
+    "sharing",
+    "birthday parties",
+    "picture books",
+    "stories in rhyme",
+    "railroads",
+    "giants",
+    "princesses",
+    "emotions",
+    "patience",
+    "the little engine that could",
+    "A little blue engine helps a stranded train of toys and food get over the mountain to the children on the other side.",
+    "Gerald is careful.  Piggie is not.  Piggie cannot help smiling.  Gerald can.  Gerald worries so that Piggie does not have to.",
+    "A young princess outwits a lonely giant by giving him the gift he needs most: a friend to share his supper and his stories.",
+    "Waiting is not easy, especially when your best friend tells you there is a surprise and you have to wait until the sun goes down.",
+]
+
 class EncoderWithPooling(torch.nn.Module):
     def __init__(self, base_model):
         super().__init__()
@@ -25,6 +55,137 @@ class EncoderWithPooling(torch.nn.Module):
         norm = torch.nn.functional.normalize(pooled, p=2, dim=1)
         return norm  # [batch, hidden]
     
+def variant_path(export_path: Path, variant: str) -> Path:
+    """
+    all-MiniLM-L6-v2.onnx -> all-MiniLM-L6-v2.int8.onnx.  Must match the naming used by EmbeddingsGenerator for STORYSPARK_MODEL_VARIANT.
+    """
+    return export_path.with_name(f"{export_path.stem}.{variant}{export_path.suffix}")
+
+def quantize_model(export_path: Path) -> Path:
+    """
+    Produce a dynamically quantized (int8 weights, activations quantized at runtime) copy of the exported model.
+    Dynamic quantization needs no calibration data and is the recommended scheme for transformer encoders on CPU.
+    """
+    int8_path = variant_path(export_path, "int8")
+    preprocessed_path = variant_path(export_path, "preprocessed")
+
+    # Pre-processing (symbolic shape inference + graph optimization) lets the quantizer find more MatMuls to quantize
+    try:
+        quant_pre_process(str(export_path), str(preprocessed_path), skip_symbolic_shape=False)
+        source_path = preprocessed_path
+    except Exception as e:
+        print("Quantization pre-processing failed, quantizing the exported model directly:", e)
+        source_path = export_path
+
+    quantize_dynamic(
+        model_input=str(source_path),
+        model_output=str(int8_path),
+        weight_type=QuantType.QInt8,
+        per_channel=False,
+        reduce_range=False,
+    )
+    if preprocessed_path.exists():
+        preprocessed_path.unlink()
+
+    print(f"Exported int8 ONNX model to: {int8_path}")
+    return int8_path
+
+def validate_quantized_model(tokenizer, fp32_path: Path, int8_path: Path, batch_sizes=(1, 8, 32), runs: int = 20):
+    """
+    Compare the int8 model against fp32: cosine parity on PARITY_CORPUS and median latency per batch size.
+    """
+    fp32_sess = ort.InferenceSession(str(fp32_path), providers=["CPUExecutionProvider"])
+    int8_sess = ort.InferenceSession(str(int8_path), providers=["CPUExecutionProvider"])
+
+    def embed(sess, texts):
+        toks = tokenizer(texts, padding="longest", truncation=True, return_tensors="np")
+        feeds = {"input_ids": toks["input_ids"].astype(np.int64), "attention_mask": toks["attention_mask"].astype(np.int64)}
+        return np.asarray(sess.run([sess.get_outputs()[0].name], feeds)[0], dtype=np.float32)
+
+    # Cosine parity
+    fp32_emb = embed(fp32_sess, PARITY_CORPUS)
+    int8_emb = embed(int8_sess, PARITY_CORPUS)
+    cosine = np.sum(fp32_emb * int8_emb, axis=1) / (
+        np.linalg.norm(fp32_emb, axis=1) * np.linalg.norm(int8_emb, axis=1) + 1e-12
+    )
+    print(f"int8 vs fp32 cosine parity over {len(PARITY_CORPUS)} texts: mean={cosine.mean():.5f} min={cosine.min():.5f}")
+
+    # The ranking we actually serve is "which book is closest", so also check nearest neighbours agree
+    fp32_nn = np.argsort(-(fp32_emb @ fp32_emb.T), axis=1)[:, 1]
+    int8_nn = np.argsort(-(int8_emb @ int8_emb.T), axis=1)[:, 1]
+    print(f"int8 vs fp32 nearest-neighbour agreement: {np.mean(fp32_nn == int8_nn):.2%}")
+
+    # Latency per batch size
+    for batch_size in batch_sizes:
+        texts = [PARITY_CORPUS[i % len(PARITY_CORPUS)] for i in range(batch_size)]
+        timings = {}
+        for name, sess in (("fp32", fp32_sess), ("int8", int8_sess)):
+            embed(sess, texts)  # warm up
+            samples = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                embed(sess, texts)
+                samples.append((time.perf_counter() - start) * 1000.0)
+            timings[name] = float(np.median(samples))
+        print(
+            f"batch size {batch_size}: fp32 {timings['fp32']:.2f} ms, int8 {timings['int8']:.2f} ms "
+            f"({timings['fp32'] / timings['int8']:.2f}x)"
+        )
+
+    print(f"Model size: fp32 {_model_size_mb(fp32_path):.1f} MB, int8 {_model_size_mb(int8_path):.1f} MB")
+
+def model_fingerprint(model_path: Path) -> str:
+    """
+    Must match OnnxSessionFactory._model_fingerprint in the service.
+    """
+    fingerprint = hashlib.sha256()
+    with model_path.open("rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            fingerprint.update(block)
+    data_path = model_path.with_name(model_path.name + ".data")
+    if data_path.exists():
+        fingerprint.update(str(data_path.stat().st_size).encode("utf-8"))
+    return fingerprint.hexdigest()[:12]
+
+def write_fingerprint_manifest(model_path: Path, fingerprint: str) -> Path:
+    """
+    Record the fingerprint next to the model, with the sizes it was computed for, so the service can look it up
+    instead of hashing the model on every cold start.  Read by OnnxSessionFactory._model_fingerprint.
+    """
+    data_path = model_path.with_name(model_path.name + ".data")
+    manifest_path = model_path.with_name(model_path.name + ".fingerprint.json")
+    manifest_path.write_text(json.dumps({
+        "fingerprint": fingerprint,
+        "model_size": model_path.stat().st_size,
+        "data_size": data_path.stat().st_size if data_path.exists() else None,
+    }))
+    print(f"Wrote model fingerprint manifest: {manifest_path}")
+    return manifest_path
+
+def export_optimized_model(model_path: Path) -> Path:
+    """
+    Save the graph-optimized (ORT format, "extended" level) copy of a model under the name the service looks for.
+    The models bucket is mounted read-only in Cloud Run, so the service cannot write this itself; shipping it with
+    the models lets every cold start skip graph optimization.
+    """
+    fingerprint = model_fingerprint(model_path)
+    write_fingerprint_manifest(model_path, fingerprint)
+    optimized_path = model_path.with_name(f"{model_path.stem}.{fingerprint}.ort{ort.__version__}.extended.ort")
+    options = ort.SessionOptions()
+    # "all" adds CPU-specific layout changes; the service applies those itself on load
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = str(optimized_path)
+    options.add_session_config_entry("session.save_model_format", "ORT")
+    ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+    print(f"Exported optimized ORT model to: {optimized_path}")
+    return optimized_path
+
+def _model_size_mb(model_path: Path) -> float:
+    # Large exports keep their weights in a side-car .data file
+    data_path = model_path.with_name(model_path.name + ".data")
+    total = model_path.stat().st_size + (data_path.stat().st_size if data_path.exists() else 0)
+    return total / (1024 * 1024)
+
 def export_model(model_name: str, out_dir: Path, opset: int = 18):
     out_dir.mkdir(parents=True, exist_ok=True)
     export_path = out_dir / "all-MiniLM-L6-v2.onnx"
@@ -97,6 +258,14 @@ def export_model(model_name: str, out_dir: Path, opset: int = 18):
     run_smoke(["one example"])
     run_smoke(["a", "b", "c"])
 
+    # int8 variant, selectable at runtime with STORYSPARK_MODEL_VARIANT=int8
+    int8_path = quantize_model(export_path)
+    validate_quantized_model(tokenizer, export_path, int8_path)
+
+    # Pre-optimized graphs for both variants so the service's cold start skips graph optimization
+    export_optimized_model(export_path)
+    export_optimized_model(int8_path)
+
 if __name__ == "__main__":
     model_name = "sentence-transformers/all-MiniLM-L6-v2"
     out_dir = Path("./models")